@@ -0,0 +1,166 @@
+import time
+import sqlite3
+import logging
+import threading
+import cPickle as pickle
+
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Seconds a response stays fresh, per api method. Methods not listed here
+# are never cached.
+DEFAULT_TTLS = {'user': 24*3600,
+				'user_recent_media': 6*3600,
+				'user_search': 7*24*3600}
+
+
+class ResponseCache(object):
+	""" An on-disk cache of api responses in a SQLite file. Entries expire
+		after the ttl of their endpoint, and once the cache holds more than
+		max_entries the least recently used entries are evicted. Hits and
+		misses are counted per endpoint. The cache is thread safe, but
+		its entry count is kept in process, so every process needs a file
+		of its own. A cache the database can't read or write, locked by
+		another process for instance, counts as a miss rather than failing
+		the call."""
+
+	def __init__(self, path, ttls=None, max_entries=100000,
+				 clock=time.time):
+		self._ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+		self._max_entries = max_entries
+		self._clock = clock
+		self._lock = threading.Lock()
+		self._hits = {}
+		self._misses = {}
+		self._db = sqlite3.connect(path, timeout=30,
+								   check_same_thread=False)
+		self._db.execute('CREATE TABLE IF NOT EXISTS response ('
+						 'key TEXT PRIMARY KEY, endpoint TEXT, value BLOB, '
+						 'stored_at REAL, accessed_at REAL)')
+		self._db.execute('CREATE INDEX IF NOT EXISTS ix_response_accessed '
+						 'ON response (accessed_at)')
+		self._db.commit()
+		self._size = self._db.execute('SELECT count(*) FROM response')\
+							 .fetchone()[0]
+
+	def caches(self, endpoint):
+		""" True if responses of this endpoint are cached."""
+
+		return endpoint in self._ttls
+
+	def get(self, endpoint, key):
+		""" Return a tuple of whether the key was found fresh in the cache
+			and the cached response."""
+
+		now = self._clock()
+		with self._lock:
+			try:
+				row = self._db.execute('SELECT value, stored_at FROM response '
+									   'WHERE key = ?', (key,)).fetchone()
+				if row is not None and now - row[1] <= self._ttls[endpoint]:
+					self._db.execute('UPDATE response SET accessed_at = ? '
+									 'WHERE key = ?', (now, key))
+					self._db.commit()
+			except sqlite3.Error as error:
+				log.warning('Cache: lookup failed, counted as a miss: %s',
+							error)
+				self._rollback()
+				row = None
+			if row is None or now - row[1] > self._ttls[endpoint]:
+				self._count(self._misses, endpoint)
+				metrics.inc('api_cache_misses_total', endpoint=endpoint)
+				return False, None
+			self._count(self._hits, endpoint)
+			metrics.inc('api_cache_hits_total', endpoint=endpoint)
+		return True, pickle.loads(str(row[0]))
+
+	def put(self, endpoint, key, value):
+		""" Store a response, evicting old entries if the cache is full."""
+
+		now = self._clock()
+		blob = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+		with self._lock:
+			size = self._size
+			try:
+				cursor = self._db.execute('INSERT OR IGNORE INTO response '
+										  'VALUES (?, ?, ?, ?, ?)',
+										  (key, endpoint, blob, now, now))
+				if cursor.rowcount:
+					self._size += 1
+				else:
+					self._db.execute('UPDATE response SET value = ?, '
+									 'stored_at = ?, accessed_at = ? '
+									 'WHERE key = ?', (blob, now, now, key))
+				if self._size > self._max_entries:
+					self._evict()
+				self._db.commit()
+			except sqlite3.Error as error:
+				log.warning('Cache: could not store a response: %s', error)
+				self._size = size
+				self._rollback()
+
+	def _rollback(self):
+		try:
+			self._db.rollback()
+		except sqlite3.Error:
+			pass
+
+	def stats(self):
+		""" Return hits, misses and hit rate in total and per endpoint."""
+
+		with self._lock:
+			endpoints = {}
+			for endpoint in set(self._hits) | set(self._misses):
+				endpoints[endpoint] = self._rates(self._hits.get(endpoint, 0),
+												  self._misses.get(endpoint, 0))
+			stats = self._rates(sum(self._hits.values()),
+								sum(self._misses.values()))
+			stats['entries'] = self._size
+			stats['endpoints'] = endpoints
+		return stats
+
+	def _rates(self, hits, misses):
+		lookups = hits + misses
+		return {'hits': hits, 'misses': misses,
+				'hit_rate': float(hits)/lookups if lookups else 0.}
+
+	def _count(self, counts, endpoint):
+		counts[endpoint] = counts.get(endpoint, 0) + 1
+
+	def _evict(self):
+		""" Drop the least recently used tenth of the cache, so eviction
+			doesn't run on every put."""
+
+		keep = int(self._max_entries*.9)
+		self._db.execute('DELETE FROM response WHERE key IN ('
+						 'SELECT key FROM response '
+						 'ORDER BY accessed_at LIMIT ?)',
+						 (self._size - keep,))
+		self._size = keep
+
+
+class CachedAPI(object):
+	""" Wraps an api client so calls to cached endpoints are answered from
+		a ResponseCache when possible. Only misses reach the client, so
+		repeated lookups cost no quota."""
+
+	def __init__(self, client, cache):
+		self._client = client
+		self.cache = cache
+
+	def __getattr__(self, name):
+		attr = getattr(self._client, name)
+		if not self.cache.caches(name):
+			return attr
+		def cached(*args, **kwargs):
+			# Ids are formatted with %s so '123' and 123L share an entry.
+			key = '%s:%s' %(name, ','.join(['%s' %arg for arg in args] +
+										   ['%s=%s' %item for item in
+											sorted(kwargs.items())]))
+			hit, value = self.cache.get(name, key)
+			if not hit:
+				value = attr(*args, **kwargs)
+				self.cache.put(name, key, value)
+			return value
+		return cached
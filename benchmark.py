@@ -0,0 +1,166 @@
+""" End-to-end crawl benchmark against MockInstagramAPI and a local database.
+
+Runs InfluencerDataPull for the most followed users of a synthetic graph and
+reports users/sec, edges/sec, database round-trips and api calls per user.
+The benchmark database is dropped and recreated on every run, so never
+point it at a database holding real data.
+
+	python benchmark.py --users 5000 --latency 0.01 --workers 4
+	python benchmark.py --save baseline.json
+	python benchmark.py --baseline baseline.json --tolerance 0.2
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+
+import psycopg2.extensions
+from sqlalchemy import create_engine, event
+
+import models
+from db_setup import Base, InstagramUser, Follower, create_tables
+from mock_api import MockInstagramAPI
+from metrics import metrics, LogExporter
+
+# Metrics where a higher value is better. Lower is better for the rest.
+HIGHER_IS_BETTER = ('users_per_sec', 'edges_per_sec')
+
+
+class RoundTripCounter(object):
+	""" Counts statements, COPYs and commits sent to the database. The
+		bulk writer uses raw DBAPI cursors, so statements are counted on
+		the cursor rather than through SQLAlchemy."""
+
+	def __init__(self):
+		self.count = 0
+		self._lock = threading.Lock()
+
+	def add(self):
+		with self._lock:
+			self.count += 1
+
+	def attach(self, engine):
+		counter = self
+
+		class CountingCursor(psycopg2.extensions.cursor):
+			def execute(self, *args, **kwargs):
+				counter.add()
+				return super(CountingCursor, self).execute(*args, **kwargs)
+
+			def executemany(self, *args, **kwargs):
+				counter.add()
+				return super(CountingCursor, self).executemany(*args,
+															   **kwargs)
+
+			def copy_expert(self, *args, **kwargs):
+				counter.add()
+				return super(CountingCursor, self).copy_expert(*args,
+															   **kwargs)
+
+		@event.listens_for(engine, 'connect')
+		def count_cursors(dbapi_connection, connection_record):
+			dbapi_connection.cursor_factory = CountingCursor
+
+		@event.listens_for(engine, 'commit')
+		def count_commit(connection):
+			counter.add()
+
+
+def run_benchmark(database_url, num_users=5000, latency=0., workers=1,
+				  influencers=1, seed=0):
+	""" Crawl a fresh synthetic graph and return the benchmark metrics."""
+
+	mock = MockInstagramAPI(num_users=num_users, latency=latency, seed=seed,
+							limit=10**9)
+	fresh = create_engine(database_url)
+	Base.metadata.drop_all(fresh)
+	create_tables(fresh)
+	fresh.dispose()
+
+	models.configure(database_url=database_url, client=mock)
+	round_trips = RoundTripCounter()
+	round_trips.attach(models.get_engine())
+
+	start = time.time()
+	for instagram_id in mock.most_followed(influencers):
+		models.InfluencerDataPull(instagram_id, workers=workers)
+	elapsed = time.time() - start
+
+	session = models.session
+	users = session.query(InstagramUser).count()
+	edges = session.query(Follower).count()
+	session.remove()
+	per_user = float(max(users, 1))
+	return {'seconds': elapsed,
+			'users': users,
+			'edges': edges,
+			'users_per_sec': users/elapsed,
+			'edges_per_sec': edges/elapsed,
+			'api_calls': mock.total_calls(),
+			'api_calls_per_user': mock.total_calls()/per_user,
+			'db_round_trips': round_trips.count,
+			'db_round_trips_per_user': round_trips.count/per_user,
+			'api_calls_by_endpoint': mock.calls}
+
+def regressions(results, baseline, tolerance):
+	""" Return the metrics that got worse than the baseline by more than
+		the tolerance, as (name, baseline, current) tuples."""
+
+	worse = []
+	for name, before in sorted(baseline.items()):
+		if not isinstance(before, (int, long, float)) or name not in results \
+		   or name in ('seconds', 'users', 'edges', 'api_calls',
+					   'db_round_trips'):
+			continue
+		after = results[name]
+		if name in HIGHER_IS_BETTER:
+			if after < before*(1 - tolerance):
+				worse.append((name, before, after))
+		elif after > before*(1 + tolerance):
+			worse.append((name, before, after))
+	return worse
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Crawl benchmark.')
+	parser.add_argument('--database',
+						default='postgresql://localhost/instagram_benchmark')
+	parser.add_argument('--users', type=int, default=5000)
+	parser.add_argument('--latency', type=float, default=0.)
+	parser.add_argument('--workers', type=int, default=1)
+	parser.add_argument('--influencers', type=int, default=1)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--save', help='write the metrics to this file')
+	parser.add_argument('--baseline', help='compare against these metrics')
+	parser.add_argument('--tolerance', type=float, default=.2)
+	parser.add_argument('--metrics', action='store_true',
+						help='log api, database and stage timings')
+	args = parser.parse_args(argv)
+	if args.metrics:
+		logging.basicConfig(level=logging.INFO, format='%(message)s')
+		metrics.enable([LogExporter()])
+
+	results = run_benchmark(args.database, num_users=args.users,
+							latency=args.latency, workers=args.workers,
+							influencers=args.influencers, seed=args.seed)
+	for name in ('seconds', 'users', 'edges', 'users_per_sec',
+				 'edges_per_sec', 'api_calls_per_user',
+				 'db_round_trips_per_user'):
+		print '%-24s %12.2f' %(name, results[name])
+	metrics.export()
+	if args.save:
+		with open(args.save, 'w') as f:
+			json.dump(results, f, indent=2, sort_keys=True)
+	if args.baseline:
+		with open(args.baseline) as f:
+			worse = regressions(results, json.load(f), args.tolerance)
+		for name, before, after in worse:
+			print 'Regression: %s went from %.2f to %.2f.' %(name, before,
+															  after)
+		return 1 if worse else 0
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,175 @@
+from cStringIO import StringIO
+
+from metrics import metrics
+
+
+def _copy_value(value):
+	""" Format a single value for the text format of postgres' COPY."""
+
+	if value is None:
+		return '\\N'
+	if isinstance(value, unicode):
+		value = value.encode('utf-8')
+	else:
+		value = str(value)
+	return value.replace('\\', '\\\\')\
+				.replace('\t', '\\t')\
+				.replace('\n', '\\n')\
+				.replace('\r', '\\r')
+
+
+class BulkWriter(object):
+	""" Buffers rows destined for a single table and writes them in batches.
+		Rows added one at a time with add are flushed every batch_size rows,
+		as multi-row INSERT statements. Rows handed over at once with
+		add_all are buffered whole, and a flush of at least copy_threshold
+		rows, from add_all or an explicit flush, is streamed through COPY
+		into a temporary table instead. Either way rows that violate a unique
+		constraint are skipped by the database with ON CONFLICT DO NOTHING,
+		so duplicates never cost a rollback.
+
+		To upsert instead, pass the columns of the unique constraint as
+		conflict_columns and the columns to overwrite on existing rows as
+		update_columns. Columns that merge the stored value with the new
+		one instead go in update_expressions, mapped to the SQL that sets
+		them, which can refer to the stored row by the table name and to
+		the new one as EXCLUDED. Rows for the same key within a flush are
+		collapsed to the last one, which postgres requires of ON CONFLICT
+		DO UPDATE.
+
+		Each flush runs in the session's transaction and commits it."""
+
+	def __init__(self, table, columns, session, batch_size=1000,
+				 copy_threshold=10000, conflict_columns=None,
+				 update_columns=None, update_expressions=None):
+		self._table = table
+		self._columns = list(columns)
+		self._session = session
+		self._batch_size = batch_size
+		self._copy_threshold = copy_threshold
+		self._conflict_columns = list(conflict_columns or [])
+		self._update_columns = list(update_columns or [])
+		self._update_expressions = dict(update_expressions or {})
+		self._rows = []
+		self.rows_written = 0
+		self.rows_skipped = 0
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.flush()
+		else:
+			self._rows = []
+
+	def add(self, **row):
+		""" Buffer a single row, flushing once the batch is full."""
+
+		self._rows.append(tuple(row[column] for column in self._columns))
+		if len(self._rows) >= self._batch_size:
+			self.flush()
+
+	def add_all(self, rows):
+		""" Buffer an iterable of row dicts, all of them, and flush them in
+			one go if they make up a full batch, so that large writes reach
+			COPY."""
+
+		for row in rows:
+			self._rows.append(tuple(row[column] for column in self._columns))
+		if len(self._rows) >= self._batch_size:
+			self.flush()
+
+	def flush(self):
+		""" Write all buffered rows and return how many were inserted, or
+			inserted and updated when upserting."""
+
+		rows, self._rows = self._rows, []
+		if not rows:
+			return 0
+		if self._update_columns or self._update_expressions:
+			rows = self._last_per_key(rows)
+		table = self._table.name
+		with metrics.timer('db_flush_seconds', table=table):
+			cursor = self._session.connection().connection.cursor()
+			try:
+				if len(rows) >= self._copy_threshold:
+					inserted = self._copy(cursor, rows)
+				else:
+					inserted = self._insert(cursor, rows)
+				self._session.commit()
+			except Exception:
+				self._session.rollback()
+				metrics.inc('db_flush_errors_total', table=table)
+				raise
+			finally:
+				cursor.close()
+		self.rows_written += inserted
+		self.rows_skipped += len(rows) - inserted
+		metrics.inc('db_flushes_total', table=table)
+		metrics.inc('db_rows_written_total', inserted, table=table)
+		metrics.inc('db_duplicate_rows_total', len(rows) - inserted,
+					table=table)
+		return inserted
+
+	def _column_list(self):
+		return ', '.join(self._columns)
+
+	def _on_conflict(self):
+		if not self._update_columns and not self._update_expressions:
+			return 'ON CONFLICT DO NOTHING'
+		updates = ['%s = EXCLUDED.%s' % (column, column)
+				   for column in self._update_columns]
+		updates.extend('%s = %s' % (column, expression) for column, expression
+					   in sorted(self._update_expressions.iteritems()))
+		return 'ON CONFLICT (%s) DO UPDATE SET %s' \
+			   % (', '.join(self._conflict_columns), ', '.join(updates))
+
+	def _last_per_key(self, rows):
+		""" Keep only the last row for each conflict key, in order."""
+
+		positions = [self._columns.index(column)
+					 for column in self._conflict_columns]
+		last = {}
+		for i, row in enumerate(rows):
+			last[tuple(row[position] for position in positions)] = i
+		keep = set(last.itervalues())
+		return [row for i, row in enumerate(rows) if i in keep]
+
+	def _insert(self, cursor, rows):
+		""" Write rows with multi-row INSERT statements of at most
+			batch_size rows each."""
+
+		template = '(' + ', '.join(['%s'] * len(self._columns)) + ')'
+		inserted = 0
+		for start in xrange(0, len(rows), self._batch_size):
+			chunk = rows[start:start + self._batch_size]
+			values = ', '.join(cursor.mogrify(template, row) for row in chunk)
+			cursor.execute('INSERT INTO %s (%s) VALUES %s %s'
+						   % (self._table.name, self._column_list(), values,
+							  self._on_conflict()))
+			inserted += cursor.rowcount
+		return inserted
+
+	def _copy(self, cursor, rows):
+		""" Stream rows into a temporary table with COPY and move them into
+			the target table in a single INSERT ... SELECT."""
+
+		staging = '_bulk_%s' % self._table.name
+		columns = self._column_list()
+		buf = StringIO()
+		for row in rows:
+			buf.write('\t'.join(_copy_value(value) for value in row))
+			buf.write('\n')
+		buf.seek(0)
+
+		cursor.execute('CREATE TEMP TABLE %s AS SELECT %s FROM %s WITH NO DATA'
+					   % (staging, columns, self._table.name))
+		cursor.copy_expert('COPY %s (%s) FROM STDIN' % (staging, columns), buf)
+		cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s %s'
+					   % (self._table.name, columns, columns, staging,
+						  self._on_conflict()))
+		inserted = cursor.rowcount
+		# On failure the rollback in flush drops the staging table instead.
+		cursor.execute('DROP TABLE %s' % staging)
+		return inserted
@@ -0,0 +1,162 @@
+""" Hashtags and mentions extracted from media captions, and topic search
+over captions, bios and hashtags.
+
+	python captions.py backfill
+	python captions.py search fitness yoga
+"""
+import re
+import sys
+import logging
+
+from sqlalchemy import text
+
+from db_setup import Media, MediaHashtag, MediaMention, SEARCH_CONFIG
+from bulk_writer import BulkWriter
+
+log = logging.getLogger(__name__)
+
+HASHTAG = re.compile(r'(?<!\w)#(\w+)', re.UNICODE)
+# Usernames are letters, digits, underscores and periods, but never end in
+# a period.
+MENTION = re.compile(r'(?<![\w@])@([\w.]*\w)', re.UNICODE)
+
+# Weight of a bio match and of a hashtag match relative to the rank of a
+# caption match, in search_users.
+BIO_WEIGHT = 2.
+HASHTAG_WEIGHT = .5
+
+SEARCH = text("""
+	WITH query AS (SELECT plainto_tsquery(:config, :query) AS q),
+	matches AS (
+		SELECT media.instagram_id, ts_rank(media.caption_tsv, query.q) AS rank
+		FROM media, query
+		WHERE media.caption_tsv @@ query.q
+		UNION ALL
+		SELECT instagram_user.instagram_id,
+			   :bio_weight*ts_rank(instagram_user.bio_tsv, query.q)
+		FROM instagram_user, query
+		WHERE instagram_user.bio_tsv @@ query.q
+		UNION ALL
+		SELECT instagram_id, :hashtag_weight
+		FROM media_hashtag
+		WHERE tag = ANY(:tags))
+	SELECT instagram_user.instagram_id, instagram_user.instagram_username,
+		   sum(matches.rank) AS score, count(*) AS matches
+	FROM matches
+	JOIN instagram_user ON instagram_user.instagram_id = matches.instagram_id
+	GROUP BY instagram_user.instagram_id, instagram_user.instagram_username
+	ORDER BY score DESC
+	LIMIT :limit""")
+
+
+def extract_hashtags(caption):
+	""" Return the unique hashtags of a caption, lower cased and without
+		the #, in the order they appear."""
+
+	return _unique(tag.lower() for tag in HASHTAG.findall(caption or ''))
+
+def extract_mentions(caption):
+	""" Return the unique usernames mentioned in a caption, lower cased and
+		without the @."""
+
+	return _unique(username.lower()
+				   for username in MENTION.findall(caption or ''))
+
+def _unique(items):
+	seen = set()
+	unique = []
+	for item in items:
+		if item not in seen:
+			seen.add(item)
+			unique.append(item)
+	return unique
+
+
+class EntityWriter(object):
+	""" Writes the hashtags and mentions of media captions to the
+		media_hashtag and media_mention tables through bulk writers, so a
+		page of media costs a statement per table. Use it as a context
+		manager, or call flush()."""
+
+	def __init__(self, session, batch_size=1000):
+		self._hashtags = BulkWriter(MediaHashtag.__table__,
+									['media_id', 'instagram_id', 'tag'],
+									session, batch_size=batch_size)
+		self._mentions = BulkWriter(MediaMention.__table__,
+									['media_id', 'instagram_id', 'username'],
+									session, batch_size=batch_size)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self._hashtags.__exit__(exc_type, exc_value, traceback)
+		self._mentions.__exit__(exc_type, exc_value, traceback)
+
+	def add(self, instagram_id, media_id, caption):
+		for tag in extract_hashtags(caption):
+			self._hashtags.add(media_id=media_id, instagram_id=instagram_id,
+							   tag=tag[:140])
+		for username in extract_mentions(caption):
+			self._mentions.add(media_id=media_id, instagram_id=instagram_id,
+							   username=username[:80])
+
+	def flush(self):
+		self._hashtags.flush()
+		self._mentions.flush()
+
+
+def backfill(session, batch_size=10000):
+	""" Extract the hashtags and mentions of every stored caption, walking
+		the media table in id order batch_size rows at a time. Media whose
+		entities are already stored are skipped by the database."""
+
+	last_id = 0
+	total = 0
+	with EntityWriter(session) as writer:
+		while True:
+			rows = session.query(Media.id, Media.instagram_id, Media.media_id,
+								 Media.caption)\
+						  .filter(Media.id > last_id,
+								  Media.caption != None,
+								  Media.caption != '')\
+						  .order_by(Media.id)\
+						  .limit(batch_size)\
+						  .all()
+			if not rows:
+				break
+			for _, instagram_id, media_id, caption in rows:
+				writer.add(instagram_id, media_id, caption)
+			writer.flush()
+			last_id = rows[-1][0]
+			total += len(rows)
+			log.info('Captions: extracted entities of %d media.', total)
+	return total
+
+def search_users(session, query, limit=20):
+	""" Rank users by how well their captions, bio and hashtags match a
+		topic query such as 'vegan recipes' or '#fitness'. Captions and
+		bios are matched through their GIN indexed text search columns,
+		hashtags by exact tag. Returns a list of (instagram_id, username,
+		score, matches) tuples, best first."""
+
+	tags = [word.lstrip('#').lower() for word in query.split()
+			if word.lstrip('#')]
+	rows = session.execute(SEARCH, {'config': SEARCH_CONFIG,
+									'query': query.replace('#', ' '),
+									'tags': tags,
+									'bio_weight': BIO_WEIGHT,
+									'hashtag_weight': HASHTAG_WEIGHT,
+									'limit': limit})
+	return [tuple(row) for row in rows]
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	import models
+	if sys.argv[1:2] == ['backfill']:
+		backfill(models.session)
+	elif sys.argv[1:2] == ['search']:
+		for instagram_id, username, score, matches in \
+			search_users(models.session, ' '.join(sys.argv[2:])):
+			print '%d\t%s\t%.4f\t%d' %(instagram_id, username, score, matches)
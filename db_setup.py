@@ -1,29 +1,65 @@
+import sys
+
 from sqlalchemy import (Column, ForeignKey, Integer, String, Boolean, 
-						Text, UniqueConstraint,DateTime)
+						Text, UniqueConstraint,DateTime,Index,BigInteger,
+						Float,LargeBinary)
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy import create_engine
 
 Base = declarative_base()
 
+# The database used unless DATABASE_URL is set in .instagram_config.
+DATABASE_URL = 'postgresql://localhost/metis_adsthetic'
+
 class InstagramUser(Base):
 	__tablename__ = 'instagram_user'
 
 	id = Column(Integer,primary_key=True)
-	instagram_id = Column(String(80),nullable=False,unique=True)
+	instagram_id = Column(BigInteger,nullable=False,unique=True)
 	instagram_username = Column(String(80),nullable=False,unique=True)
 	bio = Column(Text)
 	num_followers = Column(Integer)
 	num_following = Column(Integer)
 	num_posts = Column(Integer)
-	latitude = Column(String(80))
-	longitude = Column(String(80))
+	# Home location estimated from the user's media, see geo.py.
+	latitude = Column(Float)
+	longitude = Column(Float)
+	geohash = Column(String(12))
 	user_order = Column(Integer,nullable=False)
 	pull_completion = Column(Boolean,default=False)
 	stored_at = Column(DateTime)
+	# When the full follower and follows lists were last fetched.
+	followers_refreshed_at = Column(DateTime)
+	follows_refreshed_at = Column(DateTime)
+	# The share of the user's followers stored, below 1 when their
+	# followers were sampled, see AddUserFollowers.
+	follower_sample_rate = Column(Float)
+	# The newest media stored, where the next media pull stops.
+	newest_media_id = Column(String(280))
+	media_refreshed_at = Column(DateTime)
+	# Kept up to date from bio by a trigger, see SEARCH_COLUMNS.
+	bio_tsv = Column(TSVECTOR)
+
+	__table_args__ = (Index('ix_instagram_user_bio_tsv', 'bio_tsv',
+							postgresql_using='gin'),
+					  Index('ix_instagram_user_geohash', 'geohash',
+							postgresql_ops={'geohash': 'varchar_pattern_ops'}),)
 
 	## Relationships
-	# follower = relationship('Follower', backref="instagram_user")
+	# Edges aren't constrained by a foreign key, since they reference users
+	# that haven't been pulled yet, so these joins are declared here only.
+	followers = relationship('Follower', lazy='dynamic', viewonly=True,
+				primaryjoin='InstagramUser.instagram_id=='
+							'foreign(Follower.instagram_id)')
+	follows = relationship('Follower', lazy='dynamic', viewonly=True,
+				primaryjoin='InstagramUser.instagram_id=='
+							'foreign(Follower.follower_id)')
+	follower_sketch = relationship('FollowerSketch', uselist=False,
+				viewonly=True,
+				primaryjoin='InstagramUser.instagram_id=='
+							'foreign(FollowerSketch.instagram_id)')
 	media = relationship('Media', backref="instagram_user")
 	influencer = relationship('Influencer', backref="instagram_user")
 	client = relationship('Client', backref="instagram_user")
@@ -33,39 +69,117 @@ class Media(Base):
 	__tablename__ = 'media'
 
 	id = Column(Integer, primary_key=True)
-	instagram_id = Column(String(80),ForeignKey('instagram_user.instagram_id'),
-									 nullable=False)
+	instagram_id = Column(BigInteger,ForeignKey('instagram_user.instagram_id'),
+									 nullable=False,index=True)
 	media_id = Column(String(280),nullable=False,unique=True)
 	num_likes = Column(Integer)
 	num_comments = Column(Integer)
-	latitude = Column(String(80))
-	longitude = Column(String(80))
+	latitude = Column(Float)
+	longitude = Column(Float)
+	# Indexed for prefix lookups by LIKE, whatever the collation.
+	geohash = Column(String(12))
 	caption = Column(Text, default='')
+	# Kept up to date from caption by a trigger, see SEARCH_COLUMNS.
+	caption_tsv = Column(TSVECTOR)
+
+	__table_args__ = (Index('ix_media_caption_tsv', 'caption_tsv',
+							postgresql_using='gin'),
+					  Index('ix_media_geohash', 'geohash',
+							postgresql_ops={'geohash': 'varchar_pattern_ops'}),)
+
+class MediaHashtag(Base):
+	__tablename__ = 'media_hashtag'
+
+	# The hashtags of each media, lower cased and without the #.
+	id = Column(Integer, primary_key=True)
+	media_id = Column(String(280),nullable=False)
+	instagram_id = Column(BigInteger,nullable=False)
+	tag = Column(String(140),nullable=False,index=True)
+
+	__table_args__ = (UniqueConstraint('media_id', 'tag',
+						name='_media_hashtag_uc'),)
+
+class MediaMention(Base):
+	__tablename__ = 'media_mention'
+
+	# The usernames mentioned in each media caption, without the @.
+	id = Column(Integer, primary_key=True)
+	media_id = Column(String(280),nullable=False)
+	instagram_id = Column(BigInteger,nullable=False)
+	username = Column(String(80),nullable=False,index=True)
+
+	__table_args__ = (UniqueConstraint('media_id', 'username',
+						name='_media_mention_uc'),)
 
 class Follower(Base):
 	__tablename__ = 'follower'
 
 	id = Column(Integer, primary_key=True)
-	# May need to add foreign key relation to instagram id
-	# ForeignKey('instagram_user.instagram_id')
-	instagram_id = Column(String(80),nullable=False)
-	follower_id = Column(String(80),nullable=False)
+	# The user being followed and the user following them. Lookups by
+	# instagram_id use the unique constraint, by follower_id its own index.
+	instagram_id = Column(BigInteger,nullable=False)
+	follower_id = Column(BigInteger,nullable=False,index=True)
 
 	__table_args__ = (UniqueConstraint('instagram_id', 'follower_id', 
 						name='_following_uc'),)
 
+class FollowerSketch(Base):
+	__tablename__ = 'follower_sketch'
+
+	# The MinHash signature and HyperLogLog registers of a user's
+	# followers, as raw uint32 and uint8 arrays, see sketches.py.
+	id = Column(Integer, primary_key=True)
+	instagram_id = Column(BigInteger,nullable=False,unique=True)
+	minhash = Column(LargeBinary,nullable=False)
+	hll = Column(LargeBinary,nullable=False)
+	updated_at = Column(DateTime)
+
+class UnavailableUser(Base):
+	__tablename__ = 'unavailable_user'
+
+	# Users the api refused to return, private accounts and deleted ones,
+	# which are never requested again.
+	id = Column(Integer, primary_key=True)
+	instagram_id = Column(BigInteger,nullable=False,unique=True)
+	reason = Column(String(20),nullable=False)
+	recorded_at = Column(DateTime)
+
+class CrawlTask(Base):
+	__tablename__ = 'crawl_task'
+
+	# One row per user and task: profile, media, followers or follows.
+	# Status moves from pending to running to done, or failed for users
+	# the api won't return.
+	id = Column(Integer, primary_key=True)
+	instagram_id = Column(BigInteger,nullable=False)
+	task = Column(String(20),nullable=False)
+	user_order = Column(Integer,nullable=False)
+	status = Column(String(20),nullable=False,default='pending')
+	# Pagination cursor of the last page stored, for resuming.
+	cursor = Column(Text)
+	attempts = Column(Integer,nullable=False,default=0)
+	error = Column(Text)
+	# The worker running the task. updated_at doubles as its lease.
+	worker = Column(String(80))
+	updated_at = Column(DateTime)
+
+	__table_args__ = (UniqueConstraint('instagram_id', 'task', 
+						name='_crawl_task_uc'),
+					  Index('ix_crawl_task_status_order', 'status', 
+						'user_order', 'id'),)
+
 class Influencer(Base):
 	__tablename__='influencer'
 
 	id = Column(Integer,primary_key=True)
-	instagram_id = Column(String(80),ForeignKey('instagram_user.instagram_id'),nullable=False)
+	instagram_id = Column(BigInteger,ForeignKey('instagram_user.instagram_id'),nullable=False)
 
 
 class Client(Base):
 	__tablename__='client'
 
 	id = Column(Integer,primary_key=True)
-	instagram_id = Column(String(80),ForeignKey('instagram_user.instagram_id'),nullable=True)
+	instagram_id = Column(BigInteger,ForeignKey('instagram_user.instagram_id'),nullable=True)
 
 	campaign = relationship('Campaign', backref="client")
 
@@ -85,12 +199,162 @@ class TargetCustomer(Base):
 	__tablename__='target_customer'
 
 	id = Column(Integer,primary_key=True)
-	instagram_id = Column(String(80),ForeignKey('instagram_user.instagram_id'),nullable=False)
+	instagram_id = Column(BigInteger,ForeignKey('instagram_user.instagram_id'),nullable=False)
 
 	campaign = relationship('Campaign', backref="target_customer")
 
 
+################################################################
+#################          Migrations          #################
+################################################################
+
+# Tables with an instagram_id column that references instagram_user.
+ID_REFERENCES = ('media', 'influencer', 'client', 'target_customer')
+# Every column holding an instagram id, by table.
+ID_COLUMNS = (('instagram_user', 'instagram_id'),
+			  ('media', 'instagram_id'),
+			  ('follower', 'instagram_id'),
+			  ('follower', 'follower_id'),
+			  ('crawl_task', 'instagram_id'),
+			  ('influencer', 'instagram_id'),
+			  ('client', 'instagram_id'),
+			  ('target_customer', 'instagram_id'))
+
+def migrate_ids_to_bigint(engine):
+	""" Convert the string instagram id columns of an existing database
+		to bigint and add the indexes used to look up edges by follower and
+		media by user. Foreign keys are dropped for the conversion and put
+		back afterwards. Runs in one transaction, and columns that are
+		already bigint are left alone."""
+
+	with engine.begin() as connection:
+		types = dict(((table, column), data_type) for table, column, data_type
+					 in connection.execute(
+						"SELECT table_name, column_name, data_type "
+						"FROM information_schema.columns "
+						"WHERE column_name IN ('instagram_id', 'follower_id')"))
+		pending = [(table, column) for table, column in ID_COLUMNS
+				   if types.get((table, column), 'bigint') != 'bigint']
+		if pending:
+			for table in ID_REFERENCES:
+				connection.execute('ALTER TABLE %s DROP CONSTRAINT IF EXISTS '
+								   '%s_instagram_id_fkey' %(table, table))
+			for table, column in pending:
+				print 'Migrating %s.%s to bigint.' %(table, column)
+				connection.execute('ALTER TABLE %s ALTER COLUMN %s TYPE bigint '
+								   'USING %s::bigint' %(table, column, column))
+			for table in ID_REFERENCES:
+				connection.execute('ALTER TABLE %s ADD CONSTRAINT '
+								   '%s_instagram_id_fkey FOREIGN KEY '
+								   '(instagram_id) REFERENCES '
+								   'instagram_user (instagram_id)'
+								   %(table, table))
+		connection.execute('CREATE INDEX IF NOT EXISTS ix_follower_follower_id '
+						   'ON follower (follower_id)')
+		connection.execute('CREATE INDEX IF NOT EXISTS ix_media_instagram_id '
+						   'ON media (instagram_id)')
+
+# Columns added since a table was first created, with their types.
+ADDED_COLUMNS = (('instagram_user', 'followers_refreshed_at', 'timestamp'),
+				 ('instagram_user', 'follows_refreshed_at', 'timestamp'),
+				 ('crawl_task', 'worker', 'varchar(80)'),
+				 ('instagram_user', 'newest_media_id', 'varchar(280)'),
+				 ('instagram_user', 'media_refreshed_at', 'timestamp'),
+				 ('instagram_user', 'bio_tsv', 'tsvector'),
+				 ('media', 'caption_tsv', 'tsvector'),
+				 ('instagram_user', 'geohash', 'varchar(12)'),
+				 ('media', 'geohash', 'varchar(12)'),
+				 ('instagram_user', 'follower_sample_rate', 'double precision'))
+
+# The text search columns, the text column each is computed from and the
+# text search configuration used. The simple configuration doesn't stem,
+# so it works for captions in any language and for hashtags.
+SEARCH_COLUMNS = (('instagram_user', 'bio_tsv', 'bio'),
+				  ('media', 'caption_tsv', 'caption'))
+SEARCH_CONFIG = 'pg_catalog.simple'
+
+def add_missing_columns(engine):
+	""" Add the columns in ADDED_COLUMNS to the tables of an existing
+		database. Columns that already exist are left alone."""
+
+	with engine.begin() as connection:
+		existing = set(tuple(row) for row in connection.execute(
+						"SELECT table_name, column_name "
+						"FROM information_schema.columns"))
+		for table, column, data_type in ADDED_COLUMNS:
+			if (table, column) not in existing:
+				print 'Adding %s.%s.' %(table, column)
+				connection.execute('ALTER TABLE %s ADD COLUMN %s %s'
+								   %(table, column, data_type))
+
+
+# Coordinates that used to be stored as strings.
+COORDINATE_COLUMNS = (('instagram_user', 'latitude'),
+					  ('instagram_user', 'longitude'),
+					  ('media', 'latitude'),
+					  ('media', 'longitude'))
+
+def migrate_coordinates_to_float(engine):
+	""" Convert string coordinate columns to double precision, empty
+		strings becoming null, and index the geohash columns. Columns
+		already converted are left alone. Run geo.py backfill afterwards to
+		geohash the media stored before."""
+
+	with engine.begin() as connection:
+		types = dict(((table, column), data_type) for table, column, data_type
+					 in connection.execute(
+						"SELECT table_name, column_name, data_type "
+						"FROM information_schema.columns "
+						"WHERE column_name IN ('latitude', 'longitude')"))
+		for table, column in COORDINATE_COLUMNS:
+			if types.get((table, column), 'double precision') != \
+			   'double precision':
+				print 'Migrating %s.%s to double precision.' %(table, column)
+				connection.execute("ALTER TABLE %s ALTER COLUMN %s TYPE "
+								   "double precision USING "
+								   "nullif(trim(%s), '')::double precision"
+								   %(table, column, column))
+		for table in ('instagram_user', 'media'):
+			connection.execute('CREATE INDEX IF NOT EXISTS ix_%s_geohash ON %s '
+							   '(geohash varchar_pattern_ops)' %(table, table))
+
+def create_search_triggers(engine):
+	""" Install the triggers that keep the text search columns in step
+		with the text they index, and fill in the rows where they are
+		still empty. Safe to run again."""
+
+	with engine.begin() as connection:
+		for table, column, source in SEARCH_COLUMNS:
+			trigger = '%s_%s_update' %(table, column)
+			connection.execute('DROP TRIGGER IF EXISTS %s ON %s'
+							   %(trigger, table))
+			connection.execute("CREATE TRIGGER %s BEFORE INSERT OR UPDATE "
+							   "ON %s FOR EACH ROW EXECUTE PROCEDURE "
+							   "tsvector_update_trigger(%s, '%s', %s)"
+							   %(trigger, table, column, SEARCH_CONFIG, source))
+			connection.execute("UPDATE %s SET %s = to_tsvector('%s', "
+							   "coalesce(%s, '')) WHERE %s IS NULL"
+							   %(table, column, SEARCH_CONFIG, source, column))
+			connection.execute('CREATE INDEX IF NOT EXISTS ix_%s_%s ON %s '
+							   'USING gin (%s)' %(table, column, table, column))
+
+def create_tables(engine):
+	""" Create the tables that don't exist yet."""
+
+	Base.metadata.create_all(engine)
+	create_search_triggers(engine)
 
 
-engine = create_engine('postgresql://localhost/metis_adsthetic')
-Base.metadata.create_all(engine)
\ No newline at end of file
+if __name__ == '__main__':
+	# python db_setup.py [database url] creates the tables, and with
+	# migrate upgrades an existing database as well.
+	args = [arg for arg in sys.argv[1:] if arg != 'migrate']
+	engine = create_engine(args[0] if args else DATABASE_URL)
+	if 'migrate' in sys.argv[1:]:
+		Base.metadata.create_all(engine)
+		migrate_ids_to_bigint(engine)
+		add_missing_columns(engine)
+		migrate_coordinates_to_float(engine)
+		create_search_triggers(engine)
+	else:
+		create_tables(engine)
@@ -0,0 +1,218 @@
+""" Columnar snapshots of the users, media and edges for analysis.
+
+Each table is streamed out of Postgres through a server side cursor and
+written in chunks to Parquet files, one file per chunk, under a directory
+per table. A manifest records the highest id exported from every table, so
+later runs append only the rows inserted since. Rows updated or deleted in
+place are only picked up by a full export.
+
+	python export.py snapshots/
+	python export.py snapshots/ --full --tables follower
+
+The snapshot loads straight into pandas, without touching the database:
+
+	import export
+	followers = export.load('snapshots/', 'follower')
+
+Requires pyarrow, which is only imported when exporting or loading. It
+isn't in requirements.txt: install it with requirements-export.txt.
+"""
+import os
+import sys
+import json
+import logging
+import argparse
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+MANIFEST = 'manifest.json'
+
+# The exported columns of each table with their Arrow types. Coordinates
+# stored as strings before migrating are exported as floats too.
+TABLES = {
+	'instagram_user': (('id', 'int32'),
+					   ('instagram_id', 'int64'),
+					   ('instagram_username', 'string'),
+					   ('bio', 'string'),
+					   ('num_followers', 'int32'),
+					   ('num_following', 'int32'),
+					   ('num_posts', 'int32'),
+					   ('latitude', 'float64'),
+					   ('longitude', 'float64'),
+					   ('geohash', 'string'),
+					   ('user_order', 'int8'),
+					   ('pull_completion', 'bool_'),
+					   ('stored_at', 'timestamp'),
+					   ('followers_refreshed_at', 'timestamp'),
+					   ('follows_refreshed_at', 'timestamp'),
+					   ('follower_sample_rate', 'float64'),
+					   ('newest_media_id', 'string'),
+					   ('media_refreshed_at', 'timestamp')),
+	'media': (('id', 'int32'),
+			  ('instagram_id', 'int64'),
+			  ('media_id', 'string'),
+			  ('num_likes', 'int32'),
+			  ('num_comments', 'int32'),
+			  ('latitude', 'float64'),
+			  ('longitude', 'float64'),
+			  ('geohash', 'string'),
+			  ('caption', 'string')),
+	'follower': (('id', 'int32'),
+				 ('instagram_id', 'int64'),
+				 ('follower_id', 'int64'))}
+
+
+def _arrow_type(pa, name):
+	if name == 'timestamp':
+		return pa.timestamp('us')
+	return getattr(pa, name)()
+
+def _float(value):
+	return float(value) if value not in (None, '') else None
+
+def read_manifest(directory):
+	""" Return the manifest of a snapshot directory, empty if there is
+		none yet."""
+
+	path = os.path.join(directory, MANIFEST)
+	if not os.path.exists(path):
+		return {'tables': {}}
+	with open(path) as f:
+		return json.load(f)
+
+def write_manifest(directory, manifest):
+	""" Replace the manifest atomically."""
+
+	manifest['updated_at'] = datetime.now().isoformat()
+	path = os.path.join(directory, MANIFEST)
+	with open(path + '.tmp', 'w') as f:
+		json.dump(manifest, f, indent=2, sort_keys=True)
+	os.rename(path + '.tmp', path)
+
+
+class SnapshotExporter(object):
+	""" Exports tables to Parquet, chunk_size rows per file. The manifest
+		is written after every file, so an interrupted export resumes
+		after the last file written."""
+
+	def __init__(self, engine, directory, chunk_size=1000000,
+				 compression='snappy'):
+		import pyarrow
+		import pyarrow.parquet
+		self._pa = pyarrow
+		self._pq = pyarrow.parquet
+		self._engine = engine
+		self._directory = directory
+		self._chunk_size = chunk_size
+		self._compression = compression
+
+	def export(self, tables=None, full=False):
+		""" Export the given tables, every table by default. Returns the
+			number of rows exported by table."""
+
+		if not os.path.isdir(self._directory):
+			os.makedirs(self._directory)
+		manifest = read_manifest(self._directory)
+		exported = {}
+		for table in tables or sorted(TABLES):
+			if full:
+				self._clear(table, manifest)
+			exported[table] = self._export_table(table, manifest)
+		return exported
+
+	def _clear(self, table, manifest):
+		""" Drop a table's files and high water mark."""
+
+		state = manifest['tables'].pop(table, None)
+		for name in (state or {}).get('files', []):
+			path = os.path.join(self._directory, table, name)
+			if os.path.exists(path):
+				os.remove(path)
+		write_manifest(self._directory, manifest)
+
+	def _export_table(self, table, manifest):
+		columns = TABLES[table]
+		state = manifest['tables'].setdefault(table, {'high_water': 0,
+													  'files': [],
+													  'rows': 0})
+		path = os.path.join(self._directory, table)
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		connection = self._engine.raw_connection()
+		exported = 0
+		try:
+			cursor = connection.cursor(name='export_%s' % table)
+			cursor.itersize = self._chunk_size
+			cursor.execute('SELECT %s FROM %s WHERE id > %%s ORDER BY id'
+						   % (', '.join(name for name, _ in columns), table),
+						   (state['high_water'],))
+			while True:
+				rows = cursor.fetchmany(self._chunk_size)
+				if not rows:
+					break
+				name = self._write(table, columns, rows)
+				state['high_water'] = rows[-1][0]
+				state['files'].append(name)
+				state['rows'] += len(rows)
+				write_manifest(self._directory, manifest)
+				exported += len(rows)
+			cursor.close()
+			connection.rollback()
+		finally:
+			connection.close()
+		log.info('Exported %d rows of %s, %d in total.', exported, table,
+				 state['rows'])
+		return exported
+
+	def _write(self, table, columns, rows):
+		""" Write one chunk of rows to its own file, named after the first
+			and last id in it, and return the file name."""
+
+		pa = self._pa
+		arrays = []
+		for (name, type_name), values in zip(columns, zip(*rows)):
+			if type_name == 'float64':
+				values = [_float(value) for value in values]
+			arrays.append(pa.array(list(values),
+								   type=_arrow_type(pa, type_name)))
+		data = pa.Table.from_arrays(arrays, [name for name, _ in columns])
+		name = 'part-%012d-%012d.parquet' % (rows[0][0], rows[-1][0])
+		path = os.path.join(self._directory, table, name)
+		self._pq.write_table(data, path + '.tmp',
+							 compression=self._compression)
+		os.rename(path + '.tmp', path)
+		return name
+
+
+def load(directory, table, columns=None):
+	""" Load an exported table into a pandas DataFrame."""
+
+	import pyarrow.parquet
+	files = [os.path.join(directory, table, name) for name
+			 in read_manifest(directory)['tables'][table]['files']]
+	if not files:
+		return None
+	return pyarrow.parquet.ParquetDataset(files)\
+						  .read(columns=columns)\
+						  .to_pandas()
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Parquet snapshot export.')
+	parser.add_argument('directory')
+	parser.add_argument('--tables', nargs='+', choices=sorted(TABLES))
+	parser.add_argument('--full', action='store_true',
+						help='replace the snapshot instead of appending')
+	parser.add_argument('--chunk-size', type=int, default=1000000)
+	args = parser.parse_args(argv)
+	logging.basicConfig(level=logging.INFO)
+
+	import models
+	exporter = SnapshotExporter(models.get_engine(), args.directory,
+								chunk_size=args.chunk_size)
+	exporter.export(args.tables, full=args.full)
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,54 @@
+from multiprocessing.pool import ThreadPool
+
+
+class FanOut(object):
+	""" Runs a pull for many instagram ids on a pool of worker threads with a
+		bounded number of pulls in flight. Work is handed out in the order
+		of the ids given, and run() only returns once every pull finished,
+		so callers can mark their own pull complete afterwards exactly as
+		they would after a serial loop. The api quota is shared through the
+		scheduler every api call goes through, which blocks workers once
+		it runs out.
+
+		The session must be a scoped_session: each worker thread gets its
+		own session, which is removed after every pull so its connection
+		goes back to the engine's pool.
+
+		Given the scheduler's ConcurrencyController as concurrency and no
+		number of workers, the pool gets a thread for every call the
+		controller could allow, and the controller's limit decides how
+		many of them call the api at once. With a number of workers too,
+		the limit is raised to it to start with."""
+
+	def __init__(self, session, workers=8, concurrency=None):
+		self._session = session
+		if concurrency is not None:
+			if workers is None:
+				workers = concurrency.maximum
+			else:
+				concurrency.grow_to(workers)
+		self._workers = workers
+
+	def run(self, pull, instagram_ids):
+		""" Call pull(instagram_id) for every id. The first exception raised
+			by a pull stops the remaining work and is re-raised."""
+
+		pool = ThreadPool(self._workers)
+		try:
+			for _ in pool.imap(self._task(pull), instagram_ids):
+				pass
+		except Exception:
+			pool.terminate()
+			raise
+		else:
+			pool.close()
+		finally:
+			pool.join()
+
+	def _task(self, pull):
+		def run_pull(instagram_id):
+			try:
+				pull(instagram_id)
+			finally:
+				self._session.remove()
+		return run_pull
@@ -0,0 +1,436 @@
+import sys
+import math
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_, text
+from instagram.bind import InstagramAPIError
+
+import models
+from db_setup import InstagramUser, Follower, CrawlTask
+from models import (BATCH_SIZE, session, chunked, bulk_writer,
+					user_stored, user_states, target_pull,
+					is_unavailable, skip_unavailable,
+					update_pull_completion, AddUserProfile,
+					AddUserMedia, AddUserFollowers, AddUserFollows)
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# The tasks that make up a pull of each order, in the order they run. These
+# mirror InfluencerDataPull, TargetDataPull and BasicDataPull.
+TASKS_BY_ORDER = {1: ('profile', 'media', 'followers', 'follows'),
+				  2: ('profile', 'media', 'follows'),
+				  3: ('profile', 'media')}
+
+OPEN_STATUSES = ('pending', 'running')
+
+# How long the followers of order 1 users, the follows of order 1 and 2
+# users and the media of every user stay fresh before they are due a
+# refresh.
+REFRESH_INTERVALS = {'followers': {1: timedelta(days=1)},
+					 'follows': {1: timedelta(days=1), 2: timedelta(days=7)},
+					 'media': {1: timedelta(days=1), 2: timedelta(days=3),
+							   3: timedelta(days=7)}}
+# Marks the next pending tasks as running for a worker and returns their
+# ids. Tasks locked by another worker's claim are skipped rather than
+# waited on, so concurrent workers never claim the same task.
+CLAIM = text("""
+	UPDATE crawl_task SET status = 'running', worker = :worker,
+						  updated_at = :now
+	WHERE id IN (SELECT id FROM crawl_task
+				 WHERE status = 'pending'
+				 ORDER BY user_order, id
+				 LIMIT :limit
+				 FOR UPDATE SKIP LOCKED)
+	RETURNING id""")
+
+# Ids returned per page of followers or follows, for estimating the calls
+# a refresh will spend.
+PAGE_SIZE = 50
+
+
+################################################################
+#################      Queue functions         #################
+################################################################
+
+def enqueue(instagram_ids,order):
+	""" Queue a pull of the given order for each instagram id. Tasks that
+		already exist are kept, along with their status and cursor, but are
+		moved up to the given order, and so are users already stored at a
+		higher order, whose pull is then no longer complete."""
+
+	tasks = TASKS_BY_ORDER[order]
+	writer = bulk_writer(CrawlTask, ['instagram_id', 'task', 'user_order',
+									 'status', 'attempts', 'updated_at'])
+	now = datetime.now()
+	with writer:
+		for chunk in chunked(instagram_ids,BATCH_SIZE):
+			for instagram_id in chunk:
+				for task in tasks:
+					writer.add(instagram_id=instagram_id, task=task,
+							   user_order=order, status='pending',
+							   attempts=0, updated_at=now)
+			writer.flush()
+			session.query(CrawlTask)\
+				   .filter(CrawlTask.instagram_id.in_(chunk),
+						   CrawlTask.task.in_(tasks),
+						   CrawlTask.user_order > order)\
+				   .update({'user_order': order},synchronize_session=False)
+			session.query(InstagramUser)\
+				   .filter(InstagramUser.instagram_id.in_(chunk),
+						   InstagramUser.user_order > order)\
+				   .update({'user_order': order, 'pull_completion': False},
+						   synchronize_session=False)
+			session.commit()
+
+def stale_users(direction,now=None):
+	""" Yield (instagram_id, user_order, estimated calls) for each user
+		whose followers, follows or media are due a refresh, the longest
+		unrefreshed first and users never refreshed before all others. A
+		media refresh stops at the newest media stored, so it is counted
+		as a single call."""
+
+	now = now or datetime.now()
+	refreshed_at = getattr(InstagramUser, direction + '_refreshed_at')
+	count = {'followers': InstagramUser.num_followers,
+			 'follows': InstagramUser.num_following,
+			 'media': InstagramUser.num_posts}[direction]
+	for order, interval in sorted(REFRESH_INTERVALS[direction].items()):
+		users = session.query(InstagramUser.instagram_id,
+							  InstagramUser.user_order, count)\
+					   .filter(InstagramUser.user_order==order,
+							   (refreshed_at==None) |
+							   (refreshed_at < now - interval))\
+					   .order_by(refreshed_at.asc().nullsfirst())
+		for instagram_id, user_order, num_items in users.all():
+			if direction == 'media':
+				calls = 1
+			else:
+				calls = max(1, int(math.ceil((num_items or 0)/
+											 float(PAGE_SIZE))))
+			yield instagram_id, user_order, calls
+
+def enqueue_refreshes(budget=None,now=None):
+	""" Queue refresh tasks for the users whose data is stale, spending
+		at most an estimated budget api calls. Lower orders go first, and
+		within an order the stalest users. A refresh that already ran is
+		queued again by resetting its task. Returns the number of
+		refreshes queued."""
+
+	now = now or datetime.now()
+	due = []
+	spent = 0
+	for direction in ('followers', 'follows', 'media'):
+		for instagram_id, order, calls in stale_users(direction,now):
+			due.append((order,direction,instagram_id,calls))
+	due.sort(key=lambda item: item[0])
+	writer = bulk_writer(CrawlTask, ['instagram_id', 'task', 'user_order',
+									 'status', 'attempts', 'updated_at'])
+	queued = []
+	with writer:
+		for order, direction, instagram_id, calls in due:
+			if budget is not None and spent + calls > budget:
+				continue
+			spent += calls
+			task = 'refresh_' + direction
+			queued.append((instagram_id,task))
+			writer.add(instagram_id=instagram_id, task=task,
+					   user_order=order, status='pending', attempts=0,
+					   updated_at=now)
+	for task in ('refresh_followers', 'refresh_follows', 'refresh_media'):
+		ids = [instagram_id for instagram_id, name in queued if name == task]
+		for chunk in chunked(ids,BATCH_SIZE):
+			session.query(CrawlTask)\
+				   .filter(CrawlTask.instagram_id.in_(chunk),
+						   CrawlTask.task==task,
+						   ~CrawlTask.status.in_(OPEN_STATUSES))\
+				   .update({'status': 'pending', 'attempts': 0,
+							'cursor': None, 'error': None,
+							'updated_at': now},synchronize_session=False)
+			session.commit()
+	log.info('Refresh: queued %d refreshes, about %d calls.',
+			 len(queued),spent)
+	return len(queued)
+
+def reset_running(worker=None,lease=None):
+	""" Put tasks left running by a crashed runner back in the queue. By
+		default every running task is reset, which is right for a single
+		runner. With several workers, pass the worker's name to reset the
+		tasks it had claimed, and/or a lease to reset the tasks of any
+		worker that hasn't touched them for that long."""
+
+	tasks = session.query(CrawlTask).filter_by(status='running')
+	conditions = []
+	if worker is not None:
+		conditions.append(CrawlTask.worker==worker)
+	if lease is not None:
+		conditions.append(CrawlTask.updated_at < datetime.now() - lease)
+	if conditions:
+		tasks = tasks.filter(or_(*conditions))
+	count = tasks.update({'status': 'pending'},synchronize_session=False)
+	session.commit()
+	return count
+
+def queue_depth():
+	""" Return the number of tasks still waiting to run."""
+
+	return session.query(CrawlTask).filter_by(status='pending').count()
+
+
+################################################################
+#################        Queue runner          #################
+################################################################
+
+class CrawlRunner():
+	""" Drains the crawl_task queue. Tasks run lowest order first, so an
+		influencer's own tasks run before the order 2 pulls of its
+		followers, which are queued once its followers are stored. Every
+		task commits its own status, so a runner that is stopped or
+		crashes picks up where it left off.
+
+		Any number of runners, each with its own worker name, can drain
+		the same queue: tasks are claimed with FOR UPDATE SKIP LOCKED, and
+		a task whose worker hasn't updated it within lease goes back in the
+		queue. The lease counts from when the task starts and is renewed
+		with every page fetched, whether or not its cursor is saved, so
+		sampled pulls and refreshes, which store nothing until their last
+		page, keep it for as long as they fetch. A runner skips the tasks
+		of its batch that were reset while they waited. A task that is run
+		twice does no harm, since every write skips rows that already
+		exist.
+
+		Workers check the database for the user of a task rather than
+		their own known user index, which misses users stored by other
+		workers. A task whose profile is still queued or running elsewhere
+		goes back to pending."""
+
+	def __init__(self,batch_size=100,max_attempts=3,worker=None,
+				 lease=timedelta(minutes=30)):
+		self._batch_size = batch_size
+		self._max_attempts = max_attempts
+		self._worker = worker
+		self._lease = lease
+
+	def run(self,max_tasks=None):
+		""" Run tasks until the queue is empty or max_tasks have run."""
+
+		if self._worker is None:
+			log.info('Runner: reset %d running tasks.', reset_running())
+		else:
+			log.info('Runner: reset %d running tasks of %s.',
+					 reset_running(worker=self._worker),self._worker)
+		ran = 0
+		while max_tasks is None or ran < max_tasks:
+			if self._worker is not None:
+				expired = reset_running(lease=self._lease)
+				if expired:
+					log.info('Runner: reset %d expired tasks.', expired)
+			if metrics.enabled:
+				metrics.gauge('queue_depth', queue_depth())
+			tasks = self._claim(self._batch_size)
+			if not tasks:
+				break
+			for task in tasks:
+				self._run_task(task)
+				ran += 1
+			self._complete_influencers()
+			metrics.export(interval=60)
+		self._complete_influencers()
+		metrics.export()
+		return ran
+
+	def _claim(self,limit):
+		""" Mark the next pending tasks as running and return them."""
+
+		claimed = session.execute(CLAIM,{'worker': self._worker,
+										 'now': datetime.now(),
+										 'limit': limit})
+		ids = [task_id for task_id, in claimed]
+		session.commit()
+		if not ids:
+			return []
+		return session.query(CrawlTask)\
+					  .filter(CrawlTask.id.in_(ids))\
+					  .order_by(CrawlTask.user_order,CrawlTask.id)\
+					  .all()
+
+	def _run_task(self,task):
+		""" Run a single task and record its outcome. Errors are logged and
+			recorded on the task, never raised."""
+
+		instagram_id, order = task.instagram_id, task.user_order
+		if not self._start(task):
+			log.debug('Runner: task %d was claimed by another worker.',
+					  task.id)
+			return
+		if is_unavailable(instagram_id):
+			self._finish(task,'failed','user unavailable')
+			return
+		try:
+			if task.task == 'profile':
+				AddUserProfile(instagram_id,order,media=False)
+			elif not user_stored(instagram_id):
+				# Another worker may still be storing the profile.
+				if self._profile_open(instagram_id):
+					self._finish(task,'pending','profile not stored yet')
+				else:
+					self._finish(task,'failed','user not in database')
+				return
+			elif task.task == 'media':
+				AddUserMedia(instagram_id)
+			elif task.task == 'followers':
+				AddUserFollowers(instagram_id,cursor=task.cursor,
+								 checkpoint=self._checkpoint(task),
+								 heartbeat=self._heartbeat(task))
+				self._enqueue_followers(instagram_id,order)
+			elif task.task == 'follows':
+				AddUserFollows(instagram_id,cursor=task.cursor,
+							   checkpoint=self._checkpoint(task),
+							   heartbeat=self._heartbeat(task))
+			elif task.task == 'refresh_followers':
+				# Refreshes start over, the unfollows are only known once
+				# every page has been fetched.
+				AddUserFollowers(instagram_id,refresh=True,
+								 heartbeat=self._heartbeat(task))
+				self._enqueue_followers(instagram_id,order)
+			elif task.task == 'refresh_follows':
+				AddUserFollows(instagram_id,refresh=True,
+							   heartbeat=self._heartbeat(task))
+			elif task.task == 'refresh_media':
+				AddUserMedia(instagram_id)
+		except Exception as error:
+			if isinstance(error,InstagramAPIError) and \
+			   skip_unavailable(instagram_id,error):
+				self._finish(task,'failed',str(error))
+				return
+			# A failing task is retried up to max_attempts times, but
+			# never stops the runner: the rest of the batch still runs.
+			session.rollback()
+			log.exception('Runner: %s task of %s failed.',task.task,
+						  instagram_id)
+			task.attempts += 1
+			status = 'failed' if task.attempts >= self._max_attempts \
+					 else 'pending'
+			self._finish(task,status,str(error))
+			return
+		self._finish(task,'done')
+		self._complete_user(instagram_id,order)
+
+	def _start(self,task):
+		""" Renew the lease of a claimed task as it starts, so it's
+			counted from the start rather than the claim. Returns False if
+			the lease expired while the task waited in the batch and the
+			task was reset, so it's no longer this runner's to run."""
+
+		started = session.query(CrawlTask)\
+						 .filter(CrawlTask.id==task.id,
+								 CrawlTask.status=='running',
+								 CrawlTask.worker==self._worker)\
+						 .update({'updated_at': datetime.now()},
+								 synchronize_session=False)
+		session.commit()
+		return bool(started)
+
+	def _profile_open(self,instagram_id):
+		""" True if the user's profile task is still waiting or running."""
+
+		return session.query(CrawlTask)\
+					  .filter(CrawlTask.instagram_id==instagram_id,
+							  CrawlTask.task=='profile',
+							  CrawlTask.status.in_(OPEN_STATUSES))\
+					  .count() > 0
+
+	def _checkpoint(self,task):
+		""" Return a function that saves the cursor of the next page to
+			fetch on the task, once the previous page has been stored. A
+			page stored just before a crash is fetched again on resume, and
+			its duplicate edges are skipped by the database."""
+
+		def save_cursor(next):
+			task.cursor = next
+			task.updated_at = datetime.now()
+			session.commit()
+		return save_cursor
+
+	def _heartbeat(self,task):
+		""" Return a function that renews the lease of a running task,
+			without touching the rest of the session's state."""
+
+		def renew():
+			session.query(CrawlTask)\
+				   .filter(CrawlTask.id==task.id,
+						   CrawlTask.worker==self._worker)\
+				   .update({'updated_at': datetime.now()},
+						   synchronize_session=False)
+			session.commit()
+		return renew
+
+	def _finish(self,task,status,error=None):
+		metrics.inc('crawl_tasks_total',task=task.task,status=status)
+		task.status = status
+		task.error = error
+		task.updated_at = datetime.now()
+		session.commit()
+
+	def _enqueue_followers(self,instagram_id,order):
+		""" Queue an order 2 pull for each follower of an order 1 user,
+			skipping followers whose order 2 pull is already complete."""
+
+		if order != 1:
+			return
+		followers = session.query(Follower.follower_id)\
+						   .filter_by(instagram_id=instagram_id)
+		followers = [follower_id for follower_id, in followers]
+		states = user_states(followers)
+		enqueue([follower_id for follower_id in followers
+				 if target_pull(states.get(follower_id)) and
+					not is_unavailable(follower_id)],2)
+
+	def _complete_user(self,instagram_id,order):
+		""" Mark a user's pull complete once all of its tasks are done. An
+			order 1 user also waits on its followers, see
+			_complete_influencers."""
+
+		if order == 1:
+			return
+		unfinished = session.query(CrawlTask)\
+							.filter(CrawlTask.instagram_id==instagram_id,
+									CrawlTask.status!='done')\
+							.count()
+		if not unfinished:
+			update_pull_completion(instagram_id,order=order,is_complete=True)
+
+	def _complete_influencers(self):
+		""" Mark order 1 users complete once their own tasks are done and
+			no order 2 pull of one of their followers is still open."""
+
+		incomplete = session.query(InstagramUser.instagram_id)\
+							.filter_by(user_order=1,pull_completion=False)
+		for instagram_id, in incomplete.all():
+			own_tasks = session.query(CrawlTask)\
+							   .filter(CrawlTask.instagram_id==instagram_id)
+			if not own_tasks.count() or \
+			   own_tasks.filter(CrawlTask.status!='done').count():
+				continue
+			open_followers = session.query(CrawlTask)\
+				.join(Follower,Follower.follower_id==CrawlTask.instagram_id)\
+				.filter(Follower.instagram_id==instagram_id,
+						CrawlTask.status.in_(OPEN_STATUSES))\
+				.count()
+			if not open_followers:
+				update_pull_completion(instagram_id,order=1,is_complete=True)
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO,
+						format='%(asctime)s %(name)s %(message)s')
+	# Queue an order 1 pull for each instagram id given, then drain the
+	# queue. Without arguments this resumes the existing queue, and with
+	# refresh [budget] it first queues refreshes of the stale users.
+	if sys.argv[1:2] == ['refresh']:
+		enqueue_refreshes(int(sys.argv[2]) if sys.argv[2:] else None)
+	elif sys.argv[1:]:
+		enqueue(sys.argv[1:],1)
+	CrawlRunner().run()
+	log.info('Cache: %(hits)d hits, %(misses)d misses.', models.cache.stats())
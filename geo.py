@@ -0,0 +1,273 @@
+""" Geohashes of media and users, home location estimates and location
+queries.
+
+Media and users are indexed by the geohash of their coordinates, a base 32
+string whose prefixes are ever smaller grid cells. A radius or bounding
+box query looks up the few cells that cover the area by prefix, through the
+index, and filters the exact coordinates of what they hold.
+
+	python geo.py backfill
+	python geo.py homes
+	python geo.py near 40.73 -73.99 2
+"""
+import sys
+import math
+import logging
+
+from sqlalchemy import text
+
+log = logging.getLogger(__name__)
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+# Length of the geohashes stored, cells of about 1 by 1 meter.
+PRECISION = 12
+EARTH_RADIUS_KM = 6371.
+# Length of the cells a user's media is grouped by to find their home,
+# about 5 by 5 kilometers.
+HOME_PRECISION = 5
+
+
+def encode(latitude, longitude, precision=PRECISION):
+	""" Return the geohash of a point, or None without coordinates."""
+
+	if latitude is None or longitude is None:
+		return None
+	lat_range, lon_range = [-90., 90.], [-180., 180.]
+	geohash = []
+	bits, bit, even = 0, 0, True
+	while len(geohash) < precision:
+		if even:
+			middle = (lon_range[0] + lon_range[1])/2
+			if longitude >= middle:
+				bits = bits*2 + 1
+				lon_range[0] = middle
+			else:
+				bits = bits*2
+				lon_range[1] = middle
+		else:
+			middle = (lat_range[0] + lat_range[1])/2
+			if latitude >= middle:
+				bits = bits*2 + 1
+				lat_range[0] = middle
+			else:
+				bits = bits*2
+				lat_range[1] = middle
+		even = not even
+		bit += 1
+		if bit == 5:
+			geohash.append(BASE32[bits])
+			bits, bit = 0, 0
+	return ''.join(geohash)
+
+def cell_size(precision):
+	""" Return the (height, width) in degrees of the cells of a geohash
+		length."""
+
+	lon_bits = int(math.ceil(5*precision/2.))
+	lat_bits = 5*precision - lon_bits
+	return 180./2**lat_bits, 360./2**lon_bits
+
+def covering_cells(south, west, north, east, max_cells=16):
+	""" Return the geohashes of the smallest cells, at most max_cells of
+		them, that together cover a bounding box. Boxes that cross the
+		antimeridian aren't supported."""
+
+	for precision in xrange(PRECISION, 0, -1):
+		height, width = cell_size(precision)
+		rows = int(math.floor((north + 90.)/height) -
+				   math.floor((south + 90.)/height)) + 1
+		columns = int(math.floor((east + 180.)/width) -
+					  math.floor((west + 180.)/width)) + 1
+		if rows*columns <= max_cells:
+			break
+	cells = set()
+	first_row = math.floor((south + 90.)/height)
+	first_column = math.floor((west + 180.)/width)
+	for row in xrange(rows):
+		latitude = min((first_row + row + .5)*height - 90., 90.)
+		for column in xrange(columns):
+			longitude = min((first_column + column + .5)*width - 180., 180.)
+			cells.add(encode(latitude, longitude, precision))
+	return sorted(cells)
+
+def bounding_box(latitude, longitude, radius_km):
+	""" Return the (south, west, north, east) box around a circle."""
+
+	lat_delta = math.degrees(radius_km/EARTH_RADIUS_KM)
+	cos_lat = math.cos(math.radians(latitude))
+	if cos_lat < 1e-6:
+		lon_delta = 180.
+	else:
+		lon_delta = min(math.degrees(radius_km/EARTH_RADIUS_KM/cos_lat), 180.)
+	return (max(latitude - lat_delta, -90.), max(longitude - lon_delta, -180.),
+			min(latitude + lat_delta, 90.), min(longitude + lon_delta, 180.))
+
+def distance_km(lat1, lon1, lat2, lon2):
+	""" Great circle distance between two points."""
+
+	phi1, phi2 = math.radians(lat1), math.radians(lat2)
+	a = math.sin((phi2 - phi1)/2)**2 + \
+		math.cos(phi1)*math.cos(phi2)*math.sin(math.radians(lon2 - lon1)/2)**2
+	return 2*EARTH_RADIUS_KM*math.asin(math.sqrt(min(a, 1.)))
+
+
+################################################################
+#################           Queries            #################
+################################################################
+
+# Great circle distance in SQL, from the point given as :latitude and
+# :longitude.
+DISTANCE_SQL = ('2*%f*asin(sqrt(least(1., '
+				'power(sin(radians(latitude - :latitude)/2), 2) + '
+				'cos(radians(:latitude))*cos(radians(latitude))*'
+				'power(sin(radians(longitude - :longitude)/2), 2))))'
+				% EARTH_RADIUS_KM)
+
+def _query(session, table, columns, box, center=None, radius_km=None,
+		   limit=100):
+	south, west, north, east = box
+	cells = covering_cells(south, west, north, east)
+	params = dict(('cell%d' % i, cell + '%') for i, cell in enumerate(cells))
+	params.update(south=south, west=west, north=north, east=east,
+				  limit=limit)
+	where = ['(%s)' % ' OR '.join('geohash LIKE :cell%d' % i
+								  for i in xrange(len(cells))),
+			 'latitude BETWEEN :south AND :north',
+			 'longitude BETWEEN :west AND :east']
+	order = 'id'
+	select = ', '.join(columns)
+	if center:
+		params.update(latitude=center[0], longitude=center[1],
+					  radius=radius_km)
+		select += ', %s AS distance_km' % DISTANCE_SQL
+		where.append('%s <= :radius' % DISTANCE_SQL)
+		order = 'distance_km'
+	rows = session.execute(text('SELECT %s FROM %s WHERE %s ORDER BY %s '
+								'LIMIT :limit'
+								% (select, table, ' AND '.join(where), order)),
+						   params)
+	return [tuple(row) for row in rows]
+
+def media_within(session, latitude, longitude, radius_km, limit=100):
+	""" Return the media posted within radius_km of a point, nearest first,
+		as (instagram_id, media_id, latitude, longitude, distance_km)
+		tuples."""
+
+	return _query(session, 'media',
+				  ('instagram_id', 'media_id', 'latitude', 'longitude'),
+				  bounding_box(latitude, longitude, radius_km),
+				  (latitude, longitude), radius_km, limit)
+
+def media_in_box(session, south, west, north, east, limit=100):
+	""" Return the media posted inside a bounding box as (instagram_id,
+		media_id, latitude, longitude) tuples."""
+
+	return _query(session, 'media',
+				  ('instagram_id', 'media_id', 'latitude', 'longitude'),
+				  (south, west, north, east), limit=limit)
+
+def users_within(session, latitude, longitude, radius_km, limit=100):
+	""" Return the users whose estimated home is within radius_km of a
+		point, nearest first, as (instagram_id, instagram_username,
+		latitude, longitude, distance_km) tuples."""
+
+	return _query(session, 'instagram_user',
+				  ('instagram_id', 'instagram_username', 'latitude',
+				   'longitude'),
+				  bounding_box(latitude, longitude, radius_km),
+				  (latitude, longitude), radius_km, limit)
+
+def users_in_box(session, south, west, north, east, limit=100):
+	""" Return the users whose estimated home is inside a bounding box as
+		(instagram_id, instagram_username, latitude, longitude) tuples."""
+
+	return _query(session, 'instagram_user',
+				  ('instagram_id', 'instagram_username', 'latitude',
+				   'longitude'),
+				  (south, west, north, east), limit=limit)
+
+
+################################################################
+#################        Batch updates         #################
+################################################################
+
+# Each user's media grouped by HOME_PRECISION cell, busiest cell first.
+HOME_CELLS = text("""
+	SELECT DISTINCT ON (instagram_id) instagram_id, avg(latitude),
+		   avg(longitude), count(*) AS posts
+	FROM media
+	WHERE geohash IS NOT NULL
+	GROUP BY instagram_id, substr(geohash, 1, :precision)
+	ORDER BY instagram_id, posts DESC""")
+
+def _update_from_values(cursor, table, key, rows):
+	""" Set latitude, longitude and geohash of many rows in one UPDATE."""
+
+	values = ', '.join(cursor.mogrify('(%s, %s, %s, %s)', row)
+					   for row in rows)
+	cursor.execute('UPDATE %s SET latitude = data.latitude, '
+				   'longitude = data.longitude, geohash = data.geohash '
+				   'FROM (VALUES %s) AS data (key, latitude, longitude, '
+				   'geohash) WHERE %s.%s = data.key'
+				   % (table, values, table, key))
+
+def estimate_homes(session, min_posts=2, batch_size=1000):
+	""" Estimate the home of every user with geotagged media as the mean
+		location of their posts in the ~5km cell they post from most,
+		provided it holds at least min_posts posts. Returns the number of
+		users located."""
+
+	rows = session.execute(HOME_CELLS, {'precision': HOME_PRECISION})
+	homes = [(instagram_id, latitude, longitude,
+			  encode(latitude, longitude))
+			 for instagram_id, latitude, longitude, posts in rows
+			 if posts >= min_posts]
+	cursor = session.connection().connection.cursor()
+	try:
+		for start in xrange(0, len(homes), batch_size):
+			_update_from_values(cursor, 'instagram_user', 'instagram_id',
+								homes[start:start + batch_size])
+		session.commit()
+	finally:
+		cursor.close()
+	log.info('Geo: estimated the home of %d users.', len(homes))
+	return len(homes)
+
+def backfill(session, batch_size=10000):
+	""" Fill in the geohash of media stored with coordinates but without
+		one, batch_size rows at a time."""
+
+	total = 0
+	while True:
+		rows = session.execute(text('SELECT id, latitude, longitude FROM media '
+									'WHERE geohash IS NULL AND latitude IS NOT '
+									'NULL AND longitude IS NOT NULL '
+									'LIMIT :limit'),
+							   {'limit': batch_size}).fetchall()
+		if not rows:
+			break
+		cursor = session.connection().connection.cursor()
+		try:
+			_update_from_values(cursor, 'media', 'id',
+								[(media_id, latitude, longitude,
+								  encode(latitude, longitude))
+								 for media_id, latitude, longitude in rows])
+			session.commit()
+		finally:
+			cursor.close()
+		total += len(rows)
+		log.info('Geo: geohashed %d media.', total)
+	return total
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	import models
+	if sys.argv[1:2] == ['backfill']:
+		backfill(models.session)
+	elif sys.argv[1:2] == ['homes']:
+		estimate_homes(models.session)
+	elif sys.argv[1:2] == ['near']:
+		latitude, longitude, radius = map(float, sys.argv[2:5])
+		for row in users_within(models.session, latitude, longitude, radius):
+			print '%d\t%s\t%.5f\t%.5f\t%.2f' % row
@@ -0,0 +1,201 @@
+import os
+import sys
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Arrays that make up a saved graph, one .npy file each.
+ARRAYS = ('ids', 'out_indptr', 'out_indices', 'in_indptr', 'in_indices')
+
+
+def _csr(rows, columns, size):
+	""" Return the indptr and indices arrays of the adjacency with an edge
+		from rows[i] to columns[i], neighbours sorted within each row."""
+
+	order = np.lexsort((columns, rows))
+	counts = np.bincount(rows, minlength=size)
+	indptr = np.zeros(size + 1, dtype=np.int64)
+	np.cumsum(counts, out=indptr[1:])
+	return indptr, columns[order]
+
+def gather(indptr, indices, rows):
+	""" Return the concatenated neighbours of all given rows of a CSR
+		adjacency, along with the position in rows each one came from."""
+
+	rows = np.asarray(rows, dtype=np.int64)
+	starts = indptr[rows]
+	lengths = indptr[rows + 1] - starts
+	total = int(lengths.sum())
+	if not total:
+		return (np.zeros(0, dtype=indices.dtype),
+				np.zeros(0, dtype=np.int64))
+	# Offset of each neighbour within its row, plus the start of that row.
+	ends = np.cumsum(lengths)
+	positions = np.arange(total) - np.repeat(ends - lengths, lengths) \
+				+ np.repeat(starts, lengths)
+	origins = np.repeat(np.arange(len(rows)), lengths)
+	return indices[positions], origins
+
+
+class FollowerGraph(object):
+	""" The follower table as a compact in-memory graph. Instagram ids are
+		interned to consecutive node numbers, in sorted order, and edges
+		are stored as CSR adjacency arrays in both directions: out from a
+		follower to the accounts it follows, in from an account to its
+		followers. A graph saved with save() is loaded memory-mapped, so
+		it opens in about the time it takes to read the index arrays."""
+
+	def __init__(self, ids, out_indptr, out_indices, in_indptr, in_indices):
+		self.ids = ids
+		self.out_indptr = out_indptr
+		self.out_indices = out_indices
+		self.in_indptr = in_indptr
+		self.in_indices = in_indices
+
+	@classmethod
+	def from_edges(cls, followers, followed):
+		""" Build a graph from parallel arrays of instagram ids, where
+			followers[i] follows followed[i]."""
+
+		followers = np.asarray(followers, dtype=np.int64)
+		followed = np.asarray(followed, dtype=np.int64)
+		ids, inverse = np.unique(np.concatenate([followers, followed]),
+								 return_inverse=True)
+		index_type = np.int32 if len(ids) < 2**31 else np.int64
+		inverse = inverse.astype(index_type)
+		sources, targets = inverse[:len(followers)], inverse[len(followers):]
+		out_indptr, out_indices = _csr(sources, targets, len(ids))
+		in_indptr, in_indices = _csr(targets, sources, len(ids))
+		return cls(ids, out_indptr, out_indices, in_indptr, in_indices)
+
+	@classmethod
+	def from_database(cls, engine, chunk_size=100000):
+		""" Build a graph from the follower table, streamed through a
+			server side cursor chunk_size rows at a time."""
+
+		connection = engine.raw_connection()
+		try:
+			cursor = connection.cursor(name='follower_graph')
+			cursor.itersize = chunk_size
+			cursor.execute('SELECT follower_id, instagram_id FROM follower')
+			chunks = []
+			while True:
+				rows = cursor.fetchmany(chunk_size)
+				if not rows:
+					break
+				chunks.append(np.array(rows, dtype=np.int64))
+			cursor.close()
+			connection.rollback()
+		finally:
+			connection.close()
+		if chunks:
+			edges = np.concatenate(chunks)
+		else:
+			edges = np.zeros((0, 2), dtype=np.int64)
+		log.info('Loaded %d edges.', len(edges))
+		return cls.from_edges(edges[:, 0], edges[:, 1])
+
+	def save(self, path):
+		""" Write the graph to a directory of .npy files."""
+
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		for name in ARRAYS:
+			np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+	@classmethod
+	def load(cls, path, mmap=True):
+		""" Open a graph written by save(), memory-mapped by default."""
+
+		mode = 'r' if mmap else None
+		return cls(*[np.load(os.path.join(path, name + '.npy'),
+							 mmap_mode=mode) for name in ARRAYS])
+
+	############ Lookups ############
+
+	def __len__(self):
+		return len(self.ids)
+
+	def num_edges(self):
+		return len(self.out_indices)
+
+	def nodes(self, instagram_ids):
+		""" Return the node numbers of the given instagram ids, -1 for ids
+			not in the graph."""
+
+		instagram_ids = np.asarray(instagram_ids, dtype=np.int64)
+		if not len(self.ids):
+			return np.full(len(instagram_ids), -1, dtype=np.int64)
+		positions = np.searchsorted(self.ids, instagram_ids)
+		positions = np.minimum(positions, len(self.ids) - 1)
+		return np.where(self.ids[positions] == instagram_ids, positions, -1)
+
+	def node(self, instagram_id):
+		""" Return the node number of an instagram id, raising KeyError if
+			it isn't in the graph."""
+
+		node = int(self.nodes([instagram_id])[0])
+		if node < 0:
+			raise KeyError(instagram_id)
+		return node
+
+	def follows(self, instagram_id):
+		""" Return the instagram ids the given user follows."""
+
+		node = self.node(instagram_id)
+		return self.ids[self.out_indices[self.out_indptr[node]:
+										 self.out_indptr[node + 1]]]
+
+	def followers(self, instagram_id):
+		""" Return the instagram ids of the given user's followers."""
+
+		node = self.node(instagram_id)
+		return self.ids[self.in_indices[self.in_indptr[node]:
+										self.in_indptr[node + 1]]]
+
+	def out_degree(self):
+		return np.diff(self.out_indptr)
+
+	def in_degree(self):
+		return np.diff(self.in_indptr)
+
+	def degree_stats(self):
+		""" Summary statistics of the follower and follows counts."""
+
+		stats = {}
+		for name, degree in (('followers', self.in_degree()),
+							 ('follows', self.out_degree())):
+			if not len(degree):
+				continue
+			stats[name] = {'mean': float(degree.mean()),
+						   'median': float(np.median(degree)),
+						   'p90': float(np.percentile(degree, 90)),
+						   'p99': float(np.percentile(degree, 99)),
+						   'max': int(degree.max()),
+						   'zero': int((degree == 0).sum())}
+		return stats
+
+	def two_hop(self, instagram_id, first='followers', second='follows'):
+		""" Return the unique instagram ids two hops away from a user, by
+			default the accounts followed by the user's followers, without
+			the user itself."""
+
+		adjacency = {'followers': (self.in_indptr, self.in_indices),
+					 'follows': (self.out_indptr, self.out_indices)}
+		node = self.node(instagram_id)
+		middle, _ = gather(adjacency[first][0], adjacency[first][1], [node])
+		reached, _ = gather(adjacency[second][0], adjacency[second][1],
+							middle)
+		reached = np.unique(reached)
+		return self.ids[reached[reached != node]]
+
+
+if __name__ == '__main__':
+	# python graph.py <directory> snapshots the follower table to disk.
+	logging.basicConfig(level=logging.INFO)
+	import models
+	graph = FollowerGraph.from_database(models.get_engine())
+	graph.save(sys.argv[1])
+	log.info('Saved %d users and %d edges.', len(graph), graph.num_edges())
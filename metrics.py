@@ -0,0 +1,232 @@
+import os
+import time
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., float('inf'))
+
+
+class _Timer(object):
+	""" Observes the seconds spent inside a with block on a histogram."""
+
+	def __init__(self, registry, name, labels):
+		self._registry = registry
+		self._name = name
+		self._labels = labels
+
+	def __enter__(self):
+		self._start = time.time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self._registry.observe(self._name, time.time() - self._start,
+							   **self._labels)
+
+
+class _NullTimer(object):
+	""" The timer handed out while metrics are disabled, which does
+		nothing."""
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		pass
+
+_NULL_TIMER = _NullTimer()
+
+
+class Histogram(object):
+	""" Counts of observations per bucket, plus their count and sum."""
+
+	def __init__(self):
+		self.buckets = [0]*len(BUCKETS)
+		self.count = 0
+		self.sum = 0.
+
+	def observe(self, value):
+		self.count += 1
+		self.sum += value
+		for i, bound in enumerate(BUCKETS):
+			if value <= bound:
+				self.buckets[i] += 1
+				break
+
+
+class Metrics(object):
+	""" A registry of counters, gauges and histograms, keyed by name and
+		labels. It starts disabled, and while disabled every method returns
+		straight away, so instrumented code pays for a single attribute
+		check. Exporters are called with the registry by export()."""
+
+	def __init__(self):
+		self.enabled = False
+		self._lock = threading.Lock()
+		self._exporters = []
+		self._last_export = 0
+		self.reset()
+
+	def enable(self, exporters=()):
+		""" Turn the registry on, exporting through the given exporters
+			in place of any set before."""
+
+		self.enabled = True
+		self._exporters = list(exporters)
+
+	def disable(self):
+		self.enabled = False
+
+	def reset(self):
+		with self._lock:
+			self.counters = {}
+			self.gauges = {}
+			self.histograms = {}
+
+	def inc(self, name, value=1, **labels):
+		""" Add value to a counter."""
+
+		if not self.enabled:
+			return
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def gauge(self, name, value, **labels):
+		""" Set a gauge to value."""
+
+		if not self.enabled:
+			return
+		with self._lock:
+			self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+	def observe(self, name, value, **labels):
+		""" Record value on a histogram."""
+
+		if not self.enabled:
+			return
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			histogram = self.histograms.get(key)
+			if histogram is None:
+				histogram = self.histograms[key] = Histogram()
+			histogram.observe(value)
+
+	def timer(self, name, **labels):
+		""" Return a context manager that observes its duration in seconds
+			on the named histogram."""
+
+		if not self.enabled:
+			return _NULL_TIMER
+		return _Timer(self, name, labels)
+
+	def export(self, interval=0):
+		""" Hand the registry to every exporter, at most once per interval
+			seconds."""
+
+		if not self.enabled or time.time() - self._last_export < interval:
+			return
+		self._last_export = time.time()
+		with self._lock:
+			for exporter in self._exporters:
+				exporter.export(self)
+
+
+class LogExporter(object):
+	""" Writes one log line per metric."""
+
+	def __init__(self, logger=log, level=logging.INFO):
+		self._logger = logger
+		self._level = level
+
+	def export(self, metrics):
+		for (name, labels), value in sorted(metrics.counters.items()):
+			self._logger.log(self._level, '%s%s %s', name,
+							 _format_labels(labels), value)
+		for (name, labels), value in sorted(metrics.gauges.items()):
+			self._logger.log(self._level, '%s%s %s', name,
+							 _format_labels(labels), value)
+		for (name, labels), histogram in sorted(metrics.histograms.items()):
+			mean = histogram.sum/histogram.count if histogram.count else 0.
+			self._logger.log(self._level, '%s%s count=%d mean=%.4f', name,
+							 _format_labels(labels), histogram.count, mean)
+
+
+class PrometheusFileExporter(object):
+	""" Writes the metrics to a file in the Prometheus text format, for the
+		node exporter's textfile collector. The file is replaced atomically
+		on every export. Labels given as a tuple of (name, value) pairs are
+		added to every metric, to tell apart the files of several
+		processes."""
+
+	def __init__(self, path, prefix='instagram_', labels=()):
+		self._path = path
+		self._prefix = prefix
+		self._labels = tuple(labels)
+
+	def export(self, metrics):
+		lines = []
+		for kind, values in (('counter', metrics.counters),
+							 ('gauge', metrics.gauges)):
+			for name in sorted(set(name for name, _ in values)):
+				lines.append('# TYPE %s%s %s' %(self._prefix, name, kind))
+				for (other, labels), value in sorted(values.items()):
+					if other == name:
+						labels = self._labels + labels
+						lines.append('%s%s%s %s' %(self._prefix, name,
+												   _format_labels(labels),
+												   value))
+		for name in sorted(set(name for name, _ in metrics.histograms)):
+			lines.append('# TYPE %s%s histogram' %(self._prefix, name))
+			for (other, labels), histogram in \
+				sorted(metrics.histograms.items()):
+				if other != name:
+					continue
+				labels = self._labels + labels
+				cumulative = 0
+				for bound, count in zip(BUCKETS, histogram.buckets):
+					cumulative += count
+					le = '+Inf' if bound == float('inf') else repr(bound)
+					lines.append('%s%s_bucket%s %d'
+								 %(self._prefix, name,
+								   _format_labels(labels + (('le', le),)),
+								   cumulative))
+				lines.append('%s%s_sum%s %s' %(self._prefix, name,
+											   _format_labels(labels),
+											   histogram.sum))
+				lines.append('%s%s_count%s %d' %(self._prefix, name,
+												 _format_labels(labels),
+												 histogram.count))
+		temporary = self._path + '.tmp'
+		with open(temporary, 'w') as f:
+			f.write('\n'.join(lines) + '\n')
+		os.rename(temporary, self._path)
+
+
+def _format_labels(labels):
+	if not labels:
+		return ''
+	return '{%s}' %','.join('%s="%s"' %(key, value) for key, value in labels)
+
+def configure_metrics(config, worker=None):
+	""" Enable the registry from .instagram_config: METRICS turns it on,
+		with a log exporter, or a Prometheus text file exporter if
+		METRICS_FILE is set. A worker process writes its own file, named
+		after the worker and with a worker label on every metric."""
+
+	if not config.get('METRICS'):
+		return
+	if config.get('METRICS_FILE'):
+		path, labels = config['METRICS_FILE'], ()
+		if worker is not None:
+			root, ext = os.path.splitext(path)
+			path = '%s-%s%s' %(root, worker, ext)
+			labels = (('worker', worker),)
+		metrics.enable([PrometheusFileExporter(path, labels=labels)])
+	else:
+		metrics.enable([LogExporter()])
+
+# The registry every module records to.
+metrics = Metrics()
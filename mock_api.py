@@ -0,0 +1,195 @@
+import time
+import random
+import bisect
+import threading
+import urlparse
+
+from instagram.bind import InstagramAPIError
+
+
+class MockObject(object):
+	""" A stand-in for the python-instagram model objects, with the
+		attributes given as keywords."""
+
+	def __init__(self, **attributes):
+		self.__dict__.update(attributes)
+
+
+class MockInstagramAPI(object):
+	""" An offline stand-in for the parts of InstagramAPI used in models.py,
+		backed by a synthetic follower graph.
+
+		User popularity follows a power law: every user follows a
+		Pareto-distributed number of accounts, each picked with probability
+		proportional to rank**-alpha, so a few accounts gather most of the
+		followers, as on instagram. A share of users is private and raises
+		InstagramAPIError like the real api. Every call sleeps for latency
+		seconds, counts against an hourly limit reported through
+		x_ratelimit_remaining and is counted per endpoint in calls."""
+
+	def __init__(self, num_users=10000, alpha=1.1, mean_follows=150,
+				 max_follows=2000, media_per_user=30, private_share=.1,
+				 page_size=50, media_page_size=20, latency=0., limit=5000,
+				 seed=0):
+		self._page_size = page_size
+		self._media_page_size = media_page_size
+		self._latency = latency
+		self._limit = limit
+		self._lock = threading.Lock()
+		self._window_start = time.time()
+		self._used = 0
+		self.x_ratelimit = str(limit)
+		self.x_ratelimit_remaining = str(limit)
+		self.calls = {}
+
+		rand = random.Random(seed)
+		self._ids = [str(1000000 + i) for i in xrange(num_users)]
+		self._follows = dict((user_id, []) for user_id in self._ids)
+		self._followers = dict((user_id, []) for user_id in self._ids)
+		self._build_graph(rand, alpha, mean_follows, max_follows)
+		self._private = set(user_id for user_id in self._ids
+							if rand.random() < private_share)
+		self._media_counts = dict((user_id,
+								   int(rand.expovariate(1./media_per_user)))
+								  for user_id in self._ids)
+
+	def _build_graph(self, rand, alpha, mean_follows, max_follows):
+		weights = [(rank + 1)**-alpha for rank in xrange(len(self._ids))]
+		cumulative = []
+		total = 0.
+		for weight in weights:
+			total += weight
+			cumulative.append(total)
+		for user_id in self._ids:
+			# Shape 2 Pareto draws average twice their scale of 1.
+			num_follows = min(max_follows,
+							  int(rand.paretovariate(2)*mean_follows/2.))
+			follows = set()
+			for _ in xrange(num_follows):
+				index = bisect.bisect(cumulative, rand.random()*total)
+				followed = self._ids[min(index, len(self._ids) - 1)]
+				if followed != user_id:
+					follows.add(followed)
+			for followed in follows:
+				self._follows[user_id].append(followed)
+				self._followers[followed].append(user_id)
+
+	def most_followed(self, count=1):
+		""" Return the ids of the users with the most followers."""
+
+		return sorted(self._ids, key=lambda user_id:
+					  -len(self._followers[user_id]))[:count]
+
+	def total_calls(self):
+		return sum(self.calls.values())
+
+	############ Api methods ############
+
+	def user(self, user_id):
+		user_id = str(user_id)
+		self._call('user', user_id)
+		return MockObject(id=user_id,
+						  username='user_%s' %user_id,
+						  full_name='User %s' %user_id,
+						  bio='Bio of user %s #mock' %user_id,
+						  counts={'followed_by': len(self._followers[user_id]),
+								  'follows': len(self._follows[user_id]),
+								  'media': self._media_counts[user_id]})
+
+	def user_search(self, q, count=None):
+		self._call('user_search')
+		user_id = q[len('user_'):] if q.startswith('user_') else None
+		if user_id not in self._follows:
+			return []
+		return [MockObject(id=user_id, username=q)]
+
+	def user_followed_by(self, user_id=None, with_next_url=None):
+		return self._page('user_followed_by', self._followers, user_id,
+						  with_next_url, self._page_size, self._user_object)
+
+	def user_follows(self, user_id=None, with_next_url=None):
+		return self._page('user_follows', self._follows, user_id,
+						  with_next_url, self._page_size, self._user_object)
+
+	def user_recent_media(self, user_id=None, count=None, max_id=None,
+						  min_id=None, with_next_url=None):
+		if with_next_url:
+			user_id, _ = self._parse_next(with_next_url)
+		user_id = str(user_id)
+		# Newest first, like the api, so media ids count down.
+		media_ids = ['%d_%s' %(number, user_id) for number
+					 in xrange(self._media_counts[user_id], 0, -1)]
+		if min_id:
+			media_ids = [media_id for media_id in media_ids
+						 if self._media_number(media_id) >
+							self._media_number(min_id)]
+		if max_id:
+			media_ids = [media_id for media_id in media_ids
+						 if self._media_number(media_id) <
+							self._media_number(max_id)]
+		lists = {user_id: media_ids}
+		return self._page('user_recent_media', lists, user_id, with_next_url,
+						  count or self._media_page_size, self._media_object)
+
+	############ Helpers ############
+
+	def _call(self, endpoint, user_id=None):
+		""" Count a call against the limit, simulate latency and refuse
+			private users."""
+
+		if self._latency:
+			time.sleep(self._latency)
+		with self._lock:
+			if time.time() - self._window_start > 3600:
+				self._window_start, self._used = time.time(), 0
+			self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+			if self._used >= self._limit:
+				raise InstagramAPIError('429', 'Rate limited',
+										'Your client is making too many '
+										'request per second')
+			self._used += 1
+			self.x_ratelimit_remaining = str(self._limit - self._used)
+		if user_id is not None and user_id not in self._follows:
+			raise InstagramAPIError(400, 'APINotFoundError',
+									'this user does not exist')
+		if user_id in self._private:
+			raise InstagramAPIError(400, 'APINotAllowedError',
+									'you cannot view this resource')
+
+	def _page(self, endpoint, lists, user_id, with_next_url, size, build):
+		offset = 0
+		if with_next_url:
+			user_id, offset = self._parse_next(with_next_url)
+		user_id = str(user_id)
+		self._call(endpoint, user_id)
+		items = lists[user_id][offset:offset + size]
+		next = None
+		if offset + size < len(lists[user_id]):
+			next = 'mock://%s/%s?offset=%d' %(endpoint, user_id, offset + size)
+		return [build(item) for item in items], next
+
+	def _parse_next(self, next_url):
+		parsed = urlparse.urlparse(next_url)
+		user_id = parsed.path.strip('/')
+		offset = int(urlparse.parse_qs(parsed.query)['offset'][0])
+		return user_id, offset
+
+	def _media_number(self, media_id):
+		return int(str(media_id).split('_')[0])
+
+	def _user_object(self, user_id):
+		return MockObject(id=user_id, username='user_%s' %user_id)
+
+	def _media_object(self, media_id):
+		number = self._media_number(media_id)
+		location = None
+		if number % 3 == 0:
+			point = MockObject(latitude=40.7 + number % 7 / 100.,
+							   longitude=-74. + number % 11 / 100.)
+			location = MockObject(point=point)
+		return MockObject(id=media_id,
+						  like_count=number*7 % 500,
+						  comment_count=number*3 % 40,
+						  caption=MockObject(text='Post %s #mock @user_%s'
+												  %(media_id, 1000000)),
+						  location=location)
@@ -1,30 +1,287 @@
 import cnfg
+import random
+import logging
+import threading
 from datetime import datetime
+from collections import namedtuple
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.sql import exists
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.exc import IntegrityError
 from instagram.client import InstagramAPI
 from instagram.bind import InstagramAPIError
 
-from db_setup import Base, InstagramUser, Media, Follower
-
-# Configuring the database connection.
-engine = create_engine('postgresql://localhost/metis_adsthetic')
-Base.metadata.bind = engine
-DBSession = sessionmaker(bind = engine)
-session = DBSession()
-
-# Configuring the instagram api client.
-config = cnfg.load(".instagram_config")
-api = InstagramAPI(client_id=config['CLIENT_ID'], 
-				   client_secret=config['CLIENT_SECRET'])
+from db_setup import (Base, InstagramUser, Media, Follower, CrawlTask,
+					  UnavailableUser, DATABASE_URL)
+from bulk_writer import BulkWriter
+from fan_out import FanOut
+from rate_limit import (RequestScheduler, ScheduledAPI,
+						ConcurrencyController, classify_error, PRIVATE,
+						NOT_FOUND)
+from api_cache import ResponseCache, CachedAPI
+from user_index import KnownUserIndex
+from response_log import ResponseLog, SEGMENT_BYTES
+from captions import EntityWriter
+import geo
+from metrics import metrics, configure_metrics
+
+log = logging.getLogger(__name__)
+
+# Number of rows buffered before a bulk write is flushed to the database.
+BATCH_SIZE = 1000
+
+# The followers stored per user and how they are chosen, unless
+# MAX_FOLLOWERS and FOLLOWER_SAMPLING are set in the config: 'cap' stops
+# paginating at the cap, 'reservoir' pages through every follower and keeps
+# a uniform sample. See AddUserFollowers.
+MAX_FOLLOWERS = 10000
+FOLLOWER_SAMPLING = 'cap'
+
+# The state of a stored user, as returned by user_exists.
+UserState = namedtuple('UserState', ['user_order', 'pull_completion',
+									 'num_followers', 'num_following'])
+
+# The configuration, engine and api client are built on first use rather
+# than on import, see get_config, get_engine and get_api. configure()
+# replaces them.
+_lock = threading.RLock()
+_config = None
+_engine = None
+_scheduler = None
+_cache = None
+_api = None
+_known_users = None
+_response_log = None
+_unavailable_users = None
+
+
+class _Lazy(object):
+	""" Stands in for the object returned by factory, which is only
+		called once an attribute is looked up, so modules can use api,
+		config and the like as globals without building them on import.
+		The object is kept from then on, so later lookups take no lock,
+		until _clear is called after configure replaces it."""
+
+	def __init__(self, factory):
+		self.__dict__['_factory'] = factory
+		self.__dict__['_target'] = None
+
+	def __getattr__(self, name):
+		return getattr(self._resolve(), name)
+
+	def __getitem__(self, key):
+		return self._resolve()[key]
+
+	def _resolve(self):
+		target = self._target
+		if target is None:
+			# The factories hand every thread the same object, so racing
+			# here is harmless.
+			target = self.__dict__['_target'] = self._factory()
+		return target
+
+	def _clear(self):
+		self.__dict__['_target'] = None
+
+
+def get_config():
+	""" Return .instagram_config, loading it and enabling metrics on first
+		use. Without the file the config is empty, so offline tools, such
+		as the benchmark on the mock api, run on a machine without
+		credentials; whatever needs them fails once it looks them up."""
+
+	global _config
+	if _config is None:
+		with _lock:
+			if _config is None:
+				try:
+					config = cnfg.load(".instagram_config")
+				except IOError:
+					log.info('No .instagram_config, using the defaults.')
+					config = {}
+				configure_metrics(config)
+				_config = config
+	return _config
+
+def get_engine():
+	""" Return the engine, connecting to DATABASE_URL from the config on
+		first use. Every thread gets a connection of its own from the
+		pool, sized by DB_POOL_SIZE and DB_MAX_OVERFLOW, so FanOut workers
+		need DB_POOL_SIZE + DB_MAX_OVERFLOW of at least their number."""
+
+	global _engine
+	if _engine is None:
+		with _lock:
+			if _engine is None:
+				_engine = _create_engine(get_config().get('DATABASE_URL',
+														  DATABASE_URL))
+	return _engine
+
+def _create_engine(database_url):
+	config = get_config()
+	engine = create_engine(database_url,
+						   pool_size=config.get('DB_POOL_SIZE', 10),
+						   max_overflow=config.get('DB_MAX_OVERFLOW', 10),
+						   pool_timeout=config.get('DB_POOL_TIMEOUT', 30),
+						   pool_recycle=config.get('DB_POOL_RECYCLE', 3600))
+	Base.metadata.bind = engine
+	return engine
+
+def get_scheduler():
+	""" Return the scheduler holding the hourly api quota."""
+
+	global _scheduler
+	if _scheduler is None:
+		with _lock:
+			if _scheduler is None:
+				config = get_config()
+				_scheduler = RequestScheduler(
+								limit=config.get('RATE_LIMIT', 5000),
+								reserve=config.get('RATE_LIMIT_RESERVE', 0),
+								concurrency=_concurrency_controller())
+	return _scheduler
+
+def _concurrency_controller():
+	""" Return a controller of the api calls in flight, starting at
+		API_CONCURRENCY calls and growing up to API_MAX_CONCURRENCY while
+		calls take less than API_TARGET_LATENCY seconds."""
+
+	config = get_config()
+	return ConcurrencyController(initial=config.get('API_CONCURRENCY', 4),
+						maximum=config.get('API_MAX_CONCURRENCY', 32),
+						target_latency=config.get('API_TARGET_LATENCY', 2.))
+
+def get_cache():
+	""" Return the on-disk response cache."""
+
+	global _cache
+	if _cache is None:
+		with _lock:
+			if _cache is None:
+				config = get_config()
+				_cache = ResponseCache(
+							config.get('CACHE_PATH', '.instagram_cache'),
+							ttls=config.get('CACHE_TTLS'),
+							max_entries=config.get('CACHE_MAX_ENTRIES', 100000))
+	return _cache
+
+def get_api():
+	""" Return the instagram api client. Users, media and searches are
+		answered from the response cache when fresh, every other call goes
+		through the scheduler."""
+
+	global _api
+	if _api is None:
+		with _lock:
+			if _api is None:
+				config = get_config()
+				client = InstagramAPI(client_id=config['CLIENT_ID'],
+									  client_secret=config['CLIENT_SECRET'])
+				_api = CachedAPI(ScheduledAPI(client,get_scheduler()),
+								 get_cache())
+	return _api
+
+def get_known_users():
+	""" Return the index of instagram ids already stored, so unknown users
+		cost no query. Set BLOOM_CAPACITY to keep a Bloom filter instead of
+		a set of every id."""
+
+	global _known_users
+	if _known_users is None:
+		with _lock:
+			if _known_users is None:
+				_known_users = KnownUserIndex(
+							bloom_capacity=get_config().get('BLOOM_CAPACITY'))
+	return _known_users
+
+def get_unavailable_users():
+	""" Return the set of instagram ids in the unavailable_user table,
+		loaded on first use."""
+
+	global _unavailable_users
+	if _unavailable_users is None:
+		with _lock:
+			if _unavailable_users is None:
+				rows = session.query(UnavailableUser.instagram_id)
+				_unavailable_users = set(instagram_id for instagram_id, in rows)
+	return _unavailable_users
+
+def get_response_log():
+	""" Return the log every fetched page is appended to, kept in the
+		RESPONSE_LOG directory, or None if the config doesn't set one."""
+
+	global _response_log
+	if _response_log is None and get_config().get('RESPONSE_LOG'):
+		with _lock:
+			if _response_log is None:
+				_response_log = ResponseLog(get_config()['RESPONSE_LOG'],
+								segment_bytes=get_config().get(
+								'RESPONSE_LOG_SEGMENT_BYTES', SEGMENT_BYTES))
+	return _response_log
+
+config = _Lazy(get_config)
+scheduler = _Lazy(get_scheduler)
+cache = _Lazy(get_cache)
+api = _Lazy(get_api)
+known_users = _Lazy(get_known_users)
+
+# Thread-local sessions, so concurrent pulls never share a session, each
+# bound to the engine current when it is created.
+DBSession = sessionmaker()
+session = scoped_session(lambda: DBSession(bind=get_engine()))
 
 ################################################################
 #################      Helper functions        #################
 ################################################################
 
+def configure(database_url=None,client=None,cache_path=None,
+			  response_log=None):
+	""" Point the module at another database and/or api client, such as
+		a local database and MockInstagramAPI for benchmarks. A new client
+		gets its own scheduler and a response cache at cache_path, kept in
+		memory if no path is given. A ResponseLog given replaces the one
+		in RESPONSE_LOG."""
+
+	global _engine, _scheduler, _cache, _api, _response_log
+	global _unavailable_users
+	with _lock:
+		if response_log:
+			_response_log = response_log
+		if database_url:
+			session.remove()
+			if _engine is not None:
+				_engine.dispose()
+			_engine = _create_engine(database_url)
+			known_users.reset()
+			_unavailable_users = None
+		if client:
+			limit = getattr(client, 'x_ratelimit', None) or \
+					config.get('RATE_LIMIT', 5000)
+			_scheduler = RequestScheduler(limit=int(limit),
+								reserve=config.get('RATE_LIMIT_RESERVE', 0),
+								concurrency=_concurrency_controller())
+			_cache = ResponseCache(cache_path or ':memory:')
+			_api = CachedAPI(ScheduledAPI(client,_scheduler),_cache)
+			for lazy in (scheduler, cache, api):
+				lazy._clear()
+
+def client_credentials():
+	""" Return the api credentials in .instagram_config as a list of
+		(client_id, client_secret) tuples: one per entry of CLIENTS, a list
+		of objects with a CLIENT_ID and CLIENT_SECRET each, or else just
+		the CLIENT_ID and CLIENT_SECRET pair."""
+
+	clients = config.get('CLIENTS') or [config]
+	return [(client['CLIENT_ID'], client['CLIENT_SECRET'])
+			for client in clients]
+
+def follower_sampling():
+	""" Return the cap on the followers stored per user, None for no
+		cap, and the sampling mode used beyond it."""
+
+	return (config.get('MAX_FOLLOWERS', MAX_FOLLOWERS),
+			config.get('FOLLOWER_SAMPLING', FOLLOWER_SAMPLING))
+
 def get_user_id(username):
 	""" Given a instagram username, return the instagram_id."""
 
@@ -33,11 +290,9 @@ def get_user_id(username):
 	return str(user_ids[username])
 
 def rate_limit_check():
-	""" Ping the instagram api and return the rate limit."""
+	""" Return the remaining api calls, without spending one to find out."""
 
-	user_search = api.user_search(q='instagram')
-	remaining_calls = int(api.x_ratelimit_remaining)
-	return remaining_calls
+	return scheduler.remaining()
 
 def commit_to_db(new_object):
 	""" Commit new object to the database."""
@@ -45,46 +300,390 @@ def commit_to_db(new_object):
 	try:
 		session.add(new_object)
 		session.commit()
-		print "Succesfully added object!"
+		metrics.inc('db_rows_written_total',table=new_object.__tablename__)
 	except IntegrityError:
-		print "IntegrityError"
+		log.debug('IntegrityError adding to %s.',new_object.__tablename__)
+		metrics.inc('db_integrity_errors_total',table=new_object.__tablename__)
 		session.rollback()
 		# session.close()
 
+def bulk_writer(model, columns, batch_size=None, conflict_columns=None,
+				update_columns=None, update_expressions=None):
+	""" Return a BulkWriter for the given model's table that writes through
+		the module session."""
+
+	return BulkWriter(model.__table__, columns, session,
+					  batch_size=batch_size or BATCH_SIZE,
+					  conflict_columns=conflict_columns,
+					  update_columns=update_columns,
+					  update_expressions=update_expressions)
+
+def chunked(iterable,size):
+	""" Yield lists of at most size items from an iterable."""
+
+	chunk = []
+	for item in iterable:
+		chunk.append(item)
+		if len(chunk) >= size:
+			yield chunk
+			chunk = []
+	if chunk:
+		yield chunk
+
+def warm_known_users():
+	""" Load every stored instagram id into the known user index."""
+
+	ids = session.query(InstagramUser.instagram_id).yield_per(BATCH_SIZE)
+	known_users.warm(instagram_id for instagram_id, in ids)
+
 def user_exists(instagram_id):
 	""" This function checks to see if a user exists in the instagram user
-		table. If they do, it returns their user object. Otherwise it returns
-		None. """
+		table. If they do, it returns their UserState, with their order,
+		pull completion and profile counts. Otherwise it returns None. Users
+		missing from the known user index are answered without a query."""
 
+	if not known_users.is_warm():
+		warm_known_users()
+	if not known_users.might_exist(instagram_id):
+		return None
 	# Query database to see if instagram_id exists in instagram_user table.
-	user_exists = session.query(exists()\
-					 .where(InstagramUser.instagram_id==instagram_id))\
-					 .scalar()
-	if user_exists:
-		user = session.query(InstagramUser)\
+	state = session.query(InstagramUser.user_order,
+						  InstagramUser.pull_completion,
+						  InstagramUser.num_followers,
+						  InstagramUser.num_following)\
 				   .filter_by(instagram_id=instagram_id)\
-				   .one()
-		return user
+				   .first()
+	if state:
+		return UserState(*state)
+	else:
+		return None
+
+def user_stored(instagram_id):
+	""" Check the database itself for a user, whatever the known user
+		index says, and add them to the index if they are stored. The
+		index of one process never sees users stored by another."""
+
+	stored = session.query(InstagramUser.id)\
+					.filter_by(instagram_id=instagram_id)\
+					.first() is not None
+	if stored:
+		known_users.add(instagram_id)
+	return stored
+
+def user_states(instagram_ids):
+	""" Return a dict of UserState by instagram_id for the stored users
+		among the given ids, looked up BATCH_SIZE ids per query."""
+
+	if not known_users.is_warm():
+		warm_known_users()
+	candidates = [instagram_id for instagram_id in instagram_ids
+				  if known_users.might_exist(instagram_id)]
+	states = {}
+	for chunk in chunked(candidates,BATCH_SIZE):
+		rows = session.query(InstagramUser.instagram_id,
+							 InstagramUser.user_order,
+							 InstagramUser.pull_completion,
+							 InstagramUser.num_followers,
+							 InstagramUser.num_following)\
+					  .filter(InstagramUser.instagram_id.in_(chunk))
+		for row in rows:
+			states[row[0]] = UserState(*row[1:])
+	return states
+
+def is_unavailable(instagram_id):
+	""" True if the api refused to return the user before, see
+		skip_unavailable."""
+
+	return int(instagram_id) in get_unavailable_users()
+
+def skip_unavailable(instagram_id,error):
+	""" Given an error raised while pulling a user, record private and
+		deleted users in the unavailable_user table, so they are never
+		requested again, and return True. Any other error is the caller's
+		to raise."""
+
+	kind = classify_error(error)
+	if kind not in (PRIVATE,NOT_FOUND):
+		return False
+	log.info('Unavailable: user %s is %s.',instagram_id,kind)
+	session.rollback()
+	session.execute(text('INSERT INTO unavailable_user '
+						 '(instagram_id, reason, recorded_at) '
+						 'VALUES (:instagram_id, :reason, :recorded_at) '
+						 'ON CONFLICT (instagram_id) DO NOTHING'),
+					{'instagram_id': int(instagram_id),'reason': kind,
+					 'recorded_at': datetime.now()})
+	session.commit()
+	get_unavailable_users().add(int(instagram_id))
+	metrics.inc('unavailable_users_total',reason=kind)
+	return True
+
+def target_pull(user):
+	""" Return the pull TargetDataPull has to preform for a user with the
+		given UserState, 'full_2' or 'partial_3_2', or None if their pull
+		is already complete."""
+
+	if not user:
+		return 'full_2'
+	elif user.user_order == 3:
+		return 'partial_3_2'
+	elif not user.pull_completion:
+		return 'full_2'
 	else:
 		return None
 
+def plan_target_pulls(instagram_ids):
+	""" Look up the state of all given users at once and return a list of
+		(instagram_id, pull) for the ones whose order 2 pull isn't complete,
+		in the order given. Order 3 users are moved up to order 2 here, in
+		bulk, ready for their partial pull."""
+
+	states = user_states(instagram_ids)
+	plan = []
+	for instagram_id in instagram_ids:
+		pull = target_pull(states.get(instagram_id))
+		if pull and not is_unavailable(instagram_id):
+			plan.append((instagram_id,pull))
+	promoted = [instagram_id for instagram_id, pull in plan
+				if pull == 'partial_3_2']
+	for chunk in chunked(promoted,BATCH_SIZE):
+		session.query(InstagramUser)\
+			   .filter(InstagramUser.instagram_id.in_(chunk))\
+			   .update({'user_order': 2, 'pull_completion': False},
+					   synchronize_session=False)
+		session.commit()
+	log.info('Target Pull: %d complete, %d full 2 and %d partial 3-2 pulls.',
+			 len(instagram_ids)-len(plan),len(plan)-len(promoted),
+			 len(promoted))
+	return plan
+
 def update_pull_completion(instagram_id,order,is_complete=False):
 	""" Update a user's pull completion to True."""
-	user = session.query(InstagramUser)\
-				   .filter_by(instagram_id=instagram_id)\
-				   .one()
-	# Check if the order of the current pull is strictly less than the
-	# user order stored already in the database. i.e., jstnstwrt is in
+
+	# Only update if the order of the current pull is less than or equal to
+	# the user order stored already in the database. i.e., jstnstwrt is in
 	# the following of followers of jstnstwrt, so you will try to pull
 	# the user at order 3 when pulling at the user at order 1
-	if order <= user.user_order:
-		user.pull_completion = is_complete
-		print 'Updated to pull complete to %s.' %is_complete
-		commit_to_db(user)
+	updated = session.query(InstagramUser)\
+					 .filter(InstagramUser.instagram_id==instagram_id,
+							 InstagramUser.user_order>=order)\
+					 .update({'pull_completion': is_complete},
+							 synchronize_session=False)
+	session.commit()
+	if updated:
+		log.debug('Updated to pull complete to %s.',is_complete)
+	else:
+		log.debug('Pull is not complete!')
+
+def update_user_order(instagram_id,order):
+	""" Update a user's order."""
+
+	session.query(InstagramUser)\
+		   .filter_by(instagram_id=instagram_id)\
+		   .update({'user_order': order},synchronize_session=False)
+	session.commit()
+
+def stored_edges(instagram_id,direction):
+	""" Return the set of stored follower ids of a user, for direction
+		'followers', or the ids of the accounts they follow, for 'follows'."""
+
+	if direction == 'followers':
+		edges = session.query(Follower.follower_id)\
+					   .filter_by(instagram_id=instagram_id)
 	else:
-		print 'Pull is not complete!'
-		pass
+		edges = session.query(Follower.instagram_id)\
+					   .filter_by(follower_id=instagram_id)
+	return set(other_id for other_id, in edges.yield_per(BATCH_SIZE))
 
+def remove_edges(instagram_id,other_ids,direction):
+	""" Delete the given followers, or follows, of a user, BATCH_SIZE
+		edges per statement. Returns the number of edges deleted."""
+
+	if direction == 'followers':
+		column = Follower.follower_id
+		edges = session.query(Follower).filter_by(instagram_id=instagram_id)
+	else:
+		column = Follower.instagram_id
+		edges = session.query(Follower).filter_by(follower_id=instagram_id)
+	deleted = 0
+	for chunk in chunked(other_ids,BATCH_SIZE):
+		deleted += edges.filter(column.in_(chunk))\
+						.delete(synchronize_session=False)
+		session.commit()
+	metrics.inc('db_rows_deleted_total',deleted,table='follower')
+	return deleted
+
+def mark_refreshed(instagram_id,direction):
+	""" Record that a user's full follower, or follows, list was just
+		fetched."""
+
+	session.query(InstagramUser)\
+		   .filter_by(instagram_id=instagram_id)\
+		   .update({direction + '_refreshed_at': datetime.now()},
+				   synchronize_session=False)
+	session.commit()
+
+
+
+################################################################
+############  Functions that fetch Instagram data  #############
+################################################################
+
+def log_page(kind,instagram_id,data,**fields):
+	""" Append a fetched page to the response log, if there is one, as a
+		record of its kind, the user it was fetched for, when, and the
+		page itself as data."""
+
+	response_log = get_response_log()
+	if response_log is not None:
+		response_log.append(dict(fields,kind=kind,
+								 instagram_id=int(instagram_id),
+								 fetched_at=datetime.now().isoformat(),
+								 data=data))
+
+def fetch_profile(instagram_id,user_order=None):
+	""" Return a dict of the profile data stored for a user."""
+
+	instagram_user = api.user(user_id=instagram_id)
+	# Extract data and store in dict
+	instagram_user_profile = {'instagram_id' : instagram_id}
+	instagram_user_profile['instagram_username'] = instagram_user.username
+	instagram_user_profile['bio'] = instagram_user.bio
+	instagram_user_profile['num_followers']= instagram_user.counts['followed_by']
+	instagram_user_profile['num_following'] = instagram_user.counts['follows']
+	instagram_user_profile['num_posts'] = instagram_user.counts['media']
+	log_page('profile',instagram_id,instagram_user_profile,
+			 user_order=user_order)
+	return instagram_user_profile
+
+def fetch_media(instagram_id,stored_newest=None,max_pages=None):
+	""" Yield a user's recent media a page at a time, newest first, as
+		lists of dictionaries. Stops after max_pages pages, or after the
+		page that reaches the stored_newest media id."""
+
+	max_pages = max_pages or config.get('MEDIA_MAX_PAGES', 5)
+	media_list, next = api.user_recent_media(user_id=instagram_id)
+	pages = 1
+	while True:
+		user_media_list = [_media_record(media) for media in media_list]
+		log_page('media',instagram_id,user_media_list,first=pages == 1)
+		yield user_media_list
+		reached = stored_newest and \
+				  any(not is_newer_media(media['media_id'],stored_newest)
+					  for media in user_media_list)
+		if not next or reached or pages >= max_pages:
+			break
+		media_list, next = api.user_recent_media(with_next_url=next)
+		pages += 1
+
+def fetch_followers(instagram_id,cursor=None):
+	""" Yield a user's followers a page at a time, as tuples of a list of
+		follower ids and the cursor of the next page, which is None for
+		the last page. Pagination starts at cursor if one is given."""
+
+	if cursor:
+		followers, next = api.user_followed_by(with_next_url=cursor)
+	else:
+		followers, next = api.user_followed_by(user_id=instagram_id)
+	# Handling the pagination of the returned object. 
+	while True:
+		follower_ids = [follower.id for follower in followers]
+		log_page('followers',instagram_id,follower_ids,cursor=cursor,
+				 next=next)
+		yield follower_ids, next
+		if not next:
+			break
+		cursor = next
+		followers, next = api.user_followed_by(with_next_url=next)
+
+def fetch_follows(instagram_id,cursor=None):
+	""" Yield the accounts a user follows a page at a time, as tuples of a
+		list of ids and the cursor of the next page. Pagination starts at
+		cursor if one is given."""
+
+	if cursor:
+		follows, next = api.user_follows(with_next_url=cursor)
+	else:
+		follows, next = api.user_follows(user_id=instagram_id)
+	while True:
+		follow_ids = [user.id for user in follows]
+		log_page('follows',instagram_id,follow_ids,cursor=cursor,next=next)
+		yield follow_ids, next
+		if not next:
+			break
+		cursor = next
+		follows, next = api.user_follows(with_next_url=next)
+
+def with_heartbeat(pages,heartbeat=None):
+	""" Yield the pages of a fetch, calling heartbeat as each one comes in,
+		so a long pull can show it's still alive between checkpoints."""
+
+	for page in pages:
+		if heartbeat:
+			heartbeat()
+		yield page
+
+def store_media(user_media):
+	""" Store media, given as (instagram_id, media dict) pairs in the form
+		fetch_media yields them, updating the like and comment counts of
+		media already stored, along with the hashtags and mentions of the
+		captions. Returns the number of media stored or updated."""
+
+	user_media = list(user_media)
+	writer = bulk_writer(Media, ['instagram_id', 'media_id', 'num_likes',
+								 'num_comments', 'caption', 'latitude',
+								 'longitude', 'geohash'],
+						 conflict_columns=['media_id'],
+						 update_columns=['num_likes', 'num_comments'])
+	with writer:
+		writer.add_all(dict(media, instagram_id=instagram_id)
+					   for instagram_id, media in user_media)
+	with EntityWriter(session,batch_size=BATCH_SIZE) as entities:
+		for instagram_id, media in user_media:
+			entities.add(instagram_id,media['media_id'],media['caption'])
+	return writer.rows_written
+
+def is_newer_media(media_id,other_id):
+	""" Media ids start with a number that grows with every post, ids
+		that don't are compared as strings."""
+
+	try:
+		return int(media_id.split('_')[0]) > int(other_id.split('_')[0])
+	except ValueError:
+		return media_id != other_id
+
+def _media_record(media):
+	user_media = {'media_id' : media.id,
+				  'num_likes' : media.like_count,
+				  'num_comments' : media.comment_count,
+				  'caption' : _caption_text(media),
+				  'latitude' : _latitude(media),
+				  'longitude' : _longitude(media)}
+	user_media['geohash'] = geo.encode(user_media['latitude'],
+									   user_media['longitude'])
+	return user_media
+
+##### Helper functions ######
+def _latitude(media_object):
+	"""Exception handling for getting latitude."""
+	try:
+		return media_object.location.point.latitude
+	except AttributeError:
+		return None
+
+def _longitude(media_object):
+	"""Exception handling for getting longitude."""
+	try:
+		return media_object.location.point.longitude
+	except AttributeError:
+		return None
+
+def _caption_text(media_object):
+	"""Exception handling for getting caption."""
+	try:
+		return media_object.caption.text
+	except AttributeError:
+		return None
 
 
 ################################################################
@@ -93,61 +692,34 @@ def update_pull_completion(instagram_id,order,is_complete=False):
 
 class AddUserProfile():
 	''' This class takes a instagram_id and grabs a user's profile information
-		and their media and stores it in the database.'''
+		and their media and stores it in the database. With media=False only
+		the profile is stored.'''
 
-	def __init__(self,instagram_id,user_order):
+	def __init__(self,instagram_id,user_order,media=True):
 		self._instagram_id = instagram_id
 		self._user_order = user_order
 		# Grab and store a user's basic profile data.
 
 		if user_exists(self._instagram_id):
-			print 'User data: user profile already in database.'
+			log.debug('User data: user profile already in database.')
 			pass
 		else:
-			print 'User data: storing user profile and media in database.'
-			basics, _ = self._get_user_profile()
-			media, rate = self._get_user_media()
-			print rate
-			self._store_user(basics)
-			self._store_media(media)
-		
+			log.debug('User data: storing user profile in database.')
+			with metrics.timer('stage_seconds',stage='profile'):
+				basics, _ = self._get_user_profile()
+				self._store_user(basics)
+			if media:
+				AddUserMedia(self._instagram_id)
+
 
 	def _get_user_profile(self):
 		''' Returns a tuple including a dictionary with instagram user data
 			stored for a given user_id and the remaining amount of calls
-			available to make on the api. If the user's account
-			is private this will return (None, None).'''
-
-		instagram_user = api.user(user_id = self._instagram_id)
-		remaining_calls = int(api.x_ratelimit_remaining)
-		# Extract data and store in dict
-		instagram_user_profile = {'instagram_id' : self._instagram_id}
-		instagram_user_profile['instagram_username'] = instagram_user.username
-		instagram_user_profile['bio'] = instagram_user.bio
-		instagram_user_profile['num_followers']= instagram_user.counts['followed_by']
-		instagram_user_profile['num_following'] = instagram_user.counts['follows']
-		instagram_user_profile['num_posts'] = instagram_user.counts['media']
-		return instagram_user_profile, remaining_calls
-
-	def _get_user_media(self):
-		''' Given an instagram user id, this return a tuple including a list 
-			of dictionaries containing data on the user's recent media and 
-			the amount of remaining calls available to make on the api. If 
-			the user's account is private this will return (None, None).
-		'''
-
-		media_list, next = api.user_recent_media(user_id = self._instagram_id)
-		remaining_calls = int(api.x_ratelimit_remaining)
-		user_media_list = []
-		for media in media_list:
-			user_media = {'media_id' : media.id,
-						  'num_likes' : media.like_count,
-						  'num_comments' : media.comment_count,
-						  'caption' : self._get_caption_text(media),
-						  'latitude' : self._get_latitude(media),
-						  'longitude' : self._get_longitude(media)}
-			user_media_list.append(user_media)
-		return user_media_list, remaining_calls
+			available to make on the api.'''
+
+		instagram_user_profile = fetch_profile(self._instagram_id,
+											   self._user_order)
+		return instagram_user_profile, scheduler.remaining()
 
 	def _store_user(self,instagram_user_profile):
 		'''Stores a user's basic information dict in the database.'''
@@ -162,170 +734,341 @@ class AddUserProfile():
 							user_order=self._user_order,
 							stored_at=datetime.now())
 			commit_to_db(new_user)
+			known_users.add(self._instagram_id)
+
+
+class AddUserMedia():
+	''' This class takes an instagram_id and grabs the user's recent media
+		and stores it in the database. Media is read newest first, up to
+		max_pages pages, MEDIA_MAX_PAGES in .instagram_config by default.
+		Once a user's media has been pulled, later pulls stop at the page
+		holding the newest media stored before, so a refresh usually costs
+		a single call. The like and comment counts of media already stored
+		are updated from the pages read.'''
+
+	def __init__(self,instagram_id,max_pages=None):
+		self._instagram_id = instagram_id
+		self._max_pages = max_pages or config.get('MEDIA_MAX_PAGES', 5)
+
+		# Check to see if the user exists in the database.
+		if user_exists(self._instagram_id):
+			log.debug('Media: storing user media in database.')
+			with metrics.timer('stage_seconds',stage='media'):
+				stored_newest = self._get_newest_media_id()
+				newest = None
+				for media in self._get_user_media(stored_newest):
+					if media and not newest:
+						newest = media[0]['media_id']
+					self._store_media(media)
+				self._update_newest_media_id(newest or stored_newest)
+		else:
+			log.debug('Media: user not in database.')
+
+	def _get_user_media(self,stored_newest=None):
+		''' Yields the user's recent media a page at a time, see
+			fetch_media.'''
+
+		return fetch_media(self._instagram_id,stored_newest,self._max_pages)
 
 	def _store_media(self,user_media_list):
-		'''Stores a user's media dict in the database.'''
+		'''Stores a user's media dict in the database, updating the like and
+		   comment counts of media already stored, along with the hashtags
+		   and mentions of the captions.'''
 
 		if user_media_list:
-			for media in user_media_list:
-				new_media = Media(instagram_id=self._instagram_id,
-								  media_id=media['media_id'],
-								  num_likes=media['num_likes'],
-								  num_comments=media['num_comments'],
-								  caption=media['caption'],
-								  latitude=media['latitude'],
-								  longitude=media['longitude'])
-				commit_to_db(new_media)	
-
-	##### Helper functions ######
-	def _get_latitude(self,media_object):
-		'''Exception handling for getting latitude.'''
-		try:
-			return media_object.location.point.latitude
-		except AttributeError:
-			return None
+			stored = store_media((self._instagram_id,media)
+								 for media in user_media_list)
+			log.debug('Stored or updated %d media.',stored)
 
-	def _get_longitude(self,media_object):
-		'''Exception handling for getting longitude.'''
-		try:
-			return media_object.location.point.longitude
-		except AttributeError:
-			return None
+	def _get_newest_media_id(self):
+		'''Returns the newest media id stored for the user, if any.'''
 
-	def _get_caption_text(self,media_object):
-		'''Exception handling for getting caption.'''
-		try:
-			return media_object.caption.text
-		except AttributeError:
-			return None
+		return session.query(InstagramUser.newest_media_id)\
+					  .filter_by(instagram_id=self._instagram_id)\
+					  .scalar()
+
+	def _update_newest_media_id(self,newest):
+		'''Records the newest media id and when the media was pulled.'''
+
+		session.query(InstagramUser)\
+			   .filter_by(instagram_id=self._instagram_id)\
+			   .update({'newest_media_id': newest,
+						'media_refreshed_at': datetime.now()},
+					   synchronize_session=False)
+		session.commit()
 
 
 class AddUserFollowers():
 	''' This class takes an instagram_id and grabs the users follower data
-		and stores this information in the database.'''
-
-	def __init__(self,instagram_id,max_followers=10000):
+		and stores this information in the database. Followers are stored a
+		page at a time, and after each page checkpoint is called with the
+		cursor of the next page, which can be passed back in as cursor to
+		resume an interrupted pull. heartbeat is called as each page is
+		fetched, also when nothing is stored until the last page, as when
+		sampling or refreshing.
+
+		At most max_followers followers are kept, MAX_FOLLOWERS in the
+		config by default and no cap if None. With sampling='cap'
+		pagination stops at the cap, bounding the api calls of huge
+		accounts, but the followers kept are the most recent ones. With
+		sampling='reservoir' every page is fetched and a uniform sample is
+		kept, written once the last page is in. Either way the share of
+		followers stored is kept as the user's follower_sample_rate, for
+		rescaling counts over them.
+
+		With refresh=True the follower list is fetched whatever the stored
+		count, and only the difference with the stored followers is
+		written: new followers are added and, once the pages have been
+		fetched from the start, stored followers missing from them are
+		deleted. Those are unfollows, and with a cap also the followers
+		that fell out of the most recent max_followers or out of the
+		sample, so the stored followers stay within the cap.'''
+
+	def __init__(self,instagram_id,max_followers=None,cursor=None,
+				 checkpoint=None,refresh=False,sampling=None,heartbeat=None):
 		self._instagram_id = instagram_id
-		self._max_followers = float(max_followers)
+		self._heartbeat = heartbeat
+		default_max, default_sampling = follower_sampling()
+		self._max_followers = max_followers if max_followers is not None \
+							  else default_max
+		self._sampling = sampling or default_sampling
+		self._sampled = False
 
 		# Check to see if the user exists in the database.
 		user = user_exists(self._instagram_id)
 		if user:
+			expected = user.num_followers or 0
+			if self._max_followers:
+				expected = min(expected,self._max_followers)
 			# Checks how many followers this user already has in database.  
-			if not self._follower_count_within_range(.1):
-				print 'Followers: storing user followers in database.'
-				# Grab and store the user's list of followers.
-				followers, remaining_calls = self._get_user_followers()
-				print remaining_calls
-				self._store_followers(followers)
+			if refresh or \
+			   not self._follower_count_within_range(.1,expected):
+				log.debug('Followers: storing user followers in database.')
+				reservoir = self._sampling == 'reservoir' and \
+							self._max_followers
+				stored = stored_edges(self._instagram_id,'followers') \
+						 if refresh or reservoir else None
+				seen = set()
+				if reservoir:
+					pages = self._sample_followers(cursor,stored)
+				else:
+					pages = self._cap_followers(cursor)
+				# Grab and store the user's followers page by page.
+				with metrics.timer('stage_seconds',stage='followers'):
+					for followers, next in pages:
+						if stored is not None:
+							followers = [int(follower_id) for follower_id
+										 in followers]
+							seen.update(followers)
+							followers = [follower_id for follower_id
+										 in followers
+										 if follower_id not in stored]
+						self._store_followers(followers)
+						if checkpoint:
+							checkpoint(next)
+					if stored is not None and not cursor:
+						removed = remove_edges(self._instagram_id,
+											   stored - seen,'followers')
+						if removed:
+							import sketches
+							sketches.rebuild(session,self._instagram_id)
+						log.info('Followers: %s gained %d and lost %d.',
+								 self._instagram_id,len(seen - stored),
+								 removed)
+				self._update_sample_rate(user.num_followers)
+				mark_refreshed(self._instagram_id,'followers')
 			else:
-				print 'Followers: count of followers is within bound.'
+				log.debug('Followers: count of followers is within bound.')
 				pass
 		else: 
-			print 'Followers: user not in database.'
-
-	def _get_user_followers(self):
-		''' Given an instagram_id this will return a tuple containing
-			a list of the user's followers and the amount of remaining calls
-			available to make on the api. If the user is private it will
-			return (None, None).'''
-
-		user_follower_list = []
-		followers, next = api.user_followed_by(user_id=self._instagram_id)
-		remaining_calls = int(api.x_ratelimit_remaining)
-		# Build the list of all follower ids.
-		for follower in followers:
-			user_follower_list.append(follower.id)
-		# Handling the pagination of the returned object. 
-		while next:
-			followers, next = api.user_followed_by(with_next_url=next)
-			remaining_calls = int(api.x_ratelimit_remaining)
-			print remaining_calls
-			for follower in followers:
-				user_follower_list.append(follower.id)
-		return user_follower_list, remaining_calls
-
-	def _follower_count_within_range(self,prec_range):
+			log.debug('Followers: user not in database.')
+
+	def _cap_followers(self,cursor=None):
+		''' Yield the pages of followers until max_followers followers
+			have been fetched, counting those stored before when resuming
+			from a cursor. The page reaching the cap is cut short and
+			reported as the last one.'''
+
+		if not self._max_followers:
+			for page in self._get_user_followers(cursor):
+				yield page
+			return
+		budget = self._max_followers
+		if cursor:
+			budget -= self._follower_count()
+		for followers, next in self._get_user_followers(cursor):
+			if len(followers) >= budget and \
+			   (next or len(followers) > budget):
+				self._sampled = True
+				log.info('Followers: capped %s at %d followers.',
+						 self._instagram_id,self._max_followers)
+				yield followers[:max(budget,0)], None
+				return
+			budget -= len(followers)
+			yield followers, next
+
+	def _sample_followers(self,cursor,stored):
+		''' Fetch every page of followers and yield a single page holding a
+			uniform sample of max_followers of them. Followers not stored
+			are drawn by reservoir sampling as they come in. The sample is
+			then drawn across the stored followers still following and the
+			others, as many from each as a uniform draw over all of them
+			would pick, so stored followers are kept where they can be
+			without the sample going stale. The stored followers in the
+			sample are skipped when writing, and those left out of it are
+			deleted.'''
+
+		kept = set()
+		reservoir = []
+		fresh = 0
+		for followers, _ in self._get_user_followers(cursor):
+			for follower_id in followers:
+				follower_id = int(follower_id)
+				if follower_id in stored:
+					kept.add(follower_id)
+					continue
+				fresh += 1
+				if len(reservoir) < self._max_followers:
+					reservoir.append(follower_id)
+				else:
+					slot = random.randint(0,fresh - 1)
+					if slot < self._max_followers:
+						reservoir[slot] = follower_id
+		total = len(kept) + fresh
+		size = min(self._max_followers,total)
+		from_kept = sum(1 for i in random.sample(xrange(total),size)
+						if i < len(kept))
+		sample = random.sample(list(kept),from_kept) + \
+				 random.sample(reservoir,size - from_kept)
+		self._sampled = size < total
+		if self._sampled:
+			log.info('Followers: sampled %d of %d followers of %s.',
+					 size,total,self._instagram_id)
+		yield sample, None
+
+	def _update_sample_rate(self,num_followers):
+		''' Store the share of the user's followers that is stored, 1 unless
+			this pull sampled them.'''
+
+		rate = 1.
+		if self._sampled and num_followers:
+			rate = min(1.,self._follower_count()/float(num_followers))
+		session.query(InstagramUser)\
+			   .filter_by(instagram_id=self._instagram_id)\
+			   .update({'follower_sample_rate': rate},
+					   synchronize_session=False)
+		session.commit()
+
+	def _get_user_followers(self,cursor=None):
+		''' Yields the user's followers a page at a time, see
+			fetch_followers.'''
+
+		return with_heartbeat(fetch_followers(self._instagram_id,cursor),
+							  self._heartbeat)
+
+	def _follower_count_within_range(self,prec_range,prof_count):
 		""" This function checks the database to see if the number of followers
 			in the Follower table is within a range of the current number in 
 			the user's profile."""
 
-		followers = session.query(Follower)\
-						   .filter_by(instagram_id=self._instagram_id)
-		db_count = followers.count()
-		user = session.query(InstagramUser)\
-					  .filter_by(instagram_id=self._instagram_id)\
-					  .one()
-		prof_count = user.num_followers
+		db_count = self._follower_count()
 		bound = prof_count*prec_range
 
 		return prof_count-bound <= db_count <= prof_count+bound
 
+	def _follower_count(self):
+		return session.query(Follower)\
+					  .filter_by(instagram_id=self._instagram_id)\
+					  .count()
+
 	def _store_followers(self,user_follower_list):
 		''' A function that stores the user-follower relationship
-			as a directed pair in the database.'''
+			as a directed pair in the database, and merges the followers
+			into the user's follower sketch.'''
 
 		if user_follower_list:
-			for follower_id in user_follower_list:
-				new_follower = Follower(instagram_id=self._instagram_id,
-										follower_id=follower_id)
-				commit_to_db(new_follower)
+			writer = bulk_writer(Follower, ['instagram_id', 'follower_id'])
+			with writer:
+				writer.add_all(dict(instagram_id=self._instagram_id,
+									follower_id=follower_id)
+							   for follower_id in user_follower_list)
+			# Imported here, so importing models doesn't load numpy.
+			import sketches
+			sketches.add_followers(session,self._instagram_id,
+								   user_follower_list)
+			log.debug('Stored %d followers, skipped %d duplicates.',
+					  writer.rows_written,writer.rows_skipped)
 
 class AddUserFollows():
 	""" This class defines the methods to pull the list of users that a given
 		instagram user follows. So input is a instagram_id and stores the
-		relationships in the Follwer table."""
+		relationships in the Follwer table. Like AddUserFollowers it stores a
+		page at a time, reports the next cursor to checkpoint, calls
+		heartbeat as each page is fetched and, with refresh=True, writes
+		only the difference with the stored follows."""
 
-	def __init__(self,instagram_id):
+	def __init__(self,instagram_id,cursor=None,checkpoint=None,
+				 refresh=False,heartbeat=None):
 		self._instagram_id = instagram_id
+		self._heartbeat = heartbeat
 
 		# Check to see if the user exists in the database.
 		user = user_exists(self._instagram_id)
 		if user:
 			# Checks amount of following already in the database.
-			if not self._follows_count_within_range(.1):
-				# Grab and store the list of user follows.
-				print 'Followers: storing user followers in database.'
-				follows, remaining_calls = self._get_user_follows()
-				print remaining_calls
-				self._store_follows(follows)
+			if refresh or \
+			   not self._follows_count_within_range(.1,user.num_following):
+				# Grab and store the user follows page by page.
+				log.debug('Follows: storing user follows in database.')
+				stored = stored_edges(self._instagram_id,'follows') \
+						 if refresh else None
+				seen = set()
+				with metrics.timer('stage_seconds',stage='follows'):
+					for follows, next in self._get_user_follows(cursor):
+						if refresh:
+							follows = [int(instagram_id) for instagram_id
+									   in follows]
+							seen.update(follows)
+							follows = [instagram_id for instagram_id
+									   in follows
+									   if instagram_id not in stored]
+						self._store_follows(follows)
+						if checkpoint:
+							checkpoint(next)
+					if refresh and not cursor:
+						removed = remove_edges(self._instagram_id,
+											   stored - seen,'follows')
+						log.info('Follows: %s followed %d and unfollowed %d.',
+								 self._instagram_id,len(seen - stored),
+								 removed)
+				mark_refreshed(self._instagram_id,'follows')
 			else:
-				print 'Follows: Count of following is within bound.'
+				log.debug('Follows: Count of following is within bound.')
 				pass
 		else:
-			print 'not stroring follows: user not in db'
-
-	def _get_user_follows(self):
-		""" Given an instagram_id, this will return a tuple containing 
-			the list of users that the given account follows, and the 
-			count of remaining_calls available to make on the api."""
-
-		user_follows_list = []
-		follows, next = api.user_follows(user_id=self._instagram_id)
-		remaining_calls = int(api.x_ratelimit_remaining)
-		print remaining_calls
-		for user in follows:
-			user_follows_list.append(user.id)
-		while next:
-			follows, next = api.user_follows(with_next_url=next)
-			remaining_calls = int(api.x_ratelimit_remaining)
-			print remaining_calls	
-			for user in follows:
-				user_follows_list.append(user.id)
-		return user_follows_list, remaining_calls	
+			log.debug('not stroring follows: user not in db')
+
+	def _get_user_follows(self,cursor=None):
+		""" Yields the accounts the user follows a page at a time, see
+			fetch_follows."""
 
+		return with_heartbeat(fetch_follows(self._instagram_id,cursor),
+							  self._heartbeat)
 
 	def _store_follows(self,user_follows_list):
 		""" A method that stores the follow relationship as a directed 
 			pair in the database."""
 
 		if user_follows_list:
-			for instagram_id in user_follows_list:
-				new_relationship = Follower(instagram_id=instagram_id,
-											follower_id=self._instagram_id)
-				commit_to_db(new_relationship)
-
-	def _follows_count_within_range(self,prec_range):
+			writer = bulk_writer(Follower, ['instagram_id', 'follower_id'])
+			with writer:
+				writer.add_all(dict(instagram_id=instagram_id,
+									follower_id=self._instagram_id)
+							   for instagram_id in user_follows_list)
+			log.debug('Stored %d follows, skipped %d duplicates.',
+					  writer.rows_written,writer.rows_skipped)
+
+	def _follows_count_within_range(self,prec_range,prof_count):
 		""" This function checks the database to see if the number of follows
 			in the Follower table is within a range of the current number in 
 			the user's profile."""
@@ -333,10 +1076,6 @@ class AddUserFollows():
 		follows = session.query(Follower)\
 						   .filter_by(follower_id=self._instagram_id)
 		db_count = follows.count()
-		user = session.query(InstagramUser)\
-					  .filter_by(instagram_id=self._instagram_id)\
-					  .one()
-		prof_count = user.num_following
 		bound = prof_count*prec_range
 
 		return prof_count-bound <= db_count <= prof_count+bound
@@ -356,18 +1095,22 @@ class BasicDataPull():
 		self._instagram_id = instagram_id
 		self._user_order = user_order
 
+		if is_unavailable(self._instagram_id):
+			log.debug('Basic Pull: user is unavailable.')
+			return
+
 		# Checking whether the user already exists in the database.
 		user = user_exists(self._instagram_id)
 		if user:
 			# Different pull levels for different existing user orders. 
 			if not user.pull_completion:
-				print 'Basic Pull: user isnt complete. Preform order 3 pull.'
+				log.debug('Basic Pull: user isnt complete. Preform order 3 pull.')
 				self._full_3_pull()
 			else:
-				print 'Basic Pull: user pull already complete.'
+				log.debug('Basic Pull: user pull already complete.')
 				pass
 		else:
-			print 'Basic Pull: user doesnt exist. Preform order 3 pull.'
+			log.debug('Basic Pull: user doesnt exist. Preform order 3 pull.')
 			self._full_3_pull()
 
 
@@ -379,47 +1122,57 @@ class BasicDataPull():
 			# Update the users pull completion status.
 			update_pull_completion(self._instagram_id,order=3,
 													  is_complete=True)
-		except InstagramAPIError:
-			print 'Private: this user is private.'
-			pass
+		except InstagramAPIError as error:
+			if not skip_unavailable(self._instagram_id,error):
+				raise
 
 
 class TargetDataPull():
 	""" This is a class that pulls the all of the data necessary to
 		analyze the target customer. This is the second order data pull.
 		Pass in a instagram id and it will pull and store the user's
-		profile, recent media, and what accounts they follow."""
+		profile, recent media, and what accounts they follow. Callers that
+		already know which pull the user needs, see plan_target_pulls, pass
+		it as pull to skip the lookup."""
 
-	def __init__(self,instagram_id,user_order=2):
+	def __init__(self,instagram_id,user_order=2,pull=None):
 		self._instagram_id = instagram_id
 		self._user_order = user_order
 
+		if is_unavailable(self._instagram_id):
+			log.debug('Target Pull: user is unavailable.')
+			return
+
 		# Checking whether the user already exists in the database.
-		user = user_exists(self._instagram_id)
-		if user:
+		user = None if pull else user_exists(self._instagram_id)
+		if pull == 'full_2':
+			self._full_2_pull()
+		elif pull == 'partial_3_2':
+			self._partial_3_2_pull()
+		elif user:
 			# Different pull levels for different existing user orders. 
 			if user.user_order == 3:
-				print 'Target Pull: order 3 user exists, preform order2 pull.'
+				log.debug('Target Pull: order 3 user exists, preform order2 pull.')
 				self._update_order_to_2()
 				update_pull_completion(self._instagram_id,order=2,
 														  is_complete=False)
 				self._partial_3_2_pull()
 			elif user.user_order == 2:
 				if not user.pull_completion:
-					print 'Target Pull: user not complete. Full 2 pull.'
+					log.debug('Target Pull: user not complete. Full 2 pull.')
 					self._full_2_pull()	
 				else:
-					print 'Target Pull: user pull already complete.'
+					log.debug('Target Pull: user pull already complete.')
 					pass
 			else:
 				if not user.pull_completion:
-					print 'Target Pull: user not complete. Full 2 pull.'
+					log.debug('Target Pull: user not complete. Full 2 pull.')
 					self._full_2_pull()
 				else:
-					print 'Target Pull: user pull already complete.'
+					log.debug('Target Pull: user pull already complete.')
 					pass		
 		else:
-			print 'Target Pull: user does not exist. Full 2 pull.'
+			log.debug('Target Pull: user does not exist. Full 2 pull.')
 			self._full_2_pull()
 
 
@@ -433,9 +1186,9 @@ class TargetDataPull():
 			#Update the users pull completion status.
 			update_pull_completion(self._instagram_id,order=2,
 													  is_complete=True)
-		except InstagramAPIError:
-			print 'Private: this user is private.'
-			pass
+		except InstagramAPIError as error:
+			if not skip_unavailable(self._instagram_id,error):
+				raise
 
 	def _partial_3_2_pull(self):
 		""" Pull all following and preform order 3 pull on each."""
@@ -445,9 +1198,9 @@ class TargetDataPull():
 			# Update the users pull completion status.
 			update_pull_completion(self._instagram_id,order=2,
 													  is_complete=True)
-		except InstagramAPIError:
-			print 'Private: this user is private.'
-			pass
+		except InstagramAPIError as error:
+			if not skip_unavailable(self._instagram_id,error):
+				raise
 
 	def _get_list_follows(self):
 		""" Get list of user's following."""
@@ -461,47 +1214,61 @@ class TargetDataPull():
 		""" Update the users order to 2 and update their pull pull_completion
 			to false."""
 
-		instagram_user = session.query(InstagramUser)\
-							    .filter_by(instagram_id=self._instagram_id)\
-							    .one()
-		instagram_user.user_order = 2
-		commit_to_db(instagram_user)
+		update_user_order(self._instagram_id,2)
 
 class InfluencerDataPull():
 	""" This is a class that pulls the all of the data necessary to
 		analyze the influencer. This is the first order data pull.
 		Pass in a instagram id and it will pull and store the user's
-		profile, recent media, and what accounts they follow."""
-
-	def __init__(self,instagram_id,user_order=1):
+		profile, recent media, and what accounts they follow. With
+		workers > 1 the order 2 pulls of the followers run concurrently,
+		and with workers=None as many as the scheduler's concurrency
+		controller allows.
+		With dry_run=True nothing is pulled: the estimated cost of the
+		pull is logged and kept as plan, see planner.py."""
+
+	def __init__(self,instagram_id,user_order=1,workers=1,dry_run=False):
 		self._instagram_id = instagram_id
 		self._user_order = user_order
+		self._workers = workers
+
+		if dry_run:
+			from planner import CrawlPlanner, log_plan
+			self.plan = CrawlPlanner(workers=workers or
+							config.get('API_MAX_CONCURRENCY', 32))\
+								.plan([instagram_id])
+			log_plan(self.plan)
+			return
+
+		if is_unavailable(self._instagram_id):
+			log.debug('Influnecer Pull: user is unavailable.')
+			return
 
 		# Checking whether the user already exists in the database.
 		user = user_exists(self._instagram_id)
 		if user:
 			# Different pull levels for different existing user orders. 
 			if user.user_order == 2:
-				print 'Influnecer Pull: order 2 user exists. Partial 1 pull.'
+				log.debug('Influnecer Pull: order 2 user exists. Partial 1 pull.')
 				self._update_order_to_1()
 				update_pull_completion(self._instagram_id,order=1,
 														  is_complete=False)
 				self._partial_2_1_pull()
 			elif user.user_order == 3:
-				print 'Influnecer Pull: order 3 user exists. Partial 1 pull.'
+				log.debug('Influnecer Pull: order 3 user exists. Partial 1 pull.')
 				self._update_order_to_1()
 				update_pull_completion(self._instagram_id,order=1,
 														  is_complete=False)
 				self._partial_3_1_pull()
 			else:
 				if not user.pull_completion:
-					print 'Influnecer Pull: completing user pull.'
+					log.debug('Influnecer Pull: completing user pull.')
 					self._full_1_pull()
 				else:
-					print 'Influnecer Pull: complete user at lower order.'
+					log.debug('Influnecer Pull: complete user at lower order.')
 					pass
 		else:
-			print 'Influnecer Pull: user doesnt exist. preform order1 pull.'
+			log.debug('Influnecer Pull: user doesnt exist. preform order1 pull.')
 			self._full_1_pull()
 			
 
@@ -516,15 +1283,14 @@ class InfluencerDataPull():
 			AddUserFollows(self._instagram_id)
 
 			followers = self._get_list_followers()
-			for follower_id in followers:
-				TargetDataPull(follower_id)
+			self._pull_followers(followers)
 
 			# Update the users pull completion status.
 			update_pull_completion(self._instagram_id,order=1,
 													  is_complete=True)
-		except InstagramAPIError:
-			print 'Private: this user is private.'
-			pass
+		except InstagramAPIError as error:
+			if not skip_unavailable(self._instagram_id,error):
+				raise
 
 	def _partial_3_1_pull(self):
 		""" Pull following and followers. Preform order 2 pull on each
@@ -535,15 +1301,14 @@ class InfluencerDataPull():
 			AddUserFollows(self._instagram_id)
 			
 			followers = self._get_list_followers()
-			for follower_id in followers:
-				TargetDataPull(follower_id)
+			self._pull_followers(followers)
 
 			# Update the users pull completion status.
 			update_pull_completion(self._instagram_id,order=1,
 													  is_complete=True)
-		except InstagramAPIError:
-			print 'Private: this user is private.'
-			pass
+		except InstagramAPIError as error:
+			if not skip_unavailable(self._instagram_id,error):
+				raise
 
 	def _partial_2_1_pull(self):
 		""" Pull user followers. Preform order 2 pull on each follower.
@@ -553,15 +1318,29 @@ class InfluencerDataPull():
 			AddUserFollowers(self._instagram_id)
 			
 			followers = self._get_list_followers()
-			for follower_id in followers:
-				TargetDataPull(follower_id)
-				
+			self._pull_followers(followers)
+
 			# Update the users pull completion status.
 			update_pull_completion(self._instagram_id,order=1,
 													  is_complete=True)
-		except InstagramAPIError:
-			print 'Private: this user is private.'
-			pass
+		except InstagramAPIError as error:
+			if not skip_unavailable(self._instagram_id,error):
+				raise
+
+	def _pull_followers(self,followers):
+		""" Preform an order 2 pull on each follower whose pull isn't
+			complete yet, running up to self._workers pulls at once, or as
+			many as the concurrency controller allows."""
+
+		plan = plan_target_pulls(followers)
+		if self._workers is None or self._workers > 1:
+			fan_out = FanOut(session,workers=self._workers,
+							 concurrency=scheduler.concurrency)
+			fan_out.run(lambda (follower_id,pull):
+							TargetDataPull(follower_id,pull=pull),plan)
+		else:
+			for follower_id, pull in plan:
+				TargetDataPull(follower_id,pull=pull)
 
 	def _get_list_followers(self):
 		""" Get list of user's followers."""
@@ -583,10 +1362,6 @@ class InfluencerDataPull():
 		""" Update the users order to 1 and update their pull pull_completion
 			to false."""
 
-		instagram_user = session.query(InstagramUser)\
-							    .filter_by(instagram_id=self._instagram_id)\
-							    .one()
-		instagram_user.user_order = 1
-		commit_to_db(instagram_user)
+		update_user_order(self._instagram_id,1)
 
 
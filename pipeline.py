@@ -0,0 +1,357 @@
+""" Fetching and loading as separate stages, joined by the response log.
+
+Every page a pull fetches is appended to the log in RESPONSE_LOG, see
+response_log.py. The fetcher only fetches, so a slow database never holds
+up the api quota, and the loader tails the log and bulk-loads the pages
+into the tables, so loading can be rerun, after fixing a schema bug or into
+a new database, without a single api call.
+
+	python pipeline.py fetch <order> <instagram_id> [<instagram_id> ...]
+	python pipeline.py load [--follow]
+	python pipeline.py replay
+"""
+import os
+import sys
+import json
+import time
+import heapq
+import logging
+import argparse
+
+from sqlalchemy import func
+from instagram.bind import InstagramAPIError
+
+import models
+from db_setup import InstagramUser, Follower
+from models import (BATCH_SIZE, session, bulk_writer, known_users, chunked,
+					follower_sampling, fetch_profile, fetch_media,
+					fetch_followers, fetch_follows, log_page,
+					store_media, update_pull_completion)
+from rate_limit import classify_error, PRIVATE, NOT_FOUND
+from frontier import TASKS_BY_ORDER
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Where the loader keeps its position in each stream, and the records it
+# deferred, in the log directory.
+POSITIONS = 'loader.json'
+# Prefix of the username given to a user whose username was taken by
+# another user, followed by their instagram id. Instagram usernames can't
+# hold a '#', so it never clashes with a real one.
+STALE_USERNAME = '#'
+# How a profile loaded again merges with the stored one: the user keeps
+# the lowest order, and a pull at a lower order isn't complete yet.
+PROFILE_ORDER = {
+	'user_order': 'LEAST(instagram_user.user_order, EXCLUDED.user_order)',
+	'pull_completion': 'CASE WHEN EXCLUDED.user_order < '
+					   'instagram_user.user_order THEN FALSE '
+					   'ELSE instagram_user.pull_completion END'}
+
+
+class Fetcher(object):
+	""" Fetches the pages of a pull into the response log without reading
+		or writing the database. An order 1 fetch goes on to an order 2
+		fetch of every follower fetched, up to max_followers of them,
+		MAX_FOLLOWERS in the config by default. Nothing is known of what
+		is stored, so everything is fetched again; the loader skips what
+		it already has. Once a pull, and for order 1 the order 2 pulls of
+		the followers, has been fetched, a complete record is logged, so
+		the loader can mark the pull complete."""
+
+	def __init__(self, max_followers=None):
+		if models.get_response_log() is None:
+			raise ValueError('RESPONSE_LOG is not set in .instagram_config.')
+		self._max_followers = max_followers if max_followers is not None \
+							  else follower_sampling()[0]
+
+	def fetch(self, instagram_id, order=1):
+		""" Fetch a pull of the given order, returning the number of users
+			fetched."""
+
+		tasks = TASKS_BY_ORDER[order]
+		followers = []
+		try:
+			if 'profile' in tasks:
+				fetch_profile(instagram_id, order)
+			if 'media' in tasks:
+				for _ in fetch_media(instagram_id):
+					pass
+			if 'followers' in tasks:
+				for page, _ in fetch_followers(instagram_id):
+					followers.extend(page)
+					if self._max_followers and \
+					   len(followers) >= self._max_followers:
+						followers = followers[:self._max_followers]
+						break
+			if 'follows' in tasks:
+				for _ in fetch_follows(instagram_id):
+					pass
+		except InstagramAPIError as error:
+			kind = classify_error(error)
+			if kind not in (PRIVATE, NOT_FOUND):
+				raise
+			log.info('Fetcher: user %s is %s.', instagram_id, kind)
+			return 0
+		fetched = 1
+		for follower_id in followers:
+			fetched += self.fetch(follower_id, 2)
+		log_page('complete', instagram_id, None, user_order=order)
+		return fetched
+
+
+class LogLoader(object):
+	""" Loads the records of the response log into the database,
+		batch_size records at a time, and saves its position in every
+		stream once a batch is committed. Loading is idempotent: profiles
+		and media are upserted and edges already stored are skipped, so a
+		batch loaded twice after a crash does no harm. Unfollows aren't in
+		the log, so loading never deletes edges.
+
+		The streams of several fetchers are merged in the order their
+		records were fetched. Media whose user's profile isn't stored yet,
+		fetched by a process whose profile records lag behind, are
+		deferred, kept with the positions, and loaded once the profile
+		is.
+
+		Profiles keep the lowest order they were fetched at, and a user
+		moved to a lower order loses their pull completion, as in
+		plan_target_pulls. Complete records then mark the pull of their
+		order complete, so users fetched and loaded look pulled to the
+		crawl and aren't fetched over the api again."""
+
+	def __init__(self, response_log, batch_size=BATCH_SIZE):
+		self._log = response_log
+		self._batch_size = batch_size
+		self._path = os.path.join(response_log.directory, POSITIONS)
+		self._deferred = []
+
+	def load(self, replay=False):
+		""" Load every record after the saved positions, or every record in
+			the log with replay. Returns the number of records loaded."""
+
+		if replay:
+			positions, self._deferred = {}, []
+		else:
+			positions, self._deferred = self._state()
+		records = heapq.merge(*[self._records(stream, positions.get(stream))
+								for stream in self._log.streams()])
+		loaded = 0
+		batch = []
+		for _, stream, position, record in records:
+			batch.append(record)
+			positions[stream] = position
+			if len(batch) >= self._batch_size:
+				loaded += self._load_batch(batch)
+				self._save_state(positions)
+				batch = []
+		if batch:
+			loaded += self._load_batch(batch)
+			self._save_state(positions)
+		if loaded:
+			log.info('Loader: loaded %d records, %d media pages deferred.',
+					 loaded, len(self._deferred))
+		return loaded
+
+	def follow(self, poll_interval=5.):
+		""" Load new records as they are appended, until interrupted."""
+
+		while True:
+			if not self.load():
+				time.sleep(poll_interval)
+
+	def _records(self, stream, position):
+		""" Yield the records of a stream as tuples that sort in the
+			order they were fetched."""
+
+		for position, record in self._log.read(stream, position):
+			yield record['fetched_at'], stream, position, record
+
+	def _load_batch(self, records):
+		by_kind = {}
+		for record in records:
+			by_kind.setdefault(record['kind'], []).append(record)
+		# Media reference their user, so profiles go first.
+		with metrics.timer('stage_seconds', stage='load'):
+			self._load_profiles(by_kind.get('profile', []))
+			self._deferred = self._load_media(self._deferred +
+											  by_kind.get('media', []))
+			self._load_edges(by_kind.get('followers', []),
+							 by_kind.get('follows', []))
+			for record in by_kind.get('complete', []):
+				update_pull_completion(record['instagram_id'],
+									   order=record['user_order'],
+									   is_complete=True)
+		metrics.inc('loader_records_total', len(records))
+		return len(records)
+
+	def _load_profiles(self, records):
+		usernames = self._release_usernames(records)
+		writer = bulk_writer(InstagramUser, ['instagram_id',
+											 'instagram_username', 'bio',
+											 'num_followers', 'num_following',
+											 'num_posts', 'user_order',
+											 'pull_completion', 'stored_at'],
+							 conflict_columns=['instagram_id'],
+							 update_columns=['instagram_username', 'bio',
+											 'num_followers', 'num_following',
+											 'num_posts'],
+							 update_expressions=PROFILE_ORDER)
+		with writer:
+			for record in records:
+				profile = record['data']
+				writer.add(instagram_id=record['instagram_id'],
+						   instagram_username=usernames[id(record)],
+						   bio=profile['bio'],
+						   num_followers=profile['num_followers'],
+						   num_following=profile['num_following'],
+						   num_posts=profile['num_posts'],
+						   user_order=record.get('user_order') or 3,
+						   pull_completion=False,
+						   stored_at=record['fetched_at'])
+		for record in records:
+			known_users.add(record['instagram_id'])
+
+	def _release_usernames(self, records):
+		""" Return the username to store for each profile record, by id of
+			the record, once stored users whose username was taken by
+			another user since are renamed out of the way. Usernames are
+			unique, but users rename themselves and their old names are
+			taken by others, so the stored name of a user not fetched
+			since may be stale. A name fetched for several users in the
+			batch goes to the last one fetched."""
+
+		holders = {}
+		for record in records:
+			holders[record['data']['instagram_username']] = \
+				record['instagram_id']
+		stale = []
+		for chunk in chunked(list(holders), BATCH_SIZE):
+			stale.extend(instagram_id for instagram_id, username in
+						 session.query(InstagramUser.instagram_id,
+									   InstagramUser.instagram_username)
+								.filter(InstagramUser.instagram_username
+													 .in_(chunk))
+						 if holders[username] != instagram_id)
+		for chunk in chunked(stale, BATCH_SIZE):
+			session.query(InstagramUser)\
+				   .filter(InstagramUser.instagram_id.in_(chunk))\
+				   .update({'instagram_username':
+								func.concat(STALE_USERNAME,
+											InstagramUser.instagram_id)},
+						   synchronize_session=False)
+		if stale:
+			log.info('Loader: renamed %d users whose username was taken.',
+					 len(stale))
+		usernames = {}
+		for record in records:
+			username = record['data']['instagram_username']
+			if holders[username] != record['instagram_id']:
+				username = STALE_USERNAME + str(record['instagram_id'])
+			usernames[id(record)] = username
+		return usernames
+
+	def _load_media(self, records):
+		""" Load the media pages of stored users, returning the pages of
+			users whose profile isn't stored."""
+
+		ids = set(record['instagram_id'] for record in records)
+		stored = set()
+		for chunk in chunked(list(ids), BATCH_SIZE):
+			stored.update(instagram_id for instagram_id, in
+						  session.query(InstagramUser.instagram_id)
+								 .filter(InstagramUser.instagram_id.in_(chunk)))
+		orphans = [record for record in records
+				   if record['instagram_id'] not in stored]
+		records = [record for record in records
+				   if record['instagram_id'] in stored]
+		store_media((record['instagram_id'], media)
+					for record in records for media in record['data'])
+		# The first page of a pull holds the newest media at the time.
+		for record in records:
+			if record.get('first') and record['data']:
+				session.query(InstagramUser)\
+					   .filter_by(instagram_id=record['instagram_id'])\
+					   .update({'newest_media_id':
+									record['data'][0]['media_id'],
+								'media_refreshed_at': record['fetched_at']},
+							   synchronize_session=False)
+		session.commit()
+		return orphans
+
+	def _load_edges(self, followers, follows):
+		writer = bulk_writer(Follower, ['instagram_id', 'follower_id'])
+		added = {}
+		for record in followers:
+			added.setdefault(record['instagram_id'], []).extend(record['data'])
+		# Handed over whole, so a batch of pages goes through COPY.
+		with writer:
+			writer.add_all(dict(instagram_id=record['instagram_id'],
+								follower_id=follower_id)
+						   for record in followers
+						   for follower_id in record['data'])
+			writer.add_all(dict(instagram_id=instagram_id,
+								follower_id=record['instagram_id'])
+						   for record in follows
+						   for instagram_id in record['data'])
+		import sketches
+		for instagram_id, follower_ids in added.iteritems():
+			sketches.add_followers(session, instagram_id,
+								   [int(follower_id)
+									for follower_id in follower_ids])
+
+	def _state(self):
+		""" Return the saved positions and deferred records."""
+
+		try:
+			with open(self._path) as f:
+				state = json.load(f)
+		except IOError:
+			return {}, []
+		return (dict((stream, tuple(position)) for stream, position
+					 in state['positions'].iteritems()),
+				state['deferred'])
+
+	def _save_state(self, positions):
+		# Written aside and renamed, so a crash never leaves half a file.
+		with open(self._path + '.tmp', 'w') as f:
+			json.dump({'positions': positions, 'deferred': self._deferred}, f)
+		os.rename(self._path + '.tmp', self._path)
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Fetch and load stages.')
+	commands = parser.add_subparsers(dest='command')
+	fetch = commands.add_parser('fetch', help='fetch pulls into the log')
+	fetch.add_argument('order', type=int, choices=sorted(TASKS_BY_ORDER))
+	fetch.add_argument('instagram_ids', nargs='+')
+	load = commands.add_parser('load', help='load new records')
+	load.add_argument('--follow', action='store_true',
+					  help='keep loading records as they are appended')
+	commands.add_parser('replay', help='load every record again')
+	args = parser.parse_args(argv)
+	logging.basicConfig(level=logging.INFO)
+
+	if args.command == 'fetch':
+		fetcher = Fetcher()
+		for instagram_id in args.instagram_ids:
+			fetched = fetcher.fetch(instagram_id, args.order)
+			log.info('Fetcher: fetched %d users for %s.', fetched,
+					 instagram_id)
+		return 0
+	response_log = models.get_response_log()
+	if response_log is None:
+		log.error('RESPONSE_LOG is not set in .instagram_config.')
+		return 1
+	loader = LogLoader(response_log)
+	if args.command == 'replay':
+		loader.load(replay=True)
+	elif args.follow:
+		loader.follow()
+	else:
+		loader.load()
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,249 @@
+""" Estimates what an order 1 pull of a list of influencers will cost, in
+api calls, database rows and hours under the rate limit, from what is
+already stored and without making a single api call.
+
+	python planner.py <instagram_id> [<instagram_id> ...]
+"""
+import sys
+import math
+import logging
+
+from sqlalchemy import func
+
+from db_setup import InstagramUser, Follower
+from models import (session, config, user_states, target_pull,
+					client_credentials, follower_sampling)
+from frontier import PAGE_SIZE
+
+log = logging.getLogger(__name__)
+
+# Media per page. The ids per page of followers and follows are
+# frontier.PAGE_SIZE, shared with the refresh costs of the crawler.
+MEDIA_PAGE_SIZE = 20
+# Used for users nothing is known about, when the database has no users
+# to average over either.
+DEFAULT_FOLLOWING = 150
+DEFAULT_POSTS = 100
+# The count heuristic of AddUserFollowers and AddUserFollows.
+COUNT_RANGE = .1
+
+
+def _pages(count, page_size=PAGE_SIZE):
+	return max(1, int(math.ceil((count or 0)/float(page_size))))
+
+
+class CrawlPlanner(object):
+	""" Plans order 1 pulls. Users already stored are costed from their
+		profile counts and pull state, the way the pulls will treat them,
+		and unknown users from the averages of stored users. Followers are
+		costed up to the cap of follower_sampling, which pages through them
+		all when sampling by reservoir. Influencers that aren't stored have
+		no known follower count, so they are costed as if they had as many
+		followers as the cap, every one an unknown user, and reported as
+		unknown. With sampling by cap that is an upper bound, about
+		MAX_FOLLOWERS/PAGE_SIZE calls for the followers and as many order 2
+		pulls as MAX_FOLLOWERS, and the estimate is marked as one. A
+		reservoir pages through followers of unknown number, and without a
+		cap nothing bounds them, so those estimates are not bounds.
+
+		The suggested order runs the followers with the most value per
+		call first, a follower being worth one completed order 2 pull for
+		every planned influencer they follow."""
+
+	def __init__(self, calls_per_hour=None, latency=.3, workers=1):
+		if calls_per_hour is None:
+			calls_per_hour = config.get('RATE_LIMIT', 5000) * \
+							 len(client_credentials())
+		self._calls_per_hour = float(calls_per_hour)
+		self._latency = latency
+		self._workers = workers
+		self._max_media_pages = config.get('MEDIA_MAX_PAGES', 5)
+		self._max_followers, self._sampling = follower_sampling()
+		following, posts = session.query(func.avg(InstagramUser.num_following),
+										 func.avg(InstagramUser.num_posts))\
+								  .one()
+		self._mean_following = float(following or DEFAULT_FOLLOWING)
+		self._mean_posts = float(posts or DEFAULT_POSTS)
+
+	def plan(self, instagram_ids):
+		""" Return the plan of an order 1 pull of the given influencers, as
+			a dict with the estimate of each influencer, the totals, the
+			hours it will take and the suggested order of influencers and
+			of their followers' order 2 pulls. bound is set when some
+			estimates are upper bounds, and so are the totals then."""
+
+		instagram_ids = [int(instagram_id) for instagram_id in instagram_ids]
+		states = user_states(instagram_ids)
+		influencers = []
+		follower_costs = {}
+		follower_values = {}
+		for instagram_id in instagram_ids:
+			estimate = self._plan_influencer(instagram_id,
+											 states.get(instagram_id),
+											 follower_costs, follower_values)
+			influencers.append(estimate)
+
+		totals = dict((key, sum(estimate[key] for estimate in influencers))
+					  for key in ('calls', 'users', 'media', 'edges'))
+		# Followers shared by several influencers are pulled once.
+		totals['calls'] -= sum(follower_costs[follower_id]*(value - 1)
+							   for follower_id, value
+							   in follower_values.iteritems())
+		rate_hours = totals['calls']/self._calls_per_hour
+		latency_hours = totals['calls']*self._latency/self._workers/3600.
+		order = sorted(influencers,
+					   key=lambda estimate: -estimate['followers_per_call'])
+		followers = sorted((follower_id for follower_id, cost
+							in follower_costs.iteritems() if cost),
+						   key=lambda follower_id:
+							   -follower_values[follower_id] /
+							   float(follower_costs[follower_id]))
+		return dict(totals,
+					influencers=influencers,
+					bound=any(estimate['bound'] for estimate in influencers),
+					hours=max(rate_hours, latency_hours),
+					order=[estimate['instagram_id'] for estimate in order],
+					follower_order=followers)
+
+	def _plan_influencer(self, instagram_id, state, follower_costs,
+						 follower_values):
+		calls = media = users = edges = 0
+		followers = []
+		known = state is not None
+		bound = False
+		if state is None:
+			# Profile and media, with followers and follows of unknown size.
+			calls += 1 + self._media_pages(self._mean_posts)
+			calls += _pages(self._mean_following)
+			users += 1
+			media += min(self._mean_posts,
+						 self._max_media_pages*MEDIA_PAGE_SIZE)
+			edges += self._mean_following
+			if self._max_followers:
+				# At most the cap of followers, each an order 2 pull.
+				bound = self._sampling == 'cap'
+				cost, rows = self._plan_follower(None)
+				calls += _pages(self._max_followers)
+				calls += self._max_followers*cost
+				users += self._max_followers*rows['users']
+				media += self._max_followers*rows['media']
+				edges += self._max_followers*(1 + rows['edges'])
+		elif state.user_order == 1 and state.pull_completion:
+			pass
+		else:
+			# Followers are pulled at every order, follows unless the
+			# user was pulled at order 2 already, both skipped when the
+			# stored count is close to the profile's.
+			stored = self._stored_edges(instagram_id)
+			kept = self._kept_followers(state.num_followers)
+			if not self._within_range(stored['followers'], kept):
+				calls += _pages(kept if self._sampling == 'cap'
+								else state.num_followers)
+				edges += max(0, kept - stored['followers'])
+			if state.user_order != 2 and \
+			   not self._within_range(stored['follows'],
+									  state.num_following):
+				calls += _pages(state.num_following)
+				edges += max(0, (state.num_following or 0) -
+								stored['follows'])
+			followers = self._followers(instagram_id)
+			unknown = max(0, kept - len(followers))
+
+			follower_states = user_states(followers)
+			for follower_id in followers:
+				cost, rows = self._plan_follower(
+								follower_states.get(follower_id))
+				if follower_id not in follower_costs:
+					users += rows['users']
+					media += rows['media']
+					edges += rows['edges']
+				follower_costs[follower_id] = cost
+				follower_values[follower_id] = \
+					follower_values.get(follower_id, 0) + 1
+				calls += cost
+			# Followers not stored yet are costed as unknown users.
+			cost, rows = self._plan_follower(None)
+			calls += unknown*cost
+			users += unknown*rows['users']
+			media += unknown*rows['media']
+			edges += unknown*rows['edges']
+		follower_count = (state.num_followers or 0) if known else 0
+		return {'instagram_id': instagram_id,
+				'known': known,
+				'bound': bound,
+				'calls': int(calls),
+				'users': int(users),
+				'media': int(media),
+				'edges': int(edges),
+				'followers_per_call': follower_count/float(max(calls, 1))}
+
+	def _plan_follower(self, state):
+		""" Return the calls and rows of a follower's order 2 pull."""
+
+		pull = target_pull(state)
+		if pull is None:
+			return 0, {'users': 0, 'media': 0, 'edges': 0}
+		if state is None:
+			posts = min(self._mean_posts,
+						self._max_media_pages*MEDIA_PAGE_SIZE)
+			return (1 + self._media_pages(self._mean_posts) +
+					_pages(self._mean_following),
+					{'users': 1, 'media': posts,
+					 'edges': self._mean_following})
+		return (_pages(state.num_following),
+				{'users': 0, 'media': 0, 'edges': state.num_following or 0})
+
+	def _kept_followers(self, num_followers):
+		""" Return how many of a user's followers a pull stores."""
+
+		if self._max_followers:
+			return min(num_followers or 0, self._max_followers)
+		return num_followers or 0
+
+	def _media_pages(self, posts):
+		return min(self._max_media_pages, _pages(posts, MEDIA_PAGE_SIZE))
+
+	def _within_range(self, stored, count):
+		bound = (count or 0)*COUNT_RANGE
+		return (count or 0) - bound <= stored <= (count or 0) + bound
+
+	def _stored_edges(self, instagram_id):
+		followers = session.query(Follower)\
+						   .filter_by(instagram_id=instagram_id).count()
+		follows = session.query(Follower)\
+						 .filter_by(follower_id=instagram_id).count()
+		return {'followers': followers, 'follows': follows}
+
+	def _followers(self, instagram_id):
+		followers = session.query(Follower.follower_id)\
+						   .filter_by(instagram_id=instagram_id)
+		return [follower_id for follower_id, in followers]
+
+
+def _note(estimate):
+	if estimate['known']:
+		return ''
+	if estimate['bound']:
+		return ' at most (followers costed at the cap until the profile ' \
+			   'is pulled)'
+	return ' (followers unknown until the profile is pulled)'
+
+def log_plan(plan):
+	""" Log a plan, an influencer per line."""
+
+	for estimate in plan['influencers']:
+		log.info('Plan: %(instagram_id)s needs %(calls)d calls for '
+				 '%(users)d users, %(media)d media and %(edges)d '
+				 'edges%(note)s.',
+				 dict(estimate, note=_note(estimate)))
+	log.info('Plan: %d calls, %d users, %d media and %d edges in %s '
+			 '%.1f hours.', plan['calls'], plan['users'], plan['media'],
+			 plan['edges'], 'at most' if plan['bound'] else 'about',
+			 plan['hours'])
+	log.info('Plan: suggested order %s.',
+			 ', '.join(str(instagram_id) for instagram_id in plan['order']))
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO, format='%(message)s')
+	log_plan(CrawlPlanner().plan(sys.argv[1:]))
@@ -0,0 +1,162 @@
+import numpy as np
+
+from graph import gather
+
+
+def load_popularity(graph, session, chunk_size=100000):
+	""" Return an array with the profile follower count of every node in
+		the graph. Nodes without a stored profile fall back to their
+		follower count in the graph."""
+
+	from db_setup import InstagramUser
+
+	popularity = graph.in_degree().astype(np.float64)
+	rows = session.query(InstagramUser.instagram_id,
+						 InstagramUser.num_followers)\
+				  .filter(InstagramUser.num_followers != None)\
+				  .yield_per(chunk_size)
+	ids, counts = [], []
+	for instagram_id, num_followers in rows:
+		ids.append(instagram_id)
+		counts.append(num_followers)
+	if ids:
+		nodes = graph.nodes(ids)
+		known = nodes >= 0
+		popularity[nodes[known]] = np.asarray(counts, dtype=np.float64)[known]
+	return popularity
+
+def load_sample_rates(graph, session):
+	""" Return an array with the follower sample rate of every node in the
+		graph, 1 for nodes whose followers weren't sampled."""
+
+	from db_setup import InstagramUser
+
+	rates = np.ones(len(graph), dtype=np.float64)
+	rows = session.query(InstagramUser.instagram_id,
+						 InstagramUser.follower_sample_rate)\
+				  .filter(InstagramUser.follower_sample_rate < 1)\
+				  .all()
+	if rows:
+		nodes = graph.nodes([instagram_id for instagram_id, _ in rows])
+		known = nodes >= 0
+		rates[nodes[known]] = np.asarray([rate for _, rate in rows],
+										 dtype=np.float64)[known]
+	return rates
+
+
+class CandidateRanker(object):
+	""" Ranks the candidate accounts for an influencer: the accounts most
+		followed by the influencer's followers.
+
+		The co-follow count of every account is the product of the
+		transposed follows adjacency with the indicator vector of the
+		influencer's followers, computed straight from the graph's CSR
+		arrays. With popularity given, see load_popularity, scores are
+		co-follow counts divided by the candidate's follower count, which
+		favours niche accounts over ones everybody follows. Candidates
+		need at least min_count co-follows, so tiny accounts followed by a
+		single follower don't top the normalized ranking.
+
+		When an influencer's followers were sampled, with sample_rates
+		given, see load_sample_rates, scores are scaled up by the inverse
+		of the influencer's rate, estimating the co-follows of the whole
+		audience so scores compare across influencers. The counts
+		returned, and min_count, stay those of the stored followers."""
+
+	def __init__(self, graph, popularity=None, min_count=2,
+				 sample_rates=None):
+		self._graph = graph
+		self._popularity = popularity
+		self._min_count = min_count
+		self._sample_rates = sample_rates
+
+	def co_follow_counts(self, instagram_id):
+		""" Return the co-follow count of every node for one influencer."""
+
+		graph = self._graph
+		node = graph.node(instagram_id)
+		followers, _ = gather(graph.in_indptr, graph.in_indices, [node])
+		follows, _ = gather(graph.out_indptr, graph.out_indices, followers)
+		counts = np.bincount(follows, minlength=len(graph))
+		counts[node] = 0
+		return counts
+
+	def rank(self, instagram_id, k=20):
+		""" Return the top k candidates of one influencer as a list of
+			(instagram_id, co-follow count, score) tuples."""
+
+		counts = self.co_follow_counts(instagram_id)
+		candidates = np.flatnonzero(counts >= max(self._min_count, 1))
+		return self._top(candidates, counts[candidates], k,
+						 self._rate(self._graph.node(instagram_id)))
+
+	def rank_many(self, instagram_ids, k=20, batch_size=100):
+		""" Rank the candidates of many influencers, batch_size at a time
+			in a single pass over their followers' follows each. Returns a
+			dict of ranking lists by influencer id, leaving out influencers
+			not in the graph."""
+
+		graph = self._graph
+		size = len(graph)
+		nodes = graph.nodes(instagram_ids)
+		rankings = {}
+		for start in xrange(0, len(nodes), batch_size):
+			batch = nodes[start:start + batch_size]
+			batch_ids = list(instagram_ids[start:start + batch_size])
+			present = np.flatnonzero(batch >= 0)
+			followers, labels = gather(graph.in_indptr, graph.in_indices,
+									   batch[present])
+			follows, origins = gather(graph.out_indptr, graph.out_indices,
+									  followers)
+			labels = present[labels[origins]]
+			# One key per influencer and candidate, counted in one sort.
+			keys, counts = np.unique(labels.astype(np.int64)*size + follows,
+									 return_counts=True)
+			key_labels, candidates = keys // size, keys % size
+			keep = (counts >= max(self._min_count, 1)) & \
+				   (candidates != batch[key_labels])
+			key_labels = key_labels[keep]
+			candidates, counts = candidates[keep], counts[keep]
+			bounds = np.searchsorted(key_labels, np.arange(len(batch) + 1))
+			for label in present:
+				lo, hi = bounds[label], bounds[label + 1]
+				rankings[batch_ids[label]] = self._top(candidates[lo:hi],
+													   counts[lo:hi], k,
+													   self._rate(batch[label]))
+		return rankings
+
+	def _rate(self, node):
+		if self._sample_rates is None:
+			return 1.
+		return max(float(self._sample_rates[node]), 1e-9)
+
+	def _top(self, candidates, counts, k, rate=1.):
+		if self._popularity is not None:
+			scores = counts/np.maximum(self._popularity[candidates], 1.)
+		else:
+			scores = counts.astype(np.float64)
+		scores = scores/rate
+		if len(scores) > k:
+			best = np.argpartition(-scores, k)[:k]
+		else:
+			best = np.arange(len(scores))
+		best = best[np.argsort(-scores[best], kind='mergesort')]
+		ids = self._graph.ids[candidates[best]]
+		return [(int(instagram_id), int(count), float(score))
+				for instagram_id, count, score
+				in zip(ids, counts[best], scores[best])]
+
+
+if __name__ == '__main__':
+	# python ranking.py <graph directory> <instagram id> [k] prints the top
+	# candidates of an influencer from a graph saved by graph.py.
+	import sys
+	from graph import FollowerGraph
+	import models
+	graph = FollowerGraph.load(sys.argv[1])
+	ranker = CandidateRanker(graph, load_popularity(graph, models.session),
+							 sample_rates=load_sample_rates(graph,
+															models.session))
+	k = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+	for instagram_id, count, score in ranker.rank(int(sys.argv[2]), k):
+		print '%d\t%d\t%.6f' %(instagram_id, count, score)
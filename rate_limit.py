@@ -0,0 +1,268 @@
+import time
+import random
+import socket
+import httplib
+import logging
+import threading
+
+import httplib2
+from instagram.bind import InstagramAPIError, InstagramClientError
+
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# The kinds of errors an api call can fail with, see classify_error.
+PRIVATE = 'private'
+NOT_FOUND = 'not_found'
+RATE_LIMITED = 'rate_limited'
+TRANSIENT = 'transient'
+FATAL = 'fatal'
+
+
+def is_rate_limit_error(error):
+	""" True if an InstagramAPIError means the client ran out of quota."""
+
+	return str(error.status_code) in ('429', '503') or \
+		   error.error_type in ('Rate limited', 'OAuthRateLimitException')
+
+def classify_error(error):
+	""" Return the kind of an exception raised by an api call: PRIVATE or
+		NOT_FOUND for users that can't be read, RATE_LIMITED when the
+		quota ran out, TRANSIENT for server and network errors worth
+		retrying and FATAL for anything else."""
+
+	if isinstance(error, InstagramAPIError):
+		if is_rate_limit_error(error):
+			return RATE_LIMITED
+		if error.error_type == 'APINotAllowedError':
+			return PRIVATE
+		if error.error_type == 'APINotFoundError':
+			return NOT_FOUND
+	elif not isinstance(error, InstagramClientError):
+		if isinstance(error, (socket.error, httplib.HTTPException,
+							  httplib2.HttpLib2Error)):
+			return TRANSIENT
+		return FATAL
+	# Responses that aren't valid JSON come with the status of the error
+	# page the server returned instead.
+	if str(getattr(error, 'status_code', '')).startswith('5'):
+		return TRANSIENT
+	return FATAL
+
+
+class ConcurrencyController(object):
+	""" Adapts the number of api calls in flight the way TCP adapts its
+		congestion window, additive increase and multiplicative decrease.
+		Each call that succeeds within target_latency seconds raises the
+		limit by 1/limit, about one more call in flight per round of
+		calls. A rate limit or transient error halves it, at most once per
+		cooldown seconds, so the failures of a single round count once.
+		Slow calls hold the limit where it is. acquire() blocks while the
+		limit is reached. The controller is thread safe.
+
+		The controller only holds calls back: a single threaded pull never
+		has more than one call in flight, whatever the limit. FanOut, given
+		the controller, runs a thread per call it could ever allow and
+		leaves the controller to decide how many of them call at once."""
+
+	def __init__(self, initial=4, minimum=1, maximum=32, target_latency=2.,
+				 cooldown=1., clock=time.time):
+		self._limit = float(initial)
+		self._minimum = minimum
+		self._maximum = maximum
+		self._target_latency = target_latency
+		self._cooldown = cooldown
+		self._clock = clock
+		self._decreased = None
+		self._in_flight = 0
+		self._condition = threading.Condition()
+
+	@property
+	def limit(self):
+		return int(self._limit)
+
+	@property
+	def maximum(self):
+		return self._maximum
+
+	def grow_to(self, limit):
+		""" Raise the limit to at least the given number of calls, within
+			the maximum, so a fixed pool of that size isn't held back
+			before any call failed."""
+
+		with self._condition:
+			self._limit = max(self._limit, min(float(limit), self._maximum))
+			self._condition.notify_all()
+
+	def acquire(self):
+		""" Block until another call may be in flight."""
+
+		with self._condition:
+			while self._in_flight >= max(int(self._limit), 1):
+				self._condition.wait()
+			self._in_flight += 1
+
+	def release(self, latency=None, error_kind=None):
+		""" Record a finished call, with how long it took or the kind of
+			error it failed with."""
+
+		with self._condition:
+			self._in_flight -= 1
+			if error_kind in (RATE_LIMITED, TRANSIENT):
+				now = self._clock()
+				if self._decreased is None or \
+				   now - self._decreased >= self._cooldown:
+					self._limit = max(self._limit/2, self._minimum)
+					self._decreased = now
+					log.debug('Concurrency: backed off to %d.', self.limit)
+			elif error_kind is None and latency is not None and \
+				 latency <= self._target_latency:
+				self._limit = min(self._limit + 1/self._limit, self._maximum)
+			metrics.gauge('api_concurrency_limit', self._limit)
+			self._condition.notify_all()
+
+
+class RequestScheduler(object):
+	""" A token bucket that holds the api quota for the hourly window.
+
+		The bucket refills continuously at limit/window tokens a second and
+		is corrected by the X-Ratelimit-Remaining header of every response,
+		minus the calls still in flight. acquire() blocks until a token is
+		free instead of letting a call fail, and remaining() reports the
+		budget without spending a call. The scheduler is thread safe.
+
+		Calls also go through a ConcurrencyController, which bounds how
+		many are in flight at once. Rate limit and transient errors are
+		retried up to max_retries times after a jittered, exponentially
+		growing wait, so concurrent workers don't retry in lockstep."""
+
+	def __init__(self, limit=5000, window=3600, reserve=0, max_retries=5,
+				 clock=time.time, concurrency=None, retry_wait=1.,
+				 sleep=time.sleep):
+		self._limit = float(limit)
+		self._window = float(window)
+		self._reserve = reserve
+		self._max_retries = max_retries
+		self._clock = clock
+		self._retry_wait = retry_wait
+		self._sleep = sleep
+		self.concurrency = concurrency or ConcurrencyController(clock=clock)
+		self._tokens = self._limit
+		self._updated = clock()
+		self._blocked_until = 0
+		self._in_flight = 0
+		self._condition = threading.Condition()
+
+	def remaining(self):
+		""" Return the number of calls left in the current window."""
+
+		with self._condition:
+			self._refill()
+			return int(self._tokens)
+
+	def acquire(self):
+		""" Block until a call may be made and take a token for it."""
+
+		with self._condition:
+			while True:
+				self._refill()
+				now = self._clock()
+				if now < self._blocked_until:
+					wait = self._blocked_until - now
+				elif self._tokens - self._reserve >= 1:
+					self._tokens -= 1
+					self._in_flight += 1
+					return
+				else:
+					rate = self._limit / self._window
+					wait = (1 - (self._tokens - self._reserve))/rate
+				self._condition.wait(wait)
+
+	def release(self, remaining=None, limit=None):
+		""" Record a finished call and the rate limit headers it returned."""
+
+		with self._condition:
+			self._in_flight -= 1
+			self._refill()
+			if limit:
+				self._limit = float(limit)
+			if remaining is not None:
+				self._tokens = max(0., float(remaining) - self._in_flight)
+			self._condition.notify_all()
+
+	def block(self, seconds):
+		""" Hold back every call for the given number of seconds."""
+
+		with self._condition:
+			self._tokens = 0.
+			self._blocked_until = max(self._blocked_until,
+									  self._clock() + seconds)
+
+	def call(self, client, endpoint, *args, **kwargs):
+		""" Call the endpoint method of client once a token is free,
+			feeding the response headers found on client back into the
+			bucket. Rate limit errors block the scheduler and transient
+			errors hold back this call, and both are retried with a
+			growing, jittered wait. Other errors are raised at once."""
+
+		method = getattr(client, endpoint)
+		backoff = 60.
+		for attempt in xrange(self._max_retries + 1):
+			with metrics.timer('api_wait_seconds'):
+				self.concurrency.acquire()
+				self.acquire()
+			start = self._clock()
+			try:
+				with metrics.timer('api_call_seconds', endpoint=endpoint):
+					result = method(*args, **kwargs)
+			except Exception as error:
+				kind = classify_error(error)
+				self.release()
+				self.concurrency.release(error_kind=kind)
+				metrics.inc('api_errors_total', endpoint=endpoint, kind=kind)
+				if kind not in (RATE_LIMITED, TRANSIENT) or \
+				   attempt == self._max_retries:
+					raise
+				if kind == RATE_LIMITED:
+					wait = random.uniform(backoff/2, backoff)
+					log.warning('Rate limited: waiting %d seconds.', wait)
+					metrics.inc('api_rate_limited_total', endpoint=endpoint)
+					self.block(wait)
+					backoff = min(backoff*2, self._window)
+				else:
+					wait = random.uniform(0, self._retry_wait*2**attempt)
+					log.warning('Transient error from %s, retrying in %.1f '
+								'seconds: %s', endpoint, wait, error)
+					self._sleep(wait)
+			else:
+				self.release(getattr(client, 'x_ratelimit_remaining', None),
+							 getattr(client, 'x_ratelimit', None))
+				self.concurrency.release(latency=self._clock() - start)
+				metrics.inc('api_calls_total', endpoint=endpoint)
+				metrics.gauge('api_remaining_calls', self._tokens)
+				return result
+
+	def _refill(self):
+		now = self._clock()
+		elapsed = max(0., now - self._updated)
+		self._updated = now
+		self._tokens = min(self._limit,
+						   self._tokens + elapsed*self._limit/self._window)
+
+
+class ScheduledAPI(object):
+	""" Wraps an InstagramAPI client so every method call goes through a
+		RequestScheduler. Other attributes are read from the client."""
+
+	def __init__(self, client, scheduler):
+		self._client = client
+		self.scheduler = scheduler
+
+	def __getattr__(self, name):
+		attr = getattr(self._client, name)
+		if not callable(attr):
+			return attr
+		def scheduled(*args, **kwargs):
+			return self.scheduler.call(self._client, name, *args, **kwargs)
+		return scheduled
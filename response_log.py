@@ -0,0 +1,161 @@
+""" An append-only log of the pages fetched from the api, so they can be
+loaded into the database apart from fetching, and loaded again without
+spending any quota.
+
+Every process appends to a stream of its own, a series of segment files
+named <stream>.<number>.jsonl.gz. Each page is written as a gzip member
+holding one JSON record, so a segment reads with zcat, and its offset and
+length are then appended to the segment's .idx file. Readers only follow
+the index, so they never see a page that is still being written.
+"""
+import os
+import json
+import zlib
+import socket
+import logging
+import threading
+
+from metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Size at which a segment is closed and the next one started.
+SEGMENT_BYTES = 64*2**20
+
+_SUFFIX = '.jsonl.gz'
+
+
+def _compress(data):
+	compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return compressor.compress(data) + compressor.flush()
+
+def _decompress(data):
+	return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class ResponseLog(object):
+	""" Appends records to, and reads them back from, the segments in a
+		directory. Appending is thread safe. The stream defaults to the
+		host name and process id, so processes forked from one another
+		never write to the same files.
+
+		Positions are (segment number, offset) pairs, where offset is the
+		byte offset of the next record to read in that segment."""
+
+	def __init__(self, directory, stream=None, segment_bytes=SEGMENT_BYTES):
+		self.directory = directory
+		self._stream = stream
+		self._segment_bytes = segment_bytes
+		self._lock = threading.Lock()
+		self._pid = None
+		self._data = None
+		self._index = None
+		self._number = None
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	def append(self, record):
+		""" Append a record, a JSON serializable dict, and return its
+			position."""
+
+		member = _compress(json.dumps(record, separators=(',', ':')) + '\n')
+		with self._lock:
+			if self._pid != os.getpid() or \
+			   self._data.tell() >= self._segment_bytes:
+				self._open()
+			offset = self._data.tell()
+			self._data.write(member)
+			self._data.flush()
+			self._index.write('%d %d\n' %(offset, len(member)))
+			self._index.flush()
+			position = (self._number, offset)
+		metrics.inc('response_log_bytes_total', len(member))
+		return position
+
+	def close(self):
+		with self._lock:
+			if self._data is not None:
+				self._data.close()
+				self._index.close()
+				self._data = self._index = None
+
+	def streams(self):
+		""" Return the names of the streams in the directory."""
+
+		return sorted(set(name.rsplit('.', 3)[0]
+						  for name in os.listdir(self.directory)
+						  if name.endswith(_SUFFIX)))
+
+	def segments(self, stream):
+		""" Return the numbers of a stream's segments, in order."""
+
+		prefix = stream + '.'
+		return sorted(int(name[len(prefix):-len(_SUFFIX)])
+					  for name in os.listdir(self.directory)
+					  if name.startswith(prefix) and name.endswith(_SUFFIX)
+					  and name[len(prefix):-len(_SUFFIX)].isdigit())
+
+	def read(self, stream, position=None):
+		""" Yield the records of a stream after position, from the start
+			if it's None, as (position after the record, record) tuples."""
+
+		number, offset = position or (0, 0)
+		for segment in self.segments(stream):
+			if segment < number:
+				continue
+			start = offset if segment == number else 0
+			path = self._path(stream, segment)
+			with open(path, 'rb') as data:
+				for entry_offset, length in self._entries(path):
+					if entry_offset < start:
+						continue
+					data.seek(entry_offset)
+					member = data.read(length)
+					if len(member) < length:
+						break
+					yield ((segment, entry_offset + length),
+						   json.loads(_decompress(member)))
+
+	def _path(self, stream, number):
+		return os.path.join(self.directory,
+							'%s.%06d%s' %(stream, number, _SUFFIX))
+
+	def _entries(self, path):
+		""" Return the (offset, length) pairs of a segment's index, leaving
+			out a last line that is still being written."""
+
+		try:
+			with open(path + '.idx', 'rb') as index:
+				lines = index.read().split('\n')
+		except IOError:
+			return []
+		return [tuple(int(field) for field in line.split())
+				for line in lines[:-1]]
+
+	def _open(self):
+		""" Open the last segment of the stream for appending, or the next
+			one if it's full. A segment left behind by a crash is cut back
+			to its last indexed record first."""
+
+		if self._data is not None:
+			self._data.close()
+			self._index.close()
+		self._pid = os.getpid()
+		stream = self._stream or '%s-%d' %(socket.gethostname(), self._pid)
+		segments = self.segments(stream)
+		number = segments[-1] if segments else 0
+		path = self._path(stream, number)
+		if os.path.exists(path) and \
+		   os.path.getsize(path) >= self._segment_bytes:
+			number += 1
+			path = self._path(stream, number)
+		entries = self._entries(path)
+		end = entries[-1][0] + entries[-1][1] if entries else 0
+		self._data = open(path, 'ab')
+		self._data.truncate(end)
+		self._data.seek(end)
+		self._index = open(path + '.idx', 'ab')
+		self._index.truncate(sum(len('%d %d\n' % entry)
+								 for entry in entries))
+		self._number = number
+		log.debug('Response log: appending to %s.', path)
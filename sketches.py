@@ -0,0 +1,317 @@
+""" MinHash signatures and HyperLogLog counters of users' follower sets,
+for estimating audience overlap and combined reach without joining the
+follower table.
+
+Both sketches only ever grow by merging, a minimum per MinHash slot and a
+maximum per HyperLogLog register, so they are updated a page of followers
+at a time as the followers are stored, and adding a follower twice changes
+nothing. Removing followers needs a rebuild from the follower table.
+
+The sketch of a user whose followers were sampled covers the sample only.
+Sizes and reach are scaled up by the users' follower sample rates, while
+Jaccard similarities are those of the samples.
+
+	python sketches.py rebuild
+	python sketches.py overlap <instagram_id> <instagram_id> [...]
+"""
+import sys
+import logging
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import text
+
+from db_setup import FollowerSketch, Follower, InstagramUser
+
+log = logging.getLogger(__name__)
+
+# MinHash slots, split into LSH_BANDS bands of NUM_HASHES/LSH_BANDS rows.
+NUM_HASHES = 128
+LSH_BANDS = 32
+# HyperLogLog registers are 2**HLL_PRECISION, about 1.6% standard error.
+HLL_PRECISION = 12
+
+_PRIME = np.uint64(2**31 - 1)
+_random = np.random.RandomState(20160301)
+_A = _random.randint(1, 2**31 - 1, size=NUM_HASHES).astype(np.uint64)
+_B = _random.randint(0, 2**31 - 1, size=NUM_HASHES).astype(np.uint64)
+_EMPTY_MINHASH = np.full(NUM_HASHES, 2**32 - 1, dtype=np.uint32)
+
+UPSERT = text("""
+	INSERT INTO follower_sketch (instagram_id, minhash, hll, updated_at)
+	VALUES (:instagram_id, :minhash, :hll, :updated_at)
+	ON CONFLICT (instagram_id) DO UPDATE
+	SET minhash = EXCLUDED.minhash, hll = EXCLUDED.hll,
+		updated_at = EXCLUDED.updated_at""")
+
+# Creates an empty sketch, so there is always a row to lock.
+CREATE = text("""
+	INSERT INTO follower_sketch (instagram_id, minhash, hll, updated_at)
+	VALUES (:instagram_id, :minhash, :hll, :updated_at)
+	ON CONFLICT (instagram_id) DO NOTHING""")
+
+
+def _mix(ids):
+	""" Scramble 64 bit ids with the splitmix64 finalizer."""
+
+	x = np.asarray(ids, dtype=np.int64).astype(np.uint64)
+	x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+	x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+	return x ^ (x >> np.uint64(31))
+
+def minhash(ids, chunk_size=10000):
+	""" Return the MinHash signature of a set of instagram ids."""
+
+	signature = _EMPTY_MINHASH.copy()
+	ids = np.asarray(ids, dtype=np.int64)
+	for start in xrange(0, len(ids), chunk_size):
+		x = _mix(ids[start:start + chunk_size]) % _PRIME
+		hashes = (_A[:, None]*x[None, :] + _B[:, None]) % _PRIME
+		signature = np.minimum(signature, hashes.min(axis=1).astype(np.uint32))
+	return signature
+
+def hll(ids):
+	""" Return the HyperLogLog registers of a set of instagram ids."""
+
+	registers = np.zeros(2**HLL_PRECISION, dtype=np.uint8)
+	if not len(ids):
+		return registers
+	hashes = _mix(ids)
+	index = (hashes >> np.uint64(64 - HLL_PRECISION)).astype(np.int64)
+	rest = hashes & np.uint64(2**(64 - HLL_PRECISION) - 1)
+	# The rank is the position of the first set bit of the remaining bits.
+	length = np.zeros(len(rest), dtype=np.int64)
+	for shift in (32, 16, 8, 4, 2, 1):
+		high = rest >= np.uint64(2**shift)
+		rest = np.where(high, rest >> np.uint64(shift), rest)
+		length += np.where(high, shift, 0)
+	length += (rest > 0)
+	rank = (64 - HLL_PRECISION - length + 1).astype(np.uint8)
+	np.maximum.at(registers, index, rank)
+	return registers
+
+def jaccard(signature, other):
+	""" Estimate the Jaccard similarity of two sets from their
+		signatures."""
+
+	return float(np.mean(signature == other))
+
+def cardinality(registers):
+	""" Estimate the number of distinct ids counted by HyperLogLog
+		registers."""
+
+	m = float(len(registers))
+	alpha = .7213/(1 + 1.079/m)
+	estimate = alpha*m*m/np.sum(np.power(2., -registers.astype(np.float64)))
+	zeros = int(np.sum(registers == 0))
+	if estimate <= 2.5*m and zeros:
+		# Linear counting is more accurate for small sets.
+		return m*np.log(m/zeros)
+	return float(estimate)
+
+def union(registers_list):
+	""" Merge HyperLogLog registers into the registers of the union."""
+
+	return np.maximum.reduce([registers for registers in registers_list])
+
+
+class Sketch(object):
+	""" The MinHash signature and HyperLogLog registers of a follower set,
+		and the share of the followers it covers."""
+
+	def __init__(self, minhash=None, hll=None, rate=1.):
+		self.minhash = _EMPTY_MINHASH.copy() if minhash is None else minhash
+		self.hll = np.zeros(2**HLL_PRECISION, dtype=np.uint8) if hll is None \
+				   else hll
+		self.rate = rate
+
+	@classmethod
+	def of(cls, ids):
+		return cls(minhash(ids), hll(ids))
+
+	@classmethod
+	def from_row(cls, row, rate=None):
+		return cls(np.frombuffer(row.minhash, dtype=np.uint32).copy(),
+				   np.frombuffer(row.hll, dtype=np.uint8).copy(),
+				   rate or 1.)
+
+	def merge(self, other):
+		self.minhash = np.minimum(self.minhash, other.minhash)
+		self.hll = np.maximum(self.hll, other.hll)
+		return self
+
+	def size(self):
+		return cardinality(self.hll)/self.rate
+
+
+################################################################
+#################           Storage            #################
+################################################################
+
+def _save(session, instagram_id, sketch, statement=UPSERT):
+	session.execute(statement, {'instagram_id': instagram_id,
+								'minhash': buffer(sketch.minhash.tostring()),
+								'hll': buffer(sketch.hll.tostring()),
+								'updated_at': datetime.now()})
+
+def add_followers(session, instagram_id, follower_ids):
+	""" Merge a page of follower ids into a user's stored sketch, creating
+		it if needed, and commit. The row is created empty first and locked
+		before merging, so concurrent pages of a new user are all kept."""
+
+	if not len(follower_ids):
+		return
+	sketch = Sketch.of([int(follower_id) for follower_id in follower_ids])
+	_save(session, instagram_id, Sketch(), CREATE)
+	stored = session.query(FollowerSketch)\
+					.filter_by(instagram_id=instagram_id)\
+					.with_for_update()\
+					.one()
+	sketch.merge(Sketch.from_row(stored))
+	_save(session, instagram_id, sketch)
+	session.commit()
+
+def rebuild(session, instagram_id):
+	""" Recompute a user's sketch from their stored followers, after
+		followers were removed."""
+
+	followers = session.query(Follower.follower_id)\
+					   .filter_by(instagram_id=instagram_id)
+	_save(session, instagram_id,
+		  Sketch.of([follower_id for follower_id, in followers]))
+	session.commit()
+
+def rebuild_all(session):
+	""" Recompute the sketch of every user with stored followers."""
+
+	users = session.query(Follower.instagram_id).distinct().all()
+	for instagram_id, in users:
+		rebuild(session, instagram_id)
+	log.info('Sketches: rebuilt %d sketches.', len(users))
+	return len(users)
+
+def load(session, instagram_ids=None):
+	""" Return a dict of Sketch by instagram id, of the given users or of
+		every user with a sketch, with their follower sample rates."""
+
+	rows = session.query(FollowerSketch, InstagramUser.follower_sample_rate)\
+				  .outerjoin(InstagramUser, InstagramUser.instagram_id ==
+											FollowerSketch.instagram_id)
+	if instagram_ids is not None:
+		rows = rows.filter(FollowerSketch.instagram_id.in_(
+											list(instagram_ids)))
+	return dict((row.instagram_id, Sketch.from_row(row, rate))
+				for row, rate in rows)
+
+
+################################################################
+#################           Queries            #################
+################################################################
+
+def _reach(sketches):
+	""" Estimate the distinct followers of the union of sketches. The
+		union of samples is scaled up by the combined rate of the samples,
+		the ratio of the ids they hold to the followers they stand for."""
+
+	reach = cardinality(union([sketch.hll for sketch in sketches]))
+	sampled = [cardinality(sketch.hll) for sketch in sketches]
+	total = sum(size/sketch.rate for size, sketch in zip(sampled, sketches))
+	if total and sum(sampled) < total:
+		reach *= total/sum(sampled)
+	return reach
+
+def overlap(sketches, instagram_id, other_id):
+	""" Estimate the audience overlap of two users as a dict with the
+		Jaccard similarity of their followers, the number of followers
+		they share and the size of their combined audience."""
+
+	a, b = sketches[instagram_id], sketches[other_id]
+	similarity = jaccard(a.minhash, b.minhash)
+	reach = _reach([a, b])
+	return {'jaccard': similarity,
+			'shared': similarity*reach,
+			'reach': reach}
+
+def union_reach(sketches, instagram_ids):
+	""" Estimate the number of distinct followers of a set of users, the
+		combined unique reach of a campaign's influencers."""
+
+	return _reach([sketches[instagram_id] for instagram_id in instagram_ids])
+
+
+class LSHIndex(object):
+	""" Locality sensitive hashing over MinHash signatures. Signatures are
+		cut into LSH_BANDS bands and users that agree on a whole band land
+		in the same bucket, so pairs above a similarity of roughly
+		(1/LSH_BANDS)**(LSH_BANDS/NUM_HASHES) are found without comparing
+		every pair."""
+
+	def __init__(self, sketches):
+		self._sketches = sketches
+		self._buckets = {}
+		rows = NUM_HASHES//LSH_BANDS
+		for instagram_id, sketch in sketches.iteritems():
+			for band in xrange(LSH_BANDS):
+				key = (band, sketch.minhash[band*rows:(band + 1)*rows]
+								   .tostring())
+				self._buckets.setdefault(key, []).append(instagram_id)
+
+	def candidates(self, instagram_id):
+		""" Return the users sharing a bucket with the given user."""
+
+		rows = NUM_HASHES//LSH_BANDS
+		signature = self._sketches[instagram_id].minhash
+		found = set()
+		for band in xrange(LSH_BANDS):
+			key = (band, signature[band*rows:(band + 1)*rows].tostring())
+			found.update(self._buckets.get(key, ()))
+		found.discard(instagram_id)
+		return found
+
+	def nearest(self, instagram_id, k=10):
+		""" Return the k users with the most similar audience, as a list
+			of (instagram_id, jaccard) tuples, most similar first."""
+
+		signature = self._sketches[instagram_id].minhash
+		scored = [(other_id, jaccard(signature,
+									 self._sketches[other_id].minhash))
+				  for other_id in self.candidates(instagram_id)]
+		scored.sort(key=lambda item: -item[1])
+		return scored[:k]
+
+	def similar_pairs(self, threshold=.5):
+		""" Return every pair of users with an estimated Jaccard similarity
+			of at least threshold, as (instagram_id, instagram_id, jaccard)
+			tuples."""
+
+		pairs = set()
+		for members in self._buckets.itervalues():
+			for i, instagram_id in enumerate(members):
+				for other_id in members[i + 1:]:
+					pairs.add((min(instagram_id, other_id),
+							   max(instagram_id, other_id)))
+		similar = []
+		for instagram_id, other_id in pairs:
+			similarity = jaccard(self._sketches[instagram_id].minhash,
+								 self._sketches[other_id].minhash)
+			if similarity >= threshold:
+				similar.append((instagram_id, other_id, similarity))
+		similar.sort(key=lambda item: -item[2])
+		return similar
+
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.INFO)
+	import models
+	if sys.argv[1:2] == ['rebuild']:
+		rebuild_all(models.session)
+	elif sys.argv[1:2] == ['overlap']:
+		ids = [int(instagram_id) for instagram_id in sys.argv[2:]]
+		sketches = load(models.session, ids)
+		for i, instagram_id in enumerate(ids):
+			for other_id in ids[i + 1:]:
+				estimate = overlap(sketches, instagram_id, other_id)
+				print '%d\t%d\t%.3f\t%d' %(instagram_id, other_id,
+											estimate['jaccard'],
+											estimate['shared'])
+		print 'Combined reach: %d' % union_reach(sketches, ids)
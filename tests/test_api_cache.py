@@ -0,0 +1,106 @@
+import unittest
+
+from api_cache import ResponseCache, CachedAPI
+
+
+class FakeClock(object):
+
+	def __init__(self, now=1000.):
+		self.now = now
+
+	def __call__(self):
+		return self.now
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = FakeClock()
+
+	def cache(self, **kwargs):
+		return ResponseCache(':memory:', ttls={'user': 60},
+							 clock=self.clock, **kwargs)
+
+	def test_fresh_until_the_ttl(self):
+		cache = self.cache()
+		cache.put('user', 'user:1', {'username': 'a'})
+		self.clock.now += 60
+		self.assertEqual(cache.get('user', 'user:1'),
+						 (True, {'username': 'a'}))
+		self.clock.now += 1
+		self.assertEqual(cache.get('user', 'user:1'), (False, None))
+
+	def test_put_replaces_and_refreshes(self):
+		cache = self.cache()
+		cache.put('user', 'user:1', 'old')
+		self.clock.now += 50
+		cache.put('user', 'user:1', 'new')
+		self.clock.now += 50
+		self.assertEqual(cache.get('user', 'user:1'), (True, 'new'))
+		self.assertEqual(cache.stats()['entries'], 1)
+
+	def test_evicts_the_least_recently_used(self):
+		cache = self.cache(max_entries=10)
+		for i in xrange(10):
+			self.clock.now += 1
+			cache.put('user', 'user:%d' % i, i)
+		# Reading the oldest entries makes them the most recently used.
+		for i in xrange(3):
+			self.clock.now += 1
+			cache.get('user', 'user:%d' % i)
+		self.clock.now += 1
+		cache.put('user', 'user:10', 10)
+		self.assertEqual(cache.stats()['entries'], 9)
+		found = [i for i in xrange(11)
+				 if cache.get('user', 'user:%d' % i)[0]]
+		self.assertEqual(found, [0, 1, 2, 5, 6, 7, 8, 9, 10])
+
+	def test_counts_hits_and_misses(self):
+		cache = self.cache()
+		cache.put('user', 'user:1', 1)
+		cache.get('user', 'user:1')
+		cache.get('user', 'user:2')
+		cache.get('user', 'user:2')
+		stats = cache.stats()
+		self.assertEqual((stats['hits'], stats['misses']), (1, 2))
+		self.assertAlmostEqual(stats['endpoints']['user']['hit_rate'], 1/3.)
+
+	def test_caches_the_listed_endpoints_only(self):
+		cache = self.cache()
+		self.assertTrue(cache.caches('user'))
+		self.assertFalse(cache.caches('user_followed_by'))
+
+
+class Client(object):
+
+	def __init__(self):
+		self.calls = []
+
+	def user(self, user_id):
+		self.calls.append(('user', user_id))
+		return {'id': user_id}
+
+	def user_followed_by(self, user_id):
+		self.calls.append(('user_followed_by', user_id))
+		return []
+
+
+class CachedAPITest(unittest.TestCase):
+
+	def setUp(self):
+		self.client = Client()
+		self.api = CachedAPI(self.client, ResponseCache(':memory:'))
+
+	def test_repeated_calls_reach_the_client_once(self):
+		self.assertEqual(self.api.user(user_id='123'), {'id': '123'})
+		self.assertEqual(self.api.user(user_id=123), {'id': '123'})
+		self.assertEqual(self.client.calls, [('user', '123')])
+
+	def test_other_endpoints_pass_through(self):
+		self.api.user_followed_by(user_id=1)
+		self.api.user_followed_by(user_id=1)
+		self.assertEqual(len(self.client.calls), 2)
+
+
+if __name__ == '__main__':
+	unittest.main()
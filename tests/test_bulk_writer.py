@@ -0,0 +1,94 @@
+import unittest
+
+from bulk_writer import BulkWriter
+
+
+class RecordingWriter(BulkWriter):
+	""" A BulkWriter that records the rows of each flush instead of
+		writing them."""
+
+	def __init__(self, *args, **kwargs):
+		BulkWriter.__init__(self, None, *args, **kwargs)
+		self.flushes = []
+
+	def flush(self):
+		rows, self._rows = self._rows, []
+		if rows:
+			self.flushes.append(rows)
+		return len(rows)
+
+
+class LastPerKeyTest(unittest.TestCase):
+
+	def writer(self, conflict_columns):
+		return BulkWriter(None, ['instagram_id', 'media_id', 'num_likes'],
+						  None, conflict_columns=conflict_columns,
+						  update_columns=['num_likes'])
+
+	def test_keeps_the_last_row_of_each_key_in_order(self):
+		rows = [(1, 'a', 1), (1, 'b', 1), (1, 'a', 2), (2, 'c', 5),
+				(1, 'b', 3)]
+		self.assertEqual(self.writer(['media_id'])._last_per_key(rows),
+						 [(1, 'a', 2), (2, 'c', 5), (1, 'b', 3)])
+
+	def test_keys_of_several_columns(self):
+		rows = [(1, 'a', 1), (2, 'a', 1), (1, 'a', 2)]
+		writer = self.writer(['instagram_id', 'media_id'])
+		self.assertEqual(writer._last_per_key(rows),
+						 [(2, 'a', 1), (1, 'a', 2)])
+
+	def test_distinct_keys_are_untouched(self):
+		rows = [(1, str(i), i) for i in xrange(100)]
+		self.assertEqual(self.writer(['media_id'])._last_per_key(rows), rows)
+
+
+class OnConflictTest(unittest.TestCase):
+
+	def writer(self, **kwargs):
+		return BulkWriter(None, ['instagram_id', 'bio', 'user_order'], None,
+						  conflict_columns=['instagram_id'], **kwargs)
+
+	def test_skips_duplicates_without_updates(self):
+		self.assertEqual(self.writer()._on_conflict(),
+						 'ON CONFLICT DO NOTHING')
+
+	def test_updates_and_merges(self):
+		writer = self.writer(update_columns=['bio'],
+							 update_expressions={'user_order':
+								 'LEAST(t.user_order, EXCLUDED.user_order)'})
+		self.assertEqual(writer._on_conflict(),
+						 'ON CONFLICT (instagram_id) DO UPDATE SET '
+						 'bio = EXCLUDED.bio, '
+						 'user_order = LEAST(t.user_order, '
+						 'EXCLUDED.user_order)')
+
+
+class BatchingTest(unittest.TestCase):
+
+	def writer(self):
+		return RecordingWriter(['instagram_id', 'follower_id'], None,
+							   batch_size=10)
+
+	def test_add_flushes_every_batch(self):
+		writer = self.writer()
+		for i in xrange(25):
+			writer.add(instagram_id=1, follower_id=i)
+		self.assertEqual([len(rows) for rows in writer.flushes], [10, 10])
+
+	def test_add_all_flushes_everything_at_once(self):
+		writer = self.writer()
+		writer.add_all(dict(instagram_id=1, follower_id=i)
+					   for i in xrange(25))
+		self.assertEqual([len(rows) for rows in writer.flushes], [25])
+
+	def test_add_all_keeps_a_short_batch_buffered(self):
+		writer = self.writer()
+		with writer:
+			writer.add_all(dict(instagram_id=1, follower_id=i)
+						   for i in xrange(5))
+			self.assertEqual(writer.flushes, [])
+		self.assertEqual(writer.flushes, [[(1, i) for i in xrange(5)]])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from captions import extract_hashtags, extract_mentions
+
+
+class ExtractHashtagsTest(unittest.TestCase):
+
+	def test_hashtags(self):
+		self.assertEqual(extract_hashtags('Morning run #Fitness #yoga_life!'),
+						 ['fitness', 'yoga_life'])
+
+	def test_unique_in_order(self):
+		self.assertEqual(extract_hashtags('#b #a #B #a'), ['b', 'a'])
+
+	def test_hashtags_inside_words_are_ignored(self):
+		self.assertEqual(extract_hashtags('issue#12 a#b # #'), [])
+
+	def test_adjacent_hashtags(self):
+		self.assertEqual(extract_hashtags('#one#two'), ['one'])
+
+	def test_unicode(self):
+		self.assertEqual(extract_hashtags(u'#Café #東京'), [u'café', u'東京'])
+
+	def test_empty(self):
+		self.assertEqual(extract_hashtags(None), [])
+		self.assertEqual(extract_hashtags(''), [])
+
+
+class ExtractMentionsTest(unittest.TestCase):
+
+	def test_mentions(self):
+		self.assertEqual(extract_mentions('Shot by @Jane.Doe, styled by '
+										  '@john_smith.'),
+						 ['jane.doe', 'john_smith'])
+
+	def test_trailing_periods_are_dropped(self):
+		self.assertEqual(extract_mentions('thanks @jane...'), ['jane'])
+
+	def test_email_addresses_are_ignored(self):
+		self.assertEqual(extract_mentions('mail jane@example.com'), [])
+		self.assertEqual(extract_mentions('@@jane'), [])
+
+	def test_unique(self):
+		self.assertEqual(extract_mentions('@Jane @jane @bob'), ['jane', 'bob'])
+
+	def test_empty(self):
+		self.assertEqual(extract_mentions(None), [])
+		self.assertEqual(extract_mentions('@ @.'), [])
+
+
+if __name__ == '__main__':
+	unittest.main()
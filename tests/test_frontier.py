@@ -0,0 +1,200 @@
+import unittest
+from datetime import datetime
+
+import frontier
+from frontier import CrawlRunner, enqueue, enqueue_refreshes, stale_users
+from db_setup import InstagramUser, CrawlTask
+
+
+class FakeQuery(object):
+
+	def __init__(self, session, entity):
+		self._session = session
+		self._entity = entity
+
+	def filter(self, *criteria):
+		return self
+
+	filter_by = order_by = filter
+
+	def update(self, values, synchronize_session=None):
+		self._session.updates.append((self._entity, values))
+		return self._session.updated
+
+	def all(self):
+		return self._session.rows.pop(0)
+
+
+class FakeSession(object):
+	""" Records the updates and commits of the queue functions, and answers
+		their queries with the given rows, in order."""
+
+	def __init__(self, rows=(), claimed=(), updated=1):
+		self.rows = list(rows)
+		self.claimed = list(claimed)
+		self.updated = updated
+		self.updates = []
+		self.executed = []
+		self.queries = 0
+		self.commits = 0
+
+	def query(self, entity, *entities):
+		self.queries += 1
+		return FakeQuery(self, entity)
+
+	def execute(self, statement, params):
+		self.executed.append(params)
+		return [(task_id,) for task_id in self.claimed]
+
+	def commit(self):
+		self.commits += 1
+
+
+class FakeWriter(object):
+
+	def __init__(self):
+		self.rows = []
+		self.flushes = 0
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.flush()
+
+	def add(self, **row):
+		self.rows.append(row)
+
+	def flush(self):
+		self.flushes += 1
+
+
+class FrontierTestCase(unittest.TestCase):
+
+	def setUp(self):
+		self._session = frontier.session
+		self._bulk_writer = frontier.bulk_writer
+		self._stale_users = frontier.stale_users
+		self.session = frontier.session = FakeSession()
+		self.writer = FakeWriter()
+		frontier.bulk_writer = lambda model, columns: self.writer
+
+	def tearDown(self):
+		frontier.session = self._session
+		frontier.bulk_writer = self._bulk_writer
+		frontier.stale_users = self._stale_users
+
+
+class EnqueueTest(FrontierTestCase):
+
+	def test_queues_the_tasks_of_the_order(self):
+		enqueue([7, 8], 2)
+		self.assertEqual([(row['instagram_id'], row['task'])
+						  for row in self.writer.rows],
+						 [(7, 'profile'), (7, 'media'), (7, 'follows'),
+						  (8, 'profile'), (8, 'media'), (8, 'follows')])
+		for row in self.writer.rows:
+			self.assertEqual((row['user_order'], row['status'],
+							  row['attempts']), (2, 'pending', 0))
+
+	def test_moves_existing_tasks_and_users_up(self):
+		enqueue([7], 1)
+		self.assertEqual(self.session.updates,
+						 [(CrawlTask, {'user_order': 1}),
+						  (InstagramUser, {'user_order': 1,
+										   'pull_completion': False})])
+		self.assertEqual(self.session.commits, 1)
+
+	def test_batches(self):
+		enqueue(range(frontier.BATCH_SIZE + 1), 3)
+		self.assertEqual(len(self.writer.rows),
+						 2*(frontier.BATCH_SIZE + 1))
+		# A flush per batch, and one as the writer closes.
+		self.assertEqual(self.writer.flushes, 3)
+		self.assertEqual(self.session.commits, 2)
+
+
+class StaleUsersTest(FrontierTestCase):
+
+	def test_estimates_a_call_per_page(self):
+		self.session.rows = [[(1, 1, 120), (2, 1, 50), (3, 1, 0),
+							  (4, 1, None)]]
+		self.assertEqual(list(stale_users('followers', datetime.now())),
+						 [(1, 1, 3), (2, 1, 1), (3, 1, 1), (4, 1, 1)])
+
+	def test_media_is_a_single_call(self):
+		self.session.rows = [[(1, 1, 500)], [], [(3, 3, 20)]]
+		self.assertEqual(list(stale_users('media', datetime.now())),
+						 [(1, 1, 1), (3, 3, 1)])
+		self.assertEqual(self.session.queries, 3)
+
+
+class EnqueueRefreshesTest(FrontierTestCase):
+
+	def setUp(self):
+		super(EnqueueRefreshesTest, self).setUp()
+		due = {'followers': [(1, 1, 3)],
+			   'follows': [(2, 2, 1), (1, 1, 2)],
+			   'media': [(3, 3, 1), (2, 2, 1)]}
+		frontier.stale_users = lambda direction, now: iter(due[direction])
+
+	def queued(self):
+		return [(row['instagram_id'], row['task'], row['user_order'])
+				for row in self.writer.rows]
+
+	def test_lower_orders_first(self):
+		self.assertEqual(enqueue_refreshes(), 5)
+		self.assertEqual(self.queued(),
+						 [(1, 'refresh_followers', 1),
+						  (1, 'refresh_follows', 1),
+						  (2, 'refresh_follows', 2),
+						  (2, 'refresh_media', 2),
+						  (3, 'refresh_media', 3)])
+
+	def test_budget(self):
+		# The order 1 follows don't fit after the followers, but the
+		# cheaper refreshes after them still do.
+		self.assertEqual(enqueue_refreshes(budget=4), 2)
+		self.assertEqual(self.queued(),
+						 [(1, 'refresh_followers', 1),
+						  (2, 'refresh_follows', 2)])
+
+	def test_resets_finished_refreshes(self):
+		now = datetime.now()
+		enqueue_refreshes(budget=4, now=now)
+		reset = {'status': 'pending', 'attempts': 0, 'cursor': None,
+				 'error': None, 'updated_at': now}
+		self.assertEqual(self.session.updates,
+						 [(CrawlTask, reset), (CrawlTask, reset)])
+
+	def test_nothing_due(self):
+		frontier.stale_users = lambda direction, now: iter([])
+		self.assertEqual(enqueue_refreshes(), 0)
+		self.assertEqual(self.session.updates, [])
+
+
+class ClaimTest(FrontierTestCase):
+
+	def test_claims_for_the_worker(self):
+		self.session.claimed = [3, 1]
+		self.session.rows = [['task 1', 'task 3']]
+		runner = CrawlRunner(worker='w1')
+		self.assertEqual(runner._claim(10), ['task 1', 'task 3'])
+		(params,) = self.session.executed
+		self.assertEqual((params['worker'], params['limit']), ('w1', 10))
+		self.assertEqual(self.session.commits, 1)
+
+	def test_nothing_to_claim(self):
+		self.assertEqual(CrawlRunner(worker='w1')._claim(10), [])
+		self.assertEqual(self.session.queries, 0)
+
+	def test_skips_tasks_reset_while_waiting(self):
+		self.session.updated = 0
+		task = CrawlTask(id=1, instagram_id=7, task='media', user_order=2)
+		CrawlRunner(worker='w1')._run_task(task)
+		self.assertEqual(len(self.session.updates), 1)
+		self.assertEqual(task.status, None)
+
+
+if __name__ == '__main__':
+	unittest.main()
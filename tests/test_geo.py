@@ -0,0 +1,70 @@
+import unittest
+
+import geo
+
+
+class EncodeTest(unittest.TestCase):
+
+	def test_known_geohashes(self):
+		self.assertEqual(geo.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+		self.assertEqual(geo.encode(42.6, -5.6, 5), 'ezs42')
+
+	def test_prefixes_are_the_shorter_geohashes(self):
+		geohash = geo.encode(40.73, -73.99)
+		self.assertEqual(len(geohash), geo.PRECISION)
+		for precision in xrange(1, geo.PRECISION):
+			self.assertEqual(geo.encode(40.73, -73.99, precision),
+							 geohash[:precision])
+
+	def test_no_coordinates(self):
+		self.assertEqual(geo.encode(None, 10.), None)
+		self.assertEqual(geo.encode(10., None), None)
+
+	def test_cell_size(self):
+		self.assertEqual(geo.cell_size(1), (45., 45.))
+		self.assertEqual(geo.cell_size(2), (180./32, 360./32))
+
+
+class CoverTest(unittest.TestCase):
+
+	def assertCovers(self, box, max_cells=16):
+		south, west, north, east = box
+		cells = geo.covering_cells(south, west, north, east, max_cells)
+		self.assertTrue(0 < len(cells) <= max_cells)
+		steps = 20
+		for i in xrange(steps + 1):
+			latitude = south + (north - south)*i/steps
+			for j in xrange(steps + 1):
+				longitude = west + (east - west)*j/steps
+				geohash = geo.encode(latitude, longitude)
+				self.assertTrue(any(geohash.startswith(cell)
+									for cell in cells),
+								(latitude, longitude, cells))
+		return cells
+
+	def test_covers_small_and_large_boxes(self):
+		small = self.assertCovers(geo.bounding_box(40.73, -73.99, .5))
+		large = self.assertCovers(geo.bounding_box(40.73, -73.99, 200))
+		self.assertTrue(len(small[0]) > len(large[0]))
+
+	def test_covers_boxes_on_cell_edges(self):
+		self.assertCovers((-10., -10., 10., 10.))
+		self.assertCovers((0., 0., 45., 45.), max_cells=4)
+		self.assertCovers((80., 170., 90., 180.))
+
+	def test_bounding_box_reaches_the_radius(self):
+		south, west, north, east = geo.bounding_box(40.73, -73.99, 10)
+		self.assertAlmostEqual(geo.distance_km(40.73, -73.99, north, -73.99),
+							   10, places=6)
+		self.assertAlmostEqual(geo.distance_km(40.73, -73.99, south, -73.99),
+							   10, places=6)
+		# To the meter: the widest point of the circle isn't quite on the
+		# parallel of the center.
+		self.assertAlmostEqual(geo.distance_km(40.73, -73.99, 40.73, east),
+							   10, places=3)
+		self.assertAlmostEqual(geo.distance_km(40.73, -73.99, 40.73, west),
+							   10, places=3)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+
+import numpy as np
+
+from graph import gather
+
+
+class GatherTest(unittest.TestCase):
+
+	def setUp(self):
+		# 0 -> 1, 2; 1 -> nothing; 2 -> 0; 3 -> 0, 1, 2
+		self.indptr = np.array([0, 2, 2, 3, 6], dtype=np.int64)
+		self.indices = np.array([1, 2, 0, 0, 1, 2], dtype=np.int32)
+
+	def test_neighbours_and_origins(self):
+		neighbours, origins = gather(self.indptr, self.indices, [3, 1, 0])
+		self.assertEqual(neighbours.tolist(), [0, 1, 2, 1, 2])
+		self.assertEqual(origins.tolist(), [0, 0, 0, 2, 2])
+		self.assertEqual(neighbours.dtype, self.indices.dtype)
+
+	def test_repeated_rows(self):
+		neighbours, origins = gather(self.indptr, self.indices, [2, 2])
+		self.assertEqual(neighbours.tolist(), [0, 0])
+		self.assertEqual(origins.tolist(), [0, 1])
+
+	def test_no_neighbours(self):
+		for rows in ([], [1], [1, 1]):
+			neighbours, origins = gather(self.indptr, self.indices, rows)
+			self.assertEqual(len(neighbours), 0)
+			self.assertEqual(len(origins), 0)
+
+	def test_matches_a_loop_over_rows(self):
+		random = np.random.RandomState(0)
+		counts = random.randint(0, 5, size=100)
+		indptr = np.concatenate([[0], np.cumsum(counts)])
+		indices = random.randint(0, 100, size=indptr[-1])
+		rows = random.randint(0, 100, size=50)
+		neighbours, origins = gather(indptr, indices, rows)
+		expected = [(indices[j], i) for i, row in enumerate(rows)
+					for j in xrange(indptr[row], indptr[row + 1])]
+		self.assertEqual(zip(neighbours.tolist(), origins.tolist()),
+						 [(int(n), i) for n, i in expected])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+import cnfg
+
+import models
+
+
+def missing(filename):
+	raise IOError(2, 'No such file or directory', filename)
+
+
+class ConfigTest(unittest.TestCase):
+
+	def setUp(self):
+		self._load = cnfg.load
+		self._state = (models._config, models._scheduler, models._cache,
+					   models._api)
+		cnfg.load = missing
+		models._config = None
+		models.config._clear()
+
+	def tearDown(self):
+		cnfg.load = self._load
+		(models._config, models._scheduler, models._cache,
+		 models._api) = self._state
+		for lazy in (models.config, models.scheduler, models.cache,
+					 models.api):
+			lazy._clear()
+
+	def test_a_missing_config_is_empty(self):
+		self.assertEqual(models.get_config(), {})
+		self.assertEqual(models.config.get('RATE_LIMIT', 5000), 5000)
+
+	def test_configure_needs_no_config(self):
+		class Client(object):
+			x_ratelimit = 100
+		models.configure(client=Client())
+		self.assertEqual(models.scheduler.remaining(), 100)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+
+import planner
+from planner import CrawlPlanner
+from models import UserState
+
+# A pull of an unknown user: profile, 5 pages of media and 3 of follows at
+# the default averages.
+UNKNOWN_COST = 1 + 5 + 3
+
+
+class Planner(CrawlPlanner):
+	""" A CrawlPlanner over the given stored edge counts and followers,
+		without a database."""
+
+	def __init__(self, stored=None, followers=None, max_followers=100,
+				 sampling='cap'):
+		self._calls_per_hour = 5000.
+		self._latency = .3
+		self._workers = 1
+		self._max_media_pages = 5
+		self._max_followers = max_followers
+		self._sampling = sampling
+		self._mean_following = 150.
+		self._mean_posts = 100.
+		self._stored = stored or {}
+		self._follower_lists = followers or {}
+
+	def _stored_edges(self, instagram_id):
+		return self._stored.get(instagram_id, {'followers': 0, 'follows': 0})
+
+	def _followers(self, instagram_id):
+		return self._follower_lists.get(instagram_id, [])
+
+
+class CrawlPlannerTest(unittest.TestCase):
+
+	def setUp(self):
+		self.states = {}
+		self._user_states = planner.user_states
+		planner.user_states = lambda instagram_ids: \
+			dict((instagram_id, self.states[instagram_id])
+				 for instagram_id in instagram_ids
+				 if instagram_id in self.states)
+
+	def tearDown(self):
+		planner.user_states = self._user_states
+
+	def estimate(self, planner, instagram_id=1):
+		return planner.plan([instagram_id])['influencers'][0]
+
+	def test_unknown_influencer_is_bounded_by_the_cap(self):
+		estimate = self.estimate(Planner())
+		self.assertFalse(estimate['known'])
+		self.assertTrue(estimate['bound'])
+		# Two pages of followers and an order 2 pull of each.
+		self.assertEqual(estimate['calls'],
+						 UNKNOWN_COST + 2 + 100*UNKNOWN_COST)
+		self.assertEqual(estimate['users'], 101)
+		self.assertEqual(estimate['edges'], 150 + 100*(1 + 150))
+
+	def test_unknown_influencer_without_a_bound(self):
+		estimate = self.estimate(Planner(sampling='reservoir'))
+		self.assertFalse(estimate['bound'])
+		self.assertEqual(estimate['calls'],
+						 UNKNOWN_COST + 2 + 100*UNKNOWN_COST)
+		estimate = self.estimate(Planner(max_followers=None))
+		self.assertFalse(estimate['bound'])
+		self.assertEqual(estimate['calls'], UNKNOWN_COST)
+
+	def test_known_influencer(self):
+		self.states[1] = UserState(1, False, 1000, 100)
+		# Complete, order 3 and not stored.
+		self.states[11] = UserState(2, True, 10, 40)
+		self.states[12] = UserState(3, False, 10, 120)
+		estimate = self.estimate(Planner(followers={1: [11, 12, 13]}))
+		self.assertTrue(estimate['known'])
+		self.assertFalse(estimate['bound'])
+		# Followers up to the cap, follows, the two incomplete followers
+		# and the 97 followers not stored yet.
+		self.assertEqual(estimate['calls'],
+						 2 + 2 + 0 + 3 + UNKNOWN_COST + 97*UNKNOWN_COST)
+		self.assertEqual(estimate['followers_per_call'],
+						 1000/float(estimate['calls']))
+
+	def test_stored_edges_cost_nothing(self):
+		self.states[1] = UserState(1, False, 100, 100)
+		estimate = self.estimate(Planner(
+			stored={1: {'followers': 95, 'follows': 105}},
+			followers={1: range(100, 195)}))
+		# Every follower is unknown, but the lists needn't be fetched.
+		self.assertEqual(estimate['calls'], 100*UNKNOWN_COST)
+
+	def test_complete_influencer(self):
+		self.states[1] = UserState(1, True, 1000, 100)
+		self.assertEqual(self.estimate(Planner())['calls'], 0)
+
+	def test_shared_followers_are_pulled_once(self):
+		self.states[1] = UserState(1, False, 1, 0)
+		self.states[2] = UserState(1, False, 1, 0)
+		plan = Planner(max_followers=1, followers={1: [13], 2: [13]})\
+			   .plan([1, 2])
+		self.assertFalse(plan['bound'])
+		# One page of followers each, and the follower's pull once.
+		self.assertEqual(plan['calls'], 1 + 1 + UNKNOWN_COST)
+		self.assertEqual(plan['follower_order'], [13])
+		self.assertTrue(Planner().plan([1, 3])['bound'])
+
+
+if __name__ == '__main__':
+	unittest.main()
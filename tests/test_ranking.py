@@ -0,0 +1,73 @@
+import unittest
+from collections import Counter
+
+import numpy as np
+
+from graph import FollowerGraph
+from ranking import CandidateRanker
+
+
+def random_graph(num_users=200, num_edges=3000, seed=0):
+	random = np.random.RandomState(seed)
+	# Skewed towards low ids, so some accounts are followed by many.
+	followed = (random.pareto(1., size=num_edges)*10).astype(np.int64) \
+			   % num_users
+	followers = random.randint(0, num_users, size=num_edges)
+	keep = followers != followed
+	edges = set(zip(followers[keep] + 10**9, followed[keep] + 10**9))
+	followers, followed = zip(*sorted(edges))
+	return FollowerGraph.from_edges(followers, followed), edges
+
+
+class RankTest(unittest.TestCase):
+
+	def setUp(self):
+		self.graph, self.edges = random_graph()
+
+	def test_counts_match_the_edges(self):
+		influencer = 10**9
+		followers = set(follower for follower, followed in self.edges
+						if followed == influencer)
+		expected = Counter(followed for follower, followed in self.edges
+						   if follower in followers and
+							  followed != influencer)
+		ranking = CandidateRanker(self.graph, min_count=1)\
+				  .rank(influencer, k=len(self.graph))
+		self.assertEqual(dict((instagram_id, count)
+							  for instagram_id, count, _ in ranking),
+						 dict(expected))
+		counts = [count for _, count, _ in ranking]
+		self.assertEqual(counts, sorted(counts, reverse=True))
+
+	def assertSameRankings(self, ranker, instagram_ids, **kwargs):
+		rankings = ranker.rank_many(instagram_ids, **kwargs)
+		present = [instagram_id for instagram_id in instagram_ids
+				   if self.graph.nodes([instagram_id])[0] >= 0]
+		self.assertEqual(sorted(rankings), sorted(present))
+		for instagram_id in present:
+			self.assertEqual(rankings[instagram_id],
+							 ranker.rank(instagram_id, k=kwargs.get('k', 20)))
+
+	def test_rank_many_matches_rank(self):
+		instagram_ids = [10**9 + i for i in xrange(0, 200, 7)]
+		self.assertSameRankings(CandidateRanker(self.graph), instagram_ids)
+		self.assertSameRankings(CandidateRanker(self.graph), instagram_ids,
+								k=5, batch_size=3)
+
+	def test_rank_many_with_popularity_and_sample_rates(self):
+		random = np.random.RandomState(1)
+		ranker = CandidateRanker(self.graph,
+						popularity=random.randint(1, 1000,
+												  size=len(self.graph)),
+						sample_rates=random.uniform(.1, 1.,
+													size=len(self.graph)))
+		self.assertSameRankings(ranker, [10**9 + i for i in xrange(50)],
+								k=10, batch_size=8)
+
+	def test_rank_many_leaves_out_unknown_influencers(self):
+		self.assertSameRankings(CandidateRanker(self.graph),
+								[10**9, 42, 10**9 + 1, 43], batch_size=2)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,208 @@
+import socket
+import httplib
+import unittest
+
+from instagram.bind import InstagramAPIError, InstagramClientError
+
+from rate_limit import (RequestScheduler, ConcurrencyController,
+						classify_error, PRIVATE, NOT_FOUND, RATE_LIMITED,
+						TRANSIENT, FATAL)
+
+
+class FakeClock(object):
+	""" A clock that only moves when told to, or when slept on."""
+
+	def __init__(self, now=1000.):
+		self.now = now
+		self.sleeps = []
+
+	def __call__(self):
+		return self.now
+
+	def sleep(self, seconds):
+		self.sleeps.append(seconds)
+		self.now += seconds
+
+
+class FlakyClient(object):
+	""" Fails the first failures calls of user() with error, then
+		answers them."""
+
+	def __init__(self, error, failures):
+		self._error = error
+		self._failures = failures
+		self.calls = 0
+
+	def user(self, instagram_id):
+		self.calls += 1
+		if self.calls <= self._failures:
+			raise self._error
+		return instagram_id
+
+
+class TokenBucketTest(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = FakeClock()
+		self.scheduler = RequestScheduler(limit=3600, window=3600,
+										  clock=self.clock,
+										  sleep=self.clock.sleep)
+
+	def test_starts_full(self):
+		self.assertEqual(self.scheduler.remaining(), 3600)
+
+	def test_calls_take_tokens(self):
+		for _ in xrange(10):
+			self.scheduler.acquire()
+			self.scheduler.release()
+		self.assertEqual(self.scheduler.remaining(), 3590)
+
+	def test_refills_at_limit_per_window(self):
+		for _ in xrange(10):
+			self.scheduler.acquire()
+			self.scheduler.release()
+		self.clock.now += 4
+		self.assertEqual(self.scheduler.remaining(), 3594)
+		self.clock.now += 3600
+		self.assertEqual(self.scheduler.remaining(), 3600)
+
+	def test_headers_correct_the_bucket(self):
+		self.scheduler.acquire()
+		self.scheduler.acquire()
+		# The call still in flight has yet to be counted by the server.
+		self.scheduler.release(remaining=100)
+		self.assertEqual(self.scheduler.remaining(), 99)
+
+	def test_headers_change_the_limit(self):
+		self.scheduler.acquire()
+		self.scheduler.release(remaining=10, limit=7200)
+		self.clock.now += 1
+		self.assertEqual(self.scheduler.remaining(), 12)
+
+
+class SchedulerCallTest(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = FakeClock()
+
+	def scheduler(self, max_retries=5):
+		return RequestScheduler(limit=5000, clock=self.clock,
+								max_retries=max_retries, retry_wait=1.,
+								sleep=self.clock.sleep)
+
+	def test_retries_transient_errors(self):
+		client = FlakyClient(socket.error('reset'), 2)
+		self.assertEqual(self.scheduler().call(client, 'user', 7), 7)
+		self.assertEqual(client.calls, 3)
+		self.assertEqual(len(self.clock.sleeps), 2)
+		for attempt, wait in enumerate(self.clock.sleeps):
+			self.assertTrue(0 <= wait <= 2**attempt)
+
+	def test_raises_once_retries_run_out(self):
+		client = FlakyClient(socket.error('reset'), 10)
+		self.assertRaises(socket.error, self.scheduler(max_retries=2).call,
+						  client, 'user', 7)
+		self.assertEqual(client.calls, 3)
+
+	def test_raises_fatal_errors_at_once(self):
+		client = FlakyClient(ValueError('bad'), 1)
+		self.assertRaises(ValueError, self.scheduler().call,
+						  client, 'user', 7)
+		self.assertEqual(client.calls, 1)
+		self.assertEqual(self.clock.sleeps, [])
+
+
+class ConcurrencyControllerTest(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = FakeClock()
+
+	def controller(self, **kwargs):
+		return ConcurrencyController(clock=self.clock, **kwargs)
+
+	def finish(self, controller, latency=None, error_kind=None):
+		controller.acquire()
+		controller.release(latency=latency, error_kind=error_kind)
+
+	def test_fast_calls_add_one_per_round(self):
+		controller = self.controller(initial=4, target_latency=1.)
+		for _ in xrange(4):
+			self.finish(controller, latency=.1)
+		self.assertEqual(controller.limit, 4)
+		self.finish(controller, latency=.1)
+		self.assertEqual(controller.limit, 5)
+
+	def test_slow_calls_hold_the_limit(self):
+		controller = self.controller(initial=4, target_latency=1.)
+		for _ in xrange(20):
+			self.finish(controller, latency=5.)
+		self.assertEqual(controller.limit, 4)
+
+	def test_errors_halve_once_per_cooldown(self):
+		controller = self.controller(initial=16, cooldown=1.)
+		self.finish(controller, error_kind=TRANSIENT)
+		self.assertEqual(controller.limit, 8)
+		self.finish(controller, error_kind=RATE_LIMITED)
+		self.assertEqual(controller.limit, 8)
+		self.clock.now += 1
+		self.finish(controller, error_kind=RATE_LIMITED)
+		self.assertEqual(controller.limit, 4)
+
+	def test_fatal_errors_leave_the_limit(self):
+		controller = self.controller(initial=16)
+		self.finish(controller, error_kind=FATAL)
+		self.assertEqual(controller.limit, 16)
+
+	def test_stays_within_bounds(self):
+		controller = self.controller(initial=2, minimum=1, maximum=3,
+									 cooldown=0.)
+		for _ in xrange(100):
+			self.finish(controller, latency=0.)
+		self.assertEqual(controller.limit, 3)
+		for _ in xrange(10):
+			self.finish(controller, error_kind=TRANSIENT)
+		self.assertEqual(controller.limit, 1)
+
+	def test_grow_to_never_shrinks_or_passes_the_maximum(self):
+		controller = self.controller(initial=4, maximum=8)
+		controller.grow_to(2)
+		self.assertEqual(controller.limit, 4)
+		controller.grow_to(100)
+		self.assertEqual(controller.limit, 8)
+
+
+class ClassifyErrorTest(unittest.TestCase):
+
+	def test_rate_limits(self):
+		self.assertEqual(classify_error(
+			InstagramAPIError(429, 'Rate limited', '')), RATE_LIMITED)
+		self.assertEqual(classify_error(
+			InstagramAPIError(400, 'OAuthRateLimitException', '')),
+			RATE_LIMITED)
+
+	def test_unreadable_users(self):
+		self.assertEqual(classify_error(
+			InstagramAPIError(400, 'APINotAllowedError', '')), PRIVATE)
+		self.assertEqual(classify_error(
+			InstagramAPIError(400, 'APINotFoundError', '')), NOT_FOUND)
+
+	def test_server_and_network_errors(self):
+		self.assertEqual(classify_error(
+			InstagramAPIError(500, 'Unknown', '')), TRANSIENT)
+		self.assertEqual(classify_error(
+			InstagramClientError('Unable to parse response', 502)),
+			TRANSIENT)
+		self.assertEqual(classify_error(socket.error('reset')), TRANSIENT)
+		self.assertEqual(classify_error(httplib.BadStatusLine('')),
+						 TRANSIENT)
+
+	def test_anything_else_is_fatal(self):
+		self.assertEqual(classify_error(
+			InstagramAPIError(400, 'OAuthAccessTokenException', '')), FATAL)
+		self.assertEqual(classify_error(
+			InstagramClientError('Unable to parse response', 400)), FATAL)
+		self.assertEqual(classify_error(ValueError('bad')), FATAL)
+
+
+if __name__ == '__main__':
+	unittest.main()
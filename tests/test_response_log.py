@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from response_log import ResponseLog
+
+
+class ResponseLogTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def log(self, **kwargs):
+		return ResponseLog(self.directory, stream='test', **kwargs)
+
+	def records(self, n, start=0):
+		return [{'kind': 'followers', 'instagram_id': i, 'data': [i, i + 1]}
+				for i in xrange(start, start + n)]
+
+	def test_round_trip(self):
+		response_log = self.log()
+		positions = [response_log.append(record)
+					 for record in self.records(5)]
+		response_log.close()
+		read = list(self.log().read('test'))
+		self.assertEqual([record for _, record in read], self.records(5))
+		# The position of a record is where the next one is read from.
+		self.assertEqual([position for position, _ in read][:-1],
+						 positions[1:])
+		self.assertEqual(self.log().streams(), ['test'])
+
+	def test_resumes_from_a_position(self):
+		response_log = self.log()
+		for record in self.records(5):
+			response_log.append(record)
+		response_log.close()
+		position = list(self.log().read('test'))[2][0]
+		self.assertEqual([record for _, record
+						  in self.log().read('test', position)],
+						 self.records(2, start=3))
+
+	def test_rolls_over_to_new_segments(self):
+		response_log = self.log(segment_bytes=100)
+		for record in self.records(10):
+			response_log.append(record)
+		response_log.close()
+		self.assertTrue(len(self.log().segments('test')) > 1)
+		self.assertEqual([record for _, record in self.log().read('test')],
+						 self.records(10))
+
+	def test_truncates_what_a_crash_left_behind(self):
+		response_log = self.log()
+		for record in self.records(3):
+			response_log.append(record)
+		response_log.close()
+		path = os.path.join(self.directory, 'test.000000.jsonl.gz')
+		# A record written but not indexed, and half an index line.
+		with open(path, 'ab') as data:
+			data.write('half a gzip member')
+		with open(path + '.idx', 'ab') as index:
+			index.write('12')
+		self.assertEqual([record for _, record in self.log().read('test')],
+						 self.records(3))
+		response_log = self.log()
+		response_log.append(self.records(1, start=3)[0])
+		response_log.close()
+		self.assertEqual([record for _, record in self.log().read('test')],
+						 self.records(4))
+		with open(path + '.idx', 'rb') as index:
+			entries = [map(int, line.split())
+					   for line in index.read().splitlines()]
+		self.assertEqual(len(entries), 4)
+		self.assertEqual(sum(entries[-1]), os.path.getsize(path))
+
+
+if __name__ == '__main__':
+	unittest.main()
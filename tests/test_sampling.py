@@ -0,0 +1,87 @@
+import random
+import unittest
+from collections import Counter
+
+from models import AddUserFollowers, with_heartbeat
+
+
+class Sampler(AddUserFollowers):
+	""" An AddUserFollowers that touches neither the api nor the database,
+		paging through the given pages of follower ids."""
+
+	def __init__(self, pages, max_followers):
+		self._instagram_id = 1
+		self._max_followers = max_followers
+		self._sampled = False
+		self._pages = pages
+
+	def _get_user_followers(self, cursor=None):
+		return iter([(page, None) for page in self._pages])
+
+
+def sample(pages, max_followers, stored=()):
+	followers = Sampler(pages, max_followers)
+	(page, next), = list(followers._sample_followers(None, set(stored)))
+	return page, followers._sampled
+
+
+class ReservoirSamplingTest(unittest.TestCase):
+
+	def setUp(self):
+		random.seed(20160301)
+
+	def test_keeps_everyone_under_the_cap(self):
+		page, sampled = sample([[1, 2, 3], [4, 5]], 10)
+		self.assertEqual(sorted(page), [1, 2, 3, 4, 5])
+		self.assertFalse(sampled)
+
+	def test_sample_is_capped_and_distinct(self):
+		page, sampled = sample([range(i, i + 10) for i in xrange(0, 100, 10)],
+							   15)
+		self.assertEqual(len(page), 15)
+		self.assertEqual(len(set(page)), 15)
+		self.assertTrue(set(page) <= set(xrange(100)))
+		self.assertTrue(sampled)
+
+	def assertUniform(self, followers, max_followers, stored=(), draws=4000):
+		counts = Counter()
+		for _ in xrange(draws):
+			page, _ = sample([followers], max_followers, stored)
+			self.assertEqual(len(page), max_followers)
+			counts.update(page)
+		expected = draws*max_followers/float(len(followers))
+		# Well over four standard deviations of each count.
+		for follower_id in followers:
+			self.assertTrue(abs(counts[follower_id] - expected) <
+							.15*expected, (follower_id, counts[follower_id]))
+
+	def test_uniform(self):
+		self.assertUniform(range(20), 5)
+
+	def test_uniform_with_a_full_stored_sample(self):
+		# The stored sample is already full, new followers still get in.
+		self.assertUniform(range(20), 5, stored=range(5))
+
+	def test_uniform_with_stored_followers_gone(self):
+		self.assertUniform(range(20), 5, stored=[0, 1, 100, 101, 102])
+
+
+class HeartbeatTest(unittest.TestCase):
+
+	def test_beats_as_each_page_comes_in(self):
+		beats = []
+		pages = with_heartbeat(iter([([1], 'b'), ([2], None)]),
+							   lambda: beats.append(len(beats)))
+		self.assertEqual(beats, [])
+		self.assertEqual(next(pages), ([1], 'b'))
+		self.assertEqual(beats, [0])
+		self.assertEqual(list(pages), [([2], None)])
+		self.assertEqual(beats, [0, 1])
+
+	def test_no_heartbeat(self):
+		self.assertEqual(list(with_heartbeat(iter([([1], None)]))),
+						 [([1], None)])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+
+import numpy as np
+
+import sketches
+from sketches import Sketch
+
+# Instagram ids are large, sparse integers.
+OFFSET = 10**9
+
+
+def ids(start, stop):
+	return np.arange(OFFSET + start, OFFSET + stop, dtype=np.int64)
+
+
+class MinHashTest(unittest.TestCase):
+
+	def assertJaccard(self, a, b, expected):
+		estimate = sketches.jaccard(sketches.minhash(a), sketches.minhash(b))
+		# Three standard errors of the NUM_HASHES slot estimate.
+		error = 3*np.sqrt(expected*(1 - expected)/sketches.NUM_HASHES)
+		self.assertTrue(abs(estimate - expected) <= max(error, 1e-9),
+						(estimate, expected))
+
+	def test_identical_and_disjoint_sets(self):
+		self.assertJaccard(ids(0, 1000), ids(0, 1000), 1.)
+		self.assertJaccard(ids(0, 1000), ids(1000, 2000), 0.)
+
+	def test_partial_overlap(self):
+		self.assertJaccard(ids(0, 10000), ids(5000, 15000), 1/3.)
+		self.assertJaccard(ids(0, 10000), ids(9000, 20000), .05)
+
+	def test_chunks_change_nothing(self):
+		a = ids(0, 2500)
+		self.assertTrue(np.array_equal(sketches.minhash(a),
+									   sketches.minhash(a, chunk_size=100)))
+
+
+class HyperLogLogTest(unittest.TestCase):
+
+	def assertCardinality(self, registers, expected):
+		# Three standard errors of 1.04/sqrt(2**HLL_PRECISION).
+		error = 3*1.04/np.sqrt(2**sketches.HLL_PRECISION)
+		estimate = sketches.cardinality(registers)
+		self.assertTrue(abs(estimate - expected) <= error*expected,
+						(estimate, expected))
+
+	def test_small_and_large_sets(self):
+		for size in (100, 1000, 20000, 200000):
+			self.assertCardinality(sketches.hll(ids(0, size)), size)
+
+	def test_empty_set(self):
+		self.assertEqual(sketches.cardinality(sketches.hll(ids(0, 0))), 0)
+
+	def test_duplicates_count_once(self):
+		a = ids(0, 5000)
+		self.assertTrue(np.array_equal(sketches.hll(np.concatenate([a, a])),
+									   sketches.hll(a)))
+
+	def test_union(self):
+		registers = sketches.union([sketches.hll(ids(0, 30000)),
+									sketches.hll(ids(20000, 50000))])
+		self.assertCardinality(registers, 50000)
+
+
+class SketchTest(unittest.TestCase):
+
+	def test_merging_pages_equals_the_whole(self):
+		merged = Sketch()
+		for start in xrange(0, 10000, 1000):
+			merged.merge(Sketch.of(ids(start, start + 1000)))
+		whole = Sketch.of(ids(0, 10000))
+		self.assertTrue(np.array_equal(merged.minhash, whole.minhash))
+		self.assertTrue(np.array_equal(merged.hll, whole.hll))
+
+	def test_size_scales_by_the_sample_rate(self):
+		sketch = Sketch.of(ids(0, 1000))
+		full = sketch.size()
+		sketch.rate = .1
+		self.assertAlmostEqual(sketch.size(), full*10)
+
+
+if __name__ == '__main__':
+	unittest.main()
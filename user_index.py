@@ -0,0 +1,86 @@
+import math
+import struct
+import hashlib
+import threading
+
+
+class BloomFilter(object):
+	""" A fixed size Bloom filter over strings. Membership tests never give
+		false negatives and give false positives at about error_rate once
+		capacity keys have been added."""
+
+	def __init__(self, capacity, error_rate=.01):
+		self._size = int(math.ceil(-capacity*math.log(error_rate)
+								   /math.log(2)**2))
+		self._hashes = max(1, int(round(self._size/float(capacity)
+										*math.log(2))))
+		self._bits = bytearray((self._size + 7)//8)
+
+	def add(self, key):
+		for position in self._positions(key):
+			self._bits[position >> 3] |= 1 << (position & 7)
+
+	def __contains__(self, key):
+		for position in self._positions(key):
+			if not self._bits[position >> 3] & (1 << (position & 7)):
+				return False
+		return True
+
+	def _positions(self, key):
+		# Double hashing: two 64 bit halves of one digest give every hash.
+		first, second = struct.unpack('<QQ', hashlib.md5(str(key)).digest())
+		for i in xrange(self._hashes):
+			yield (first + i*second) % self._size
+
+
+class KnownUserIndex(object):
+	""" The instagram ids stored in the instagram_user table, held in
+		process so lookups of unknown users skip the database. By default
+		the ids are kept in a set. For tables too large for that, pass
+		bloom_capacity to keep a Bloom filter instead: a miss is still
+		certain, while a hit then means the user probably exists.
+
+		The index is warmed from the database on first use and must be told
+		about every user inserted afterwards. Users inserted by another
+		process aren't seen until the index is warmed again."""
+
+	def __init__(self, bloom_capacity=None, error_rate=.01):
+		self._bloom_capacity = bloom_capacity
+		self._error_rate = error_rate
+		self._lock = threading.Lock()
+		self._ids = None
+
+	def warm(self, ids):
+		""" Rebuild the index from an iterable of instagram ids."""
+
+		if self._bloom_capacity:
+			known = BloomFilter(self._bloom_capacity, self._error_rate)
+		else:
+			known = set()
+		for instagram_id in ids:
+			known.add(str(instagram_id))
+		with self._lock:
+			self._ids = known
+
+	def reset(self):
+		""" Forget every id, so the index is warmed again on next use."""
+
+		with self._lock:
+			self._ids = None
+
+	def is_warm(self):
+		return self._ids is not None
+
+	def add(self, instagram_id):
+		""" Record a newly stored user."""
+
+		with self._lock:
+			if self._ids is not None:
+				self._ids.add(str(instagram_id))
+
+	def might_exist(self, instagram_id):
+		""" False only if the user is certainly not stored. A cold index
+			knows nothing, so every user might exist."""
+
+		known = self._ids
+		return known is None or str(instagram_id) in known
@@ -0,0 +1,98 @@
+""" Runs several crawl workers, each in its own process with its own
+database connection and api client, draining the crawl_task queue.
+
+Worker i uses the credentials at position first_client + i of CLIENTS in
+.instagram_config, wrapping around if there are fewer credentials than
+workers. Start workers on as many machines as needed, giving each machine
+its own range of credentials:
+
+	python worker.py --workers 4
+	python worker.py --workers 4 --first-client 4
+"""
+import sys
+import socket
+import logging
+import argparse
+import multiprocessing
+
+from instagram.client import InstagramAPI
+
+import models
+from frontier import CrawlRunner
+from metrics import configure_metrics
+
+log = logging.getLogger(__name__)
+
+
+def run_worker(name, client_index, database_url, max_tasks=None):
+	""" Drain the queue as the named worker, with the credentials at
+		client_index. The engine is created in the worker process, never
+		inherited from the parent."""
+
+	configure_metrics(models.config, worker=name)
+	credentials = models.client_credentials()
+	client_id, client_secret = credentials[client_index % len(credentials)]
+	# The cache counts its entries in process, so workers can't share a
+	# file.
+	cache_path = '%s.%s' %(models.config.get('CACHE_PATH', '.instagram_cache'),
+						   name)
+	models.configure(database_url=database_url,
+					 client=InstagramAPI(client_id=client_id,
+										 client_secret=client_secret),
+					 cache_path=cache_path)
+	# Small batches, so claimed tasks don't wait out their lease behind
+	# the rest of the batch.
+	ran = CrawlRunner(batch_size=10,worker=name).run(max_tasks)
+	log.info('Worker %s ran %d tasks.', name, ran)
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Crawl workers.')
+	parser.add_argument('--workers', type=int, default=1)
+	parser.add_argument('--first-client', type=int, default=0,
+						help='credentials of the first worker, from 0')
+	parser.add_argument('--database',
+						help='DATABASE_URL in .instagram_config by default')
+	parser.add_argument('--max-tasks', type=int,
+						help='tasks each worker runs before stopping')
+	parser.add_argument('--max-restarts', type=int, default=5,
+						help='times a worker that dies is started again')
+	args = parser.parse_args(argv)
+	logging.basicConfig(level=logging.INFO,
+						format='%(asctime)s %(processName)s %(name)s '
+							   '%(message)s')
+
+	host = socket.gethostname()
+	running = []
+	for i in xrange(args.workers):
+		client_index = args.first_client + i
+		running.append(_start(args, '%s-%d' %(host, client_index),
+							  client_index))
+	restarts = {}
+	failed = 0
+	# A worker that dies is started again, resuming its own tasks, until
+	# it has been restarted max_restarts times.
+	while running:
+		process, client_index = running.pop(0)
+		process.join(1)
+		if process.is_alive():
+			running.append((process, client_index))
+		elif process.exitcode:
+			log.warning('Worker %s exited with %d.', process.name,
+						process.exitcode)
+			restarts[process.name] = restarts.get(process.name, 0) + 1
+			if restarts[process.name] <= args.max_restarts:
+				running.append(_start(args, process.name, client_index))
+			else:
+				failed += 1
+	return 1 if failed else 0
+
+def _start(args, name, client_index):
+	process = multiprocessing.Process(target=run_worker, name=name,
+									  args=(name, client_index,
+											args.database, args.max_tasks))
+	process.start()
+	return process, client_index
+
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))